@@ -0,0 +1,67 @@
+"""Extract compressed maps pushed by fastdl
+
+Run this on a game server whose FTP push mode is set to compressed maps.
+It watches the maps directory for .bsp.bz2 files and, once one has stopped
+changing, extracts it next to itself and removes the bz2. It only needs the
+standard library:
+
+    python3 unpack.py /path/to/tf/maps
+"""
+from argparse import ArgumentParser
+from bz2 import BZ2File
+from os import listdir, path, replace, stat, unlink
+from shutil import copyfileobj
+from sys import stderr
+from time import sleep
+
+
+SUFFIX = '.bsp.bz2'
+
+
+def unpack(filename: str):
+    target = filename.removesuffix('.bz2')
+    temp = path.join(path.dirname(target), '.' + path.basename(target))
+    with BZ2File(filename) as source, open(temp, 'wb') as output:
+        copyfileobj(source, output, 1024 * 1024)
+    replace(temp, target)
+    unlink(filename)
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('directory')
+    parser.add_argument(
+        '--interval',
+        type=float,
+        default=5,
+        help='seconds between scans of the directory'
+    )
+    args = parser.parse_args()
+
+    # (size, mtime) of each bz2 at the previous scan; a file is only
+    # extracted once it looks the same twice, so uploads can finish
+    seen: dict[str, tuple[int, float]] = {}
+    while True:
+        current = {}
+        for name in listdir(args.directory):
+            if not name.endswith(SUFFIX):
+                continue
+            filename = path.join(args.directory, name)
+            try:
+                info = stat(filename)
+            except FileNotFoundError:
+                continue
+            current[filename] = (info.st_size, info.st_mtime)
+            if seen.get(filename) == current[filename]:
+                try:
+                    unpack(filename)
+                    del current[filename]
+                    print('extracted', name)
+                except (OSError, EOFError) as err:
+                    print(f'failed to extract {name}: {err}', file=stderr)
+        seen = current
+        sleep(args.interval)
+
+
+if __name__ == '__main__':
+    main()
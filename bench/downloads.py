@@ -0,0 +1,253 @@
+"""Benchmark map downloads
+
+Starts fastdl against a temporary SQLite database and an upload directory
+of generated maps, then fires concurrent downloads at it and reports
+latency, throughput, database queries per request and how long the access
+log spent writing to the database. Run from the repository root:
+
+    python -m bench.downloads --requests 2000 --concurrency 32
+"""
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from http.client import HTTPConnection
+from os import environ, mkdir, path, urandom
+from tempfile import TemporaryDirectory
+from threading import Thread, local
+from time import perf_counter, sleep
+
+
+SERVER_ADDRESS = ('203.0.113.10', 27015)
+STEAMID64 = 76561197960287930
+
+SCENARIOS = {
+    'whitelisted': {
+        'User-Agent': 'Half-Life 2',
+        'Referer': 'hl2://{}:{}'.format(*SERVER_ADDRESS),
+    },
+    'rejected': {
+        'User-Agent': 'Half-Life 2',
+        'Referer': 'hl2://198.51.100.1:27015',
+    },
+    'authenticated': {
+        'User-Agent': 'Mozilla/5.0',
+    },
+    # what a game client asks for when joining: the compressed map and
+    # other files first, then the map itself
+    'join': {
+        'User-Agent': 'Half-Life 2',
+        'Referer': 'hl2://{}:{}'.format(*SERVER_ADDRESS),
+    },
+}
+
+
+def join_requests(names: list[str]) -> list[str]:
+    requests = []
+    for name in names:
+        base = name.removesuffix('.bsp')
+        requests += [name + '.bz2', base + '.nav', base + '.res', name]
+    return requests
+
+
+def write_config(directory: str, fast_path: bool) -> str:
+    uploads = path.join(directory, 'uploads')
+    mkdir(uploads)
+    filename = path.join(directory, 'fastdl.cfg')
+    with open(filename, 'w') as cfg:
+        cfg.write(f'''
+SECRET_KEY = {urandom(16).hex()!r}
+STEAM_API_KEY = 'benchmark'
+SQLALCHEMY_DATABASE_URI = 'sqlite:///{path.join(directory, 'bench.sqlite')}'
+UPLOAD_DIR = {uploads!r}
+COMPRESS_WORKERS = 0
+DOWNLOAD_FAST_PATH = {fast_path!r}
+''')
+    return filename
+
+
+def generate_map(filename: str, size: int):
+    # half random, half zeros, so compressed maps are roughly realistic
+    block = 64 * 1024
+    with open(filename, 'wb') as bsp:
+        bsp.write(b'VBSP')
+        written = 4
+        while written < size:
+            length = min(block, size - written)
+            bsp.write(urandom(length // 2) + bytes(length - length // 2))
+            written += length
+
+
+def populate(app, db, sizes: list[int]) -> list[str]:
+    from fastdl.models import Map, Server, User
+
+    names = []
+    with app.app_context():
+        db.create_all()
+        server = Server(
+            ip=SERVER_ADDRESS[0],
+            port=SERVER_ADDRESS[1],
+            description='benchmark'
+        )
+        db.session.add(server)
+        db.session.add(User(steamid64=STEAMID64, name='benchmark'))
+        for i, size in enumerate(sizes):
+            map = Map(name=f'bench_{i}_{size}.bsp', uploaded=True)
+            generate_map(map.filename, size)
+            map.record_files()
+            db.session.add(map)
+            names.append(map.name)
+        db.session.commit()
+    return names
+
+
+def session_cookie(app) -> str:
+    serializer = app.session_interface.get_signing_serializer(app)
+    value = serializer.dumps({'_user_id': str(STEAMID64), '_fresh': True})
+    return app.config['SESSION_COOKIE_NAME'] + '=' + value
+
+
+def start_server(app, kind: str) -> int:
+    if kind == 'async':
+        from fastdl.async_download import serve
+        port = 28080
+        Thread(target=serve, args=('127.0.0.1', port), daemon=True).start()
+    else:
+        from werkzeug.serving import WSGIRequestHandler, make_server
+
+        class QuietHandler(WSGIRequestHandler):
+            def log_request(self, *args, **kwargs):
+                pass
+
+        server = make_server(
+            '127.0.0.1', 0, app,
+            threaded=True,
+            request_handler=QuietHandler
+        )
+        port = server.server_port
+        Thread(target=server.serve_forever, daemon=True).start()
+    sleep(0.5)
+    return port
+
+
+def run_scenario(
+    port: int,
+    names: list[str],
+    headers: dict[str, str],
+    requests: int,
+    concurrency: int
+) -> dict[str, float]:
+    connections = local()
+
+    def download(i: int) -> tuple[float, int, int]:
+        connection = getattr(connections, 'connection', None)
+        if connection is None:
+            connection = connections.connection = HTTPConnection(
+                '127.0.0.1', port
+            )
+        started = perf_counter()
+        connection.request('GET', '/maps/' + names[i % len(names)],
+                           headers=headers)
+        response = connection.getresponse()
+        length = len(response.read())
+        return perf_counter() - started, response.status, length
+
+    started = perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        results = list(executor.map(download, range(requests)))
+    elapsed = perf_counter() - started
+
+    latencies = sorted(result[0] for result in results)
+    statuses: dict[int, int] = {}
+    for _latency, status, _length in results:
+        statuses[status] = statuses.get(status, 0) + 1
+    return {
+        'p50': latencies[len(latencies) // 2] * 1000,
+        'p99': latencies[min(len(latencies) * 99 // 100,
+                             len(latencies) - 1)] * 1000,
+        'rps': requests / elapsed,
+        'mbps': sum(result[2] for result in results) / elapsed / 1e6,
+        'statuses': statuses,
+    }
+
+
+def query_count(metrics) -> float:
+    # includes the access log's batched writes, which are few
+    counters = metrics.snapshot()[0]
+    return counters.get(('fastdl_db_query_seconds_count', ()), 0)
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument(
+        '--sizes',
+        default='1000000,8000000,32000000',
+        help='comma-separated sizes of the generated maps in bytes'
+    )
+    parser.add_argument(
+        '--scenario',
+        action='append',
+        choices=list(SCENARIOS),
+        help='scenario to run; may be repeated (default: all)'
+    )
+    parser.add_argument(
+        '--server',
+        choices=['werkzeug', 'async'],
+        default='werkzeug',
+        help='serve with the Flask app or the asyncio download server'
+    )
+    parser.add_argument(
+        '--no-fast-path',
+        dest='fast_path',
+        action='store_false',
+        help='send game clients through the Flask view (werkzeug only)'
+    )
+    args = parser.parse_args()
+
+    with TemporaryDirectory(prefix='fastdl-bench-') as directory:
+        environ['FASTDL_SETTINGS'] = write_config(directory, args.fast_path)
+        from fastdl import access_log, app, db, metrics
+
+        names = populate(
+            app,
+            db,
+            [int(size) for size in args.sizes.split(',')]
+        )
+        port = start_server(app, args.server)
+        cookie = session_cookie(app)
+
+        print(
+            'scenario'.ljust(14) +
+            'p50 ms'.rjust(9) + 'p99 ms'.rjust(9) +
+            'req/s'.rjust(10) + 'MB/s'.rjust(10) + 'queries'.rjust(9) +
+            '  statuses'
+        )
+        for scenario in args.scenario or list(SCENARIOS):
+            headers = dict(SCENARIOS[scenario])
+            if scenario == 'authenticated':
+                headers['Cookie'] = cookie
+            paths = join_requests(names) if scenario == 'join' else names
+            queries = query_count(metrics)
+            result = run_scenario(
+                port, paths, headers, args.requests, args.concurrency
+            )
+            queries = (query_count(metrics) - queries) / args.requests
+            print(
+                scenario.ljust(14) +
+                '{:9.1f}{:9.1f}{:10.1f}{:10.1f}{:9.2f}'.format(
+                    result['p50'], result['p99'],
+                    result['rps'], result['mbps'], queries
+                ) +
+                '  ' + str(result['statuses'])
+            )
+
+        sleep(app.config['ACCESS_LOG_FLUSH_INTERVAL'] * 2)
+        print()
+        print(f'access log: {access_log.written} written, '
+              f'{access_log.pending()} pending, '
+              f'{access_log.dropped} dropped, '
+              f'{access_log.write_time:.3f}s spent writing')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,30 +1,67 @@
 from importlib import import_module
-from os import path
+from os import environ, path
+from threading import Lock
 
 from flask import Flask
 from flask_login import LoginManager
 from flask_sock import Sock
 from flask_sqlalchemy import SQLAlchemy
-from steam.webapi import WebAPI
 
 
-app = Flask('fastdl', instance_relative_config=True)
+# modules that only matter when serving requests
+VIEW_MODULES = [
+    'fastdl.views',
+    'fastdl.fast_download',
+    'fastdl.background',
+    'fastdl.metrics',
+    'fastdl.profiling',
+]
+
+
+class FastDL(Flask):
+    """Flask app that imports its views when it gets its first request
+
+    CLI commands that don't serve requests start faster without them.
+    """
+
+    views_loaded = False
+    views_lock = Lock()
+
+    def load_views(self):
+        with self.views_lock:
+            if not self.views_loaded:
+                for name in VIEW_MODULES:
+                    import_module(name)
+                self.views_loaded = True
+
+    def __call__(self, environ, start_response):
+        if not self.views_loaded:
+            self.load_views()
+        return super().__call__(environ, start_response)
+
+
+app = FastDL('fastdl', instance_relative_config=True)
 app.config.from_object('fastdl.config')
 app.config['UPLOAD_DIR'] = path.join(app.instance_path, 'uploads')
-app.config.from_pyfile('fastdl.cfg')
+app.config['STEAM_INTERFACE_CACHE'] = path.join(
+    app.instance_path, 'steam_interfaces.json'
+)
+app.config.from_pyfile(environ.get('FASTDL_SETTINGS', 'fastdl.cfg'))
 app.config['UPLOAD_DIR'] = path.abspath(app.config['UPLOAD_DIR'])
 
 for key in ['SECRET_KEY', 'SQLALCHEMY_DATABASE_URI', 'STEAM_API_KEY']:
     if key not in app.config:
         raise ValueError('Missing configuration key: ' + key)
 
+offload = app.config['DOWNLOAD_OFFLOAD']
+if offload not in (None, 'x-accel-redirect', 'x-sendfile'):
+    raise ValueError('Invalid DOWNLOAD_OFFLOAD: ' + str(offload))
+
 login_manager = LoginManager(app)
 db = SQLAlchemy(app)
 sock = Sock(app)
-steam_api = WebAPI(app.config['STEAM_API_KEY'])
+steam_api = import_module('fastdl.webapi').LazyWebAPI()
 
 
 models = import_module('fastdl.models')
-views = import_module('fastdl.views')
 cli = import_module('fastdl.cli')
-background = import_module('fastdl.background')
@@ -0,0 +1,172 @@
+from atexit import register
+from datetime import datetime
+from ipaddress import IPv4Address
+from queue import Empty, Full, Queue
+from sys import stderr
+from threading import Event, Lock, Thread
+from time import monotonic
+from traceback import print_exception
+
+from sqlalchemy.exc import IntegrityError
+
+from . import app, db
+from .models import Access, MapStats, ServerStats, UTCDateTime
+
+
+# (packed client ip, server id, map id, bytes served, access time)
+Entry = tuple[bytes, int, int, int, datetime]
+
+queue: Queue[Entry] = Queue(maxsize=app.config['ACCESS_LOG_QUEUE_SIZE'])
+stopping = Event()
+thread: Thread | None = None
+thread_lock = Lock()
+
+dropped = 0
+written = 0
+# seconds spent writing batches, a measure of database write contention
+write_time = 0.0
+
+
+def pending() -> int:
+    return queue.qsize()
+
+
+def record(
+    address: str | IPv4Address,
+    server_id: int,
+    map_id: int,
+    size: int
+):
+    """Queue an access to be written by the flusher thread"""
+    global dropped
+    if not isinstance(address, IPv4Address):
+        address = IPv4Address(address)
+    ensure_started()
+    try:
+        queue.put_nowait(
+            (address.packed, server_id, map_id, size, UTCDateTime.utcnow())
+        )
+    except Full:
+        dropped += 1
+
+
+Totals = dict[int, list]
+
+
+def add_stats(connection, model, key, totals: Totals):
+    for id, (served, bytes_served, last_access) in totals.items():
+        values = {
+            'served': model.served + served,
+            'bytes_served': model.bytes_served + bytes_served,
+            'last_access': last_access
+        }
+        statement = db.update(model).where(key == id).values(values)
+        if connection.execute(statement).rowcount:
+            continue
+        try:
+            with connection.begin_nested():
+                connection.execute(db.insert(model).values({
+                    key.key: id,
+                    'served': served,
+                    'bytes_served': bytes_served,
+                    'last_access': last_access
+                }))
+        except IntegrityError:
+            # another process created the row first
+            connection.execute(statement)
+
+
+def tally(totals: Totals, id: int, size: int, time: datetime):
+    total = totals.setdefault(id, [0, 0, time])
+    total[0] += 1
+    total[1] += size
+    total[2] = max(total[2], time)
+
+
+def write(entries: list[Entry]):
+    global written, write_time
+    started = monotonic()
+    maps: Totals = {}
+    servers: Totals = {}
+    for _ip, server_id, map_id, size, time in entries:
+        tally(maps, map_id, size, time)
+        tally(servers, server_id, size, time)
+
+    with db.engine.begin() as connection:
+        connection.execute(db.insert(Access), [
+            {
+                '_ip': ip,
+                'server_id': server_id,
+                'map_id': map_id,
+                'access_time': time
+            }
+            for ip, server_id, map_id, _size, time in entries
+        ])
+        add_stats(connection, MapStats, MapStats.map_id, maps)
+        add_stats(connection, ServerStats, ServerStats.server_id, servers)
+    written += len(entries)
+    write_time += monotonic() - started
+
+
+def drain(limit: int) -> list[Entry]:
+    entries = []
+    while len(entries) < limit:
+        try:
+            entries.append(queue.get_nowait())
+        except Empty:
+            break
+    return entries
+
+
+def flush():
+    """Write everything currently queued"""
+    batch_size = app.config['ACCESS_LOG_BATCH_SIZE']
+    while entries := drain(batch_size):
+        write(entries)
+
+
+def flusher_thread():
+    global dropped
+    interval = app.config['ACCESS_LOG_FLUSH_INTERVAL']
+    batch_size = app.config['ACCESS_LOG_BATCH_SIZE']
+    with app.app_context():
+        while not stopping.is_set():
+            deadline = monotonic() + interval
+            entries = []
+            while len(entries) < batch_size and not stopping.is_set():
+                try:
+                    entries.append(
+                        queue.get(timeout=max(deadline - monotonic(), 0))
+                    )
+                except Empty:
+                    break
+                entries.extend(drain(batch_size - len(entries)))
+            if not entries:
+                continue
+            try:
+                write(entries)
+            except Exception as ex:
+                dropped += len(entries)
+                print(f'failed to write {len(entries)} accesses:', file=stderr)
+                print_exception(ex, file=stderr)
+        flush()
+
+
+def ensure_started():
+    global thread
+    if thread is None:
+        with thread_lock:
+            if thread is None:
+                thread = Thread(
+                    target=flusher_thread,
+                    name='access-log',
+                    daemon=True
+                )
+                thread.start()
+
+
+@register
+def shutdown():
+    stopping.set()
+    if thread is not None:
+        thread.join()
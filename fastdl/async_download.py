@@ -0,0 +1,224 @@
+from asyncio import (
+    IncompleteReadError, LimitOverrunError, StreamReader, StreamWriter,
+    get_running_loop, run, start_server, wait_for
+)
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate
+from os import fstat
+from time import perf_counter
+from urllib.parse import unquote, urlsplit
+
+from werkzeug.http import dump_options_header
+
+from . import access_log, app, metrics
+from .download import MapFile, classify_client, find_map_file
+
+
+HEADER_TIMEOUT = 30
+MAX_HEADER_SIZE = 16 * 1024
+STATUS = {
+    200: 'OK',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+}
+
+Headers = dict[str, str]
+
+# database lookups block, so they run here rather than on the event loop
+executor = ThreadPoolExecutor(thread_name_prefix='download-lookup')
+
+
+def lookup(
+    name: str,
+    headers: Headers
+) -> tuple[MapFile, int] | str:
+    """Find the file to send, or the outcome to count a refusal under"""
+    with app.app_context():
+        server_id, outcome = classify_client(
+            headers.get('user-agent'),
+            headers.get('referer')
+        )
+        if server_id is None:
+            return outcome
+        file = find_map_file(name)
+        if file is None:
+            return 'not_found'
+        return file, server_id
+
+
+def client_address(peer: str, headers: Headers) -> str:
+    """Get the client's address, trusting X-Forwarded-For from proxies
+
+    Addresses are taken from the end of X-Forwarded-For for as long as the
+    one that sent them is in DOWNLOAD_TRUSTED_PROXIES.
+    """
+    trusted = app.config['DOWNLOAD_TRUSTED_PROXIES']
+    forwarded = [
+        address.strip()
+        for address in headers.get('x-forwarded-for', '').split(',')
+        if address.strip()
+    ]
+    address = peer
+    while address in trusted and forwarded:
+        address = forwarded.pop()
+    return address
+
+
+def parse_request(head: bytes) -> tuple[str, str, str, Headers] | None:
+    try:
+        request_line, *header_lines = head.decode('latin-1').split('\r\n')
+        method, target, version = request_line.split(' ')
+    except ValueError:
+        return None
+
+    headers: Headers = {}
+    for line in header_lines:
+        if not line:
+            continue
+        name, sep, value = line.partition(':')
+        if not sep:
+            return None
+        headers[name.strip().lower()] = value.strip()
+    return method, target, version, headers
+
+
+def response_head(
+    status: int,
+    headers: list[tuple[str, str]],
+    keep_alive: bool
+) -> bytes:
+    lines = [f'HTTP/1.1 {status} {STATUS[status]}']
+    lines.append('Date: ' + formatdate(usegmt=True))
+    lines.append('Connection: ' + ('keep-alive' if keep_alive else 'close'))
+    lines.extend(f'{name}: {value}' for name, value in headers)
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+
+def send_error(writer: StreamWriter, status: int, keep_alive: bool):
+    body = STATUS[status].encode()
+    writer.write(response_head(status, [
+        ('Content-Type', 'text/plain'),
+        ('Content-Length', str(len(body))),
+    ], keep_alive) + body)
+
+
+async def respond(
+    writer: StreamWriter,
+    method: str,
+    target: str,
+    headers: Headers,
+    keep_alive: bool
+):
+    if method not in ('GET', 'HEAD'):
+        send_error(writer, 405, keep_alive)
+        return
+
+    started = perf_counter()
+    path = unquote(urlsplit(target).path)
+    name = path.removeprefix('/maps/')
+    if name == path or not name or '/' in name:
+        metrics.record_download('not_found', started)
+        send_error(writer, 404, keep_alive)
+        return
+
+    loop = get_running_loop()
+    found = await loop.run_in_executor(executor, lookup, name, headers)
+    if isinstance(found, str):
+        metrics.record_download(found, started)
+        send_error(writer, 404, keep_alive)
+        return
+    file, server_id = found
+
+    try:
+        fp = open(file.filename, 'rb')
+    except OSError:
+        metrics.record_download('not_found', started)
+        send_error(writer, 404, keep_alive)
+        return
+
+    with fp:
+        size = fstat(fp.fileno()).st_size
+        if method == 'GET':
+            peer = writer.get_extra_info('peername')
+            try:
+                access_log.record(
+                    client_address(peer[0], headers),
+                    server_id,
+                    file.map_id,
+                    size
+                )
+            except ValueError:
+                metrics.record_download('not_found', started)
+                send_error(writer, 404, keep_alive)
+                return
+
+        writer.write(response_head(200, [
+            ('Content-Type', file.mimetype),
+            ('Content-Length', str(size)),
+            (
+                'Content-Disposition',
+                dump_options_header(
+                    'attachment',
+                    {'filename': file.download_name}
+                )
+            ),
+        ], keep_alive))
+        if method == 'GET':
+            await loop.sendfile(writer.transport, fp, 0, size)
+        metrics.record_download(
+            'served',
+            started,
+            file.map_name,
+            server_id,
+            size if method == 'GET' else 0
+        )
+
+
+async def handle_connection(reader: StreamReader, writer: StreamWriter):
+    try:
+        while True:
+            try:
+                head = await wait_for(
+                    reader.readuntil(b'\r\n\r\n'),
+                    HEADER_TIMEOUT
+                )
+            except (IncompleteReadError, LimitOverrunError, TimeoutError):
+                break
+
+            request = parse_request(head)
+            if request is None:
+                send_error(writer, 400, False)
+                break
+            method, target, version, headers = request
+
+            connection = headers.get('connection', '').lower()
+            if version == 'HTTP/1.1':
+                keep_alive = connection != 'close'
+            else:
+                keep_alive = connection == 'keep-alive'
+
+            await respond(writer, method, target, headers, keep_alive)
+            await writer.drain()
+            if not keep_alive:
+                break
+
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def serve_forever(host: str, port: int):
+    server = await start_server(
+        handle_connection,
+        host,
+        port,
+        limit=MAX_HEADER_SIZE
+    )
+    async with server:
+        await server.serve_forever()
+
+
+def serve(host: str, port: int):
+    run(serve_forever(host, port))
@@ -1,43 +1,263 @@
 from json import JSONDecodeError, dumps, loads
-from typing import Callable
-from weakref import ref, WeakSet
+from threading import Lock
+from time import monotonic
+from typing import Callable, NamedTuple
+from weakref import WeakSet
 
 from flask_login import login_required
 from flask_sock import Server
 from simple_websocket import ConnectionClosed
 
-from . import sock
+from . import db, sock
+from .models import Map
 
 
-subscribers: dict[int, WeakSet[Callable[[int, str, float], None]]] = {}
+# seconds between frames sent to each websocket
+PROGRESS_INTERVAL = 0.1
+# seconds between reads of the job queues for the dashboard
+QUEUE_INTERVAL = 1.0
+# how long finished tasks stay on the dashboard
+TASK_RETENTION = 60
+# running tasks silent for this long are shown as failed; their worker died
+TASK_TIMEOUT = 5 * 60
+# subscribers under this key get every map's progress
+EVERY_MAP = 0
+
+
+class Task(NamedTuple):
+    map_id: int
+    type: str
+    state: str
+    progress: float
+    # bytes the whole task processes, if known
+    size: int | None
+    # progress when first reported; resumed transfers don't start at 0
+    initial: float
+    started: float
+    updated: float
+
+    def describe(self) -> dict:
+        elapsed = self.updated - self.started
+        done = self.progress - self.initial
+        rate = eta = None
+        if self.size and elapsed > 0:
+            rate = done * self.size / elapsed
+        if self.state == 'running' and done > 0:
+            eta = elapsed * (1 - self.progress) / done
+        return {
+            'm': self.map_id,
+            't': self.type,
+            's': self.state,
+            'p': self.progress,
+            'rate': rate,
+            'eta': eta,
+        }
+
+
+class QueueState(NamedTuple):
+    # jobs waiting, by kind of task
+    waiting: dict[str, int]
+    # (kind of task, map name, process) of jobs a live process has taken
+    claimed: list[tuple[str, str, str]]
+
+
+class Outbox:
+    """Progress waiting to be sent to one websocket
+
+    Only the latest state of each task is kept, so however often a task
+    reports, the socket gets at most one update for it per frame.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.pending: dict[tuple[int, str], Task] = {}
+
+    def put(self, task: Task):
+        with self.lock:
+            self.pending[(task.map_id, task.type)] = task
+
+    def take(self) -> list[Task]:
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        return list(pending.values())
+
+
+subscribers: dict[int, WeakSet[Outbox]] = {}
+# latest state of running and recently finished tasks; this is kept in
+# memory, so each process only knows about the tasks it runs itself
+latest: dict[tuple[int, str], Task] = {}
+# functions reading a job queue from the database, so that jobs waiting
+# for or taken by any process are shown
+queue_states: list[Callable[[], QueueState]] = []
+lock = Lock()
+
+
+def report(
+    map_id: int,
+    type: str,
+    progress: float,
+    size: int | None = None,
+    failed: bool = False
+):
+    """Record the progress of a background task
+
+    This is called from worker threads for every block they process, so it
+    never touches a socket; the websockets pick the update up on their next
+    tick.
+    """
+    now = monotonic()
+    if failed:
+        state = 'failed'
+    elif progress >= 1.0:
+        state = 'done'
+    else:
+        state = 'running'
+
+    with lock:
+        previous = latest.get((map_id, type))
+        if previous is not None and previous.state == 'running':
+            initial = previous.initial
+            started = previous.started
+            if size is None:
+                size = previous.size
+        else:
+            initial = progress
+            started = now
+        task = latest[(map_id, type)] = Task(
+            map_id, type, state, progress, size, initial, started, now
+        )
+        outboxes = get_outboxes(map_id)
+    for outbox in outboxes:
+        outbox.put(task)
+
+
+def get_outboxes(map_id: int) -> list[Outbox]:
+    """Outboxes subscribed to map_id; the caller must hold lock"""
+    return [
+        *subscribers.get(map_id, ()),
+        *subscribers.get(EVERY_MAP, ())
+    ]
+
+
+def expire():
+    """Forget old finished tasks, and fail running ones that went silent"""
+    now = monotonic()
+    updates = []
+    with lock:
+        for key, task in list(latest.items()):
+            age = now - task.updated
+            if task.state != 'running':
+                if age > TASK_RETENTION:
+                    del latest[key]
+            elif age > TASK_TIMEOUT:
+                task = latest[key] = task._replace(state='failed', updated=now)
+                updates += [
+                    (outbox, task) for outbox in get_outboxes(task.map_id)
+                ]
+    for outbox, task in updates:
+        outbox.put(task)
+
+
+def fail(map_id: int, type: str):
+    """Mark a task as failed, keeping the progress it had made"""
+    with lock:
+        previous = latest.get((map_id, type))
+    progress = previous.progress if previous is not None else 0.0
+    report(map_id, type, progress, failed=True)
+
+
+def subscribe(map_id: int, outbox: Outbox):
+    """Send progress of map_id, or of every map, to outbox
+
+    What is already known about the map's tasks is sent straight away, so a
+    reconnecting client catches up.
+    """
+    expire()
+    with lock:
+        subscribers.setdefault(map_id, WeakSet()).add(outbox)
+        for task in latest.values():
+            if map_id in (task.map_id, EVERY_MAP):
+                outbox.put(task)
+
+
+def get_queue_states() -> dict:
+    waiting = {}
+    claimed = []
+    for get_state in queue_states:
+        state = get_state()
+        waiting.update(state.waiting)
+        claimed += state.claimed
+    return {
+        'queues': waiting,
+        'claimed': [
+            {'t': type, 'n': name, 'by': process}
+            for type, name, process in sorted(claimed)
+        ]
+    }
 
 
 @login_required
 @sock.route('/progress')
 def progress(sock: Server):
-    subscribed = set()
-    weak_sock = ref(sock)
-
-    def send_progress(map_id: int, type: str, progress: float):
-        sock = weak_sock()
-        if sock is not None:
-            try:
-                sock.send(dumps({'m': map_id, 't': type, 'p': progress}))
-            except ConnectionClosed:
-                pass
+    outbox = Outbox()
+    next_frame = monotonic()
 
     try:
         while True:
-            message = sock.receive()
+            message = sock.receive(
+                timeout=max(next_frame - monotonic(), 0)
+            )
             if message is not None:
                 try:
-                    id = loads(message)['m']
-                    if id not in subscribed:
-                        subscribed.add(id)
-                        weak_set = subscribers.setdefault(id, WeakSet())
-                        weak_set.add(send_progress)
-                except (KeyError, JSONDecodeError):
+                    subscribe(loads(message)['m'], outbox)
+                except (KeyError, TypeError, JSONDecodeError):
                     pass
 
+            if monotonic() >= next_frame:
+                next_frame = monotonic() + PROGRESS_INTERVAL
+                frame = outbox.take()
+                if frame:
+                    sock.send(dumps([
+                        {'m': task.map_id, 't': task.type, 'p': task.progress}
+                        for task in frame
+                    ]))
+
+    except ConnectionClosed:
+        sock.close()
+
+
+@sock.route('/tasks/feed')
+@login_required
+def tasks_feed(sock: Server):
+    outbox = Outbox()
+    subscribe(EVERY_MAP, outbox)
+    names: dict[int, str] = {}
+    queues = None
+    next_poll = monotonic()
+
+    try:
+        while True:
+            # nothing is expected from the client; this just paces frames
+            sock.receive(timeout=PROGRESS_INTERVAL)
+            expire()
+
+            tasks = []
+            for task in outbox.take():
+                if task.map_id not in names:
+                    map = db.session.get(Map, task.map_id)
+                    names[task.map_id] = map.name if map else '(deleted)'
+                    db.session.rollback()
+                tasks.append(task.describe() | {'n': names[task.map_id]})
+            message = {'tasks': tasks}
+            if monotonic() >= next_poll:
+                next_poll = monotonic() + QUEUE_INTERVAL
+                current = get_queue_states()
+                db.session.rollback()
+                if current != queues:
+                    queues = current
+                    message |= queues
+            if len(message) > 1 or tasks:
+                sock.send(dumps(message))
+
     except ConnectionClosed:
         sock.close()
@@ -1,10 +1,20 @@
-from os import listdir, mkdir, path
+from concurrent.futures import ThreadPoolExecutor
+from io import StringIO
+from os import listdir, mkdir, path, stat
+from pstats import Stats
 
-from click import argument, echo, option
+from click import ClickException, argument, echo, option
 from steam.enums.common import EType
 
+from sqlalchemy import Column, inspect, literal, text
+from sqlalchemy.sql.functions import count, max as max_
+
 from . import app, db
-from .models import Map, User
+from .models import (
+    Access, CompressJob, Map, MapStats, Server, ServerStats, Upload, User
+)
+from .profiles import get_name, refresh_users
+from .storage import adopt, hash_file
 from .util import string_to_steamid
 
 
@@ -26,6 +36,108 @@ def create_database():
     db.create_all()
 
 
+def add_column_ddl(column: Column) -> str:
+    dialect = db.engine.dialect
+    quote = dialect.identifier_preparer.quote
+    ddl = 'ALTER TABLE {} ADD COLUMN {} {}'.format(
+        quote(column.table.name),
+        quote(column.name),
+        column.type.compile(dialect=dialect)
+    )
+    default = column.default
+    if default is not None and default.is_scalar:
+        ddl += ' DEFAULT ' + str(literal(default.arg, column.type).compile(
+            dialect=dialect,
+            compile_kwargs={'literal_binds': True}
+        ))
+    elif not column.nullable:
+        raise ClickException(
+            f'{column.table.name}.{column.name} has no default to fill '
+            'existing rows with'
+        )
+    if not column.nullable:
+        ddl += ' NOT NULL'
+    return ddl
+
+
+@database.command()
+def upgrade():
+    """Add tables, columns and indexes missing from an older database
+
+    Existing rows get each new column's default. Nothing is removed or
+    changed, except that the sizes of maps added before they were kept are
+    recorded.
+    """
+    db.create_all()
+    inspector = inspect(db.engine)
+    with db.engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            columns = {
+                column['name'] for column in inspector.get_columns(table.name)
+            }
+            for column in table.columns:
+                if column.name not in columns:
+                    connection.execute(text(add_column_ddl(column)))
+                    echo(f'added column {table.name}.{column.name}')
+
+            indexes = {
+                index['name'] for index in inspector.get_indexes(table.name)
+            }
+            for index in table.indexes:
+                if index.name not in indexes:
+                    index.create(connection)
+                    echo(f'added index {index.name}')
+
+    recorded = Map.record_unscanned()
+    if recorded:
+        echo(f'recorded the sizes of {recorded} maps')
+
+
+@database.command('rebuild-stats')
+def rebuild_stats():
+    """Recompute per-map and per-server statistics from the access log"""
+    db.session.execute(db.delete(MapStats))
+    db.session.execute(db.delete(ServerStats))
+
+    sizes = {}
+    for map in db.session.scalars(db.select(Map)):
+        sizes[map.id] = map.size_compressed if map.compressed else map.size
+
+    served_by_map = db.select(
+        Access.map_id, count(Access.id), max_(Access.access_time)
+    ).group_by(Access.map_id)
+    for map_id, served, last_access in db.session.execute(served_by_map):
+        db.session.add(MapStats(
+            map_id=map_id,
+            served=served,
+            bytes_served=served * sizes.get(map_id, 0),
+            last_access=last_access
+        ))
+
+    served_by_server = db.select(
+        Access.server_id, Access.map_id, count(Access.id),
+        max_(Access.access_time)
+    ).group_by(Access.server_id, Access.map_id)
+    stats: dict[int, ServerStats] = {}
+    for server_id, map_id, served, last_access in db.session.execute(
+        served_by_server
+    ):
+        server_stats = stats.get(server_id)
+        if server_stats is None:
+            server_stats = stats[server_id] = ServerStats(
+                server_id=server_id,
+                served=0,
+                bytes_served=0,
+                last_access=last_access
+            )
+            db.session.add(server_stats)
+        server_stats.served += served
+        server_stats.bytes_served += served * sizes.get(map_id, 0)
+        server_stats.last_access = max(server_stats.last_access, last_access)
+
+    db.session.commit()
+
+
 @app.cli.group()
 def maps():
     """Map-related utilites"""
@@ -69,7 +181,9 @@ def discover():
         with open(full_path, 'rb') as file:
             magic_number = file.read(4)
         if magic_number == b'VBSP':
-            db.session.add(Map(name=name, uploaded=True))
+            new_map = Map(name=name, uploaded=True)
+            new_map.record_files()
+            db.session.add(new_map)
             echo('added ' + name)
         else:
             echo('warning: ignoring invalid BSP ' + name)
@@ -77,17 +191,286 @@ def discover():
     db.session.commit()
 
 
+@maps.command('retry-compress')
+def retry_compress():
+    """Compress maps again whose compression failed
+
+    The running app picks them up within COMPRESS_POLL_INTERVAL seconds.
+    """
+    from .compress import retry
+
+    for job in db.session.scalars(
+        db.select(CompressJob).where(CompressJob.failed == True)  # noqa
+    ):
+        echo(f'retrying {job.map.name}: {job.error}')
+        retry(job)
+    db.session.commit()
+
+
+@maps.command('compress-report')
+def compress_report():
+    """Show how well each map compressed and the bandwidth it saved"""
+    echo(
+        'Map'.ljust(32) + '  ' +
+        'Size (MiB)'.rjust(10) + '  ' +
+        'Ratio'.rjust(6) + '  ' +
+        'Time (s)'.rjust(8) + '  ' +
+        'Served'.rjust(7) + '  ' +
+        'Saved (MiB)'.rjust(11)
+    )
+    echo('-' * 84)
+
+    mib = 1024 * 1024
+    total_saved = 0
+    for map in db.session.scalars(db.select(Map).order_by(Map.name)):
+        size = map.size
+        if map.compressed and size:
+            ratio = '{:.3f}'.format(map.size_compressed / size)
+            saved = (size - map.size_compressed) * map.times_served
+        elif map.compress_level == 0:
+            ratio = 'skip'
+            saved = 0
+        elif map.compress_job is not None and map.compress_job.failed:
+            ratio = 'failed'
+            saved = 0
+        else:
+            ratio = '-'
+            saved = 0
+        total_saved += saved
+
+        if map.compress_time is None:
+            time = '-'
+        else:
+            time = '{:.1f}'.format(map.compress_time)
+
+        echo(
+            map.name[:32].ljust(32) + '  ' +
+            '{:.1f}'.format(size / mib).rjust(10) + '  ' +
+            ratio.rjust(6) + '  ' +
+            time.rjust(8) + '  ' +
+            str(map.times_served).rjust(7) + '  ' +
+            '{:.1f}'.format(saved / mib).rjust(11)
+        )
+
+    echo('-' * 84)
+    echo('Total saved: {:.1f} MiB'.format(total_saved / mib))
+
+
+@maps.command('serve')
+@option('--host', default='0.0.0.0', help='Address to listen on')
+@option('--port', default=8080, help='Port to listen on')
+def serve_downloads(host, port):
+    """Serve map downloads to game clients asynchronously
+
+    Only whitelisted game clients are served. Keep the Flask app running for
+    the web interface and for downloads by logged-in users.
+    """
+    from .async_download import serve
+
+    echo(f'serving downloads on {host}:{port}')
+    serve(host, port)
+
+
+@maps.command()
+def dedupe():
+    """Move maps stored under their own name into the blob store"""
+    for map in db.session.scalars(
+        db.select(Map).where(
+            Map.uploaded == True,  # noqa
+            Map.digest == None  # noqa
+        )
+    ):
+        try:
+            map.digest = adopt(map.filename, map.compressed)
+        except IOError as e:
+            echo(f'warning: could not move {map.name}: {e}')
+            continue
+        map.content_hash = map.digest
+        db.session.commit()
+        echo(f'moved {map.name} to {map.digest}')
+
+
 @maps.command()
 def prune():
-    """Remove maps that do not exist on the filesystem"""
+    """Remove maps that do not exist on the filesystem
+
+    Maps still being uploaded in chunks are kept, unless the upload was
+    started more than UPLOAD_EXPIRY seconds ago.
+    """
+    for name in Upload.expire():
+        echo('expired upload of ' + name)
     for map in db.session.scalars(db.select(Map)):
-        if not path.isfile(map.filename):
+        if map.upload is None and not path.isfile(map.filename):
             db.session.delete(map)
             echo('pruned ' + map.name)
 
     db.session.commit()
 
 
+def scan_map(
+    filename: str,
+    filename_compressed: str | None,
+    content_hash: str | None,
+    previous: tuple[int, float | None] | None
+) -> tuple[int, float, str, int]:
+    """Get the size, mtime, hash and compressed size of a map's files
+
+    content_hash is kept if the size and mtime are still previous.
+    """
+    info = stat(filename)
+    if content_hash is None or (info.st_size, info.st_mtime) != previous:
+        content_hash = hash_file(filename)
+    size_compressed = 0
+    if filename_compressed is not None:
+        size_compressed = path.getsize(filename_compressed)
+    return info.st_size, info.st_mtime, content_hash, size_compressed
+
+
+@maps.command()
+@option('--workers', default=8, help='Maps to read at once')
+@option('--rehash', is_flag=True, help='Hash maps that look unchanged too')
+def rescan(workers, rehash):
+    """Record the size, mtime and hash of every map's files
+
+    Pages read these from the database instead of the filesystem. Maps
+    outside the blob store are only hashed again if their size or mtime
+    changed, unless --rehash is given.
+    """
+    maps = list(db.session.scalars(
+        db.select(Map).where(Map.uploaded == True)  # noqa
+    ))
+    with ThreadPoolExecutor(workers) as executor:
+        futures = [
+            executor.submit(
+                scan_map,
+                map.filename,
+                map.filename_compressed if map.compressed else None,
+                map.digest or (None if rehash else map.content_hash),
+                (map.size, map.mtime)
+            )
+            for map in maps
+        ]
+
+        changed = 0
+        for map, future in zip(maps, futures):
+            try:
+                scanned = future.result()
+            except OSError as e:
+                echo(f'warning: could not read {map.name}: {e}')
+                continue
+            current = (
+                map.size, map.mtime, map.content_hash, map.size_compressed
+            )
+            if scanned != current:
+                (
+                    map.size, map.mtime, map.content_hash, map.size_compressed
+                ) = scanned
+                changed += 1
+                echo('updated ' + map.name)
+
+    db.session.commit()
+    echo(f'{changed} of {len(maps)} maps changed')
+
+
+@maps.command()
+def sync():
+    """Push maps that are missing from game servers over FTP
+
+    Lists each server's maps directory once and compares it with what was
+    pushed before. Missing maps are queued; the running app pushes them
+    within FTP_POLL_INTERVAL seconds.
+    """
+    from ftplib import all_errors
+
+    from .upload_ftp import (
+        close_quietly, list_remote, open_ftp_session, reconcile
+    )
+
+    for server in db.session.scalars(
+        db.select(Server).where(Server.ftp_enabled == True)  # noqa
+    ):
+        try:
+            ftp = open_ftp_session(server)
+            try:
+                listing = list_remote(ftp)
+            finally:
+                close_quietly(ftp)
+        except all_errors as e:
+            echo(f'warning: could not list {server.description}: {e}')
+            continue
+        missing = reconcile(server, listing)
+        echo(f'{server.description}: {missing} maps queued')
+
+
+@app.cli.group()
+def profile():
+    """Inspect profiles of sampled requests"""
+    pass
+
+
+@profile.command()
+@option('--functions', default=0, help='Functions to show per endpoint')
+def top(functions):
+    """Show where sampled requests spent their time, by endpoint
+
+    Reads the profiles saved to PROFILE_DIR. Times are means per request.
+    With --functions, also shows the functions with the most cumulative
+    time in each endpoint's combined cProfile dumps.
+    """
+    from .profiling import load_profiles
+
+    if app.config['PROFILE_DIR'] is None:
+        raise ClickException('PROFILE_DIR is not set')
+    profiles = load_profiles(app.config['PROFILE_DIR'])
+    if not profiles:
+        echo('no profiles saved yet')
+        return
+
+    echo(
+        'Endpoint'.ljust(24) + '  ' +
+        'Requests'.rjust(8) + '  ' +
+        'Time (ms)'.rjust(9) + '  ' +
+        'Max (ms)'.rjust(8) + '  ' +
+        'Queries'.rjust(7) + '  ' +
+        'SQL (ms)'.rjust(8) + '  ' +
+        'Stats'.rjust(5) + '  ' +
+        'Render (ms)'.rjust(11)
+    )
+    echo('-' * 96)
+
+    def total_time(item):
+        return sum(summary['time'] for summary, _dump in item[1])
+
+    by_time = sorted(profiles.items(), key=total_time, reverse=True)
+    for endpoint, samples in by_time:
+        summaries = [summary for summary, _dump in samples]
+
+        def mean(key):
+            return sum(summary[key] for summary in summaries) / len(summaries)
+
+        echo(
+            endpoint[:24].ljust(24) + '  ' +
+            str(len(summaries)).rjust(8) + '  ' +
+            '{:.1f}'.format(mean('time') * 1000).rjust(9) + '  ' +
+            '{:.1f}'.format(
+                max(summary['time'] for summary in summaries) * 1000
+            ).rjust(8) + '  ' +
+            '{:.1f}'.format(mean('queries')).rjust(7) + '  ' +
+            '{:.1f}'.format(mean('query_time') * 1000).rjust(8) + '  ' +
+            '{:.1f}'.format(mean('stats')).rjust(5) + '  ' +
+            '{:.1f}'.format(mean('render_time') * 1000).rjust(11)
+        )
+
+    if functions:
+        for endpoint, samples in by_time:
+            echo()
+            echo(f'{endpoint}:')
+            output = StringIO()
+            stats = Stats(*(dump for _summary, dump in samples), stream=output)
+            stats.sort_stats('cumulative').print_stats(functions)
+            echo(output.getvalue())
+
+
 @app.cli.group()
 def user():
     """Manage users"""
@@ -104,8 +487,11 @@ def create_user(steamid, admin):
         echo('Invalid steam ID')
         return 1
 
-    user = User(steamid64=steamid.as_64, admin=admin)
-    user.refresh_name()
+    user = User(
+        steamid64=steamid.as_64,
+        admin=admin,
+        name=get_name(steamid.as_64)
+    )
     if user.name is not None:
         db.session.add(user)
         db.session.commit()
@@ -135,3 +521,13 @@ def list_users():
     echo('-' * 79)
     for user in db.session.scalars(db.select(User)):
         echo(str(user.steamid64) + '  ' + user.name)
+
+
+@user.command('refresh')
+def refresh_user_names():
+    """Update every user's name from their Steam profile
+
+    Steam is asked about up to 100 users at a time.
+    """
+    changed = refresh_users()
+    echo(f'{changed} names changed')
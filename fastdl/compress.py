@@ -1,74 +1,499 @@
-from bz2 import BZ2Compressor
-from errno import EXDEV
-from os import fstat, link, unlink
-from shutil import copyfile
+from bz2 import BZ2Compressor, compress
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from datetime import timedelta
+from enum import IntEnum
+from itertools import count
+from multiprocessing import get_context
+from os import cpu_count, fstat, getpid, path, replace
+from queue import PriorityQueue
+from socket import gethostname
 from sys import stderr
 from tempfile import NamedTemporaryFile
-from threading import Thread
+from threading import Condition, Lock, Thread
+from time import monotonic, sleep
 from traceback import print_exception
+from typing import BinaryIO, Callable
 
-from . import app, db
-from .background import subscribers
-from .models import Map
+from sqlalchemy import or_
+from sqlalchemy.sql.functions import count as count_rows
+from sqlalchemy.exc import IntegrityError
 
+from . import app, db, metrics
+from .background import QueueState, fail, queue_states, report
+from .download import forget_missing
+from .models import CompressJob, Map, UTCDateTime
 
-BLOCK_SIZE = 16 * 1024
 
+executor: ProcessPoolExecutor | None = None
+executor_lock = Lock()
 
-def send_progress(id: int, progress: float):
-    for subscriber in subscribers.get(id, []):
-        subscriber(id, 'Compressing to bz2', progress)
 
+def process_count() -> int:
+    return app.config['COMPRESS_PROCESSES'] or cpu_count() or 1
 
-def compress_file(map: Map):
-    with NamedTemporaryFile(delete_on_close=False) as tempfile:
-        compressor = BZ2Compressor()
+
+def get_executor() -> ProcessPoolExecutor:
+    global executor
+    if executor is None:
+        with executor_lock:
+            if executor is None:
+                # spawn rather than fork: the app has threads running
+                executor = ProcessPoolExecutor(
+                    max_workers=process_count(),
+                    mp_context=get_context('spawn')
+                )
+    return executor
+
+
+class ParallelCompressor:
+    """Compress data written to it into a multi-stream bz2 file
+
+    Input is cut into blocks that are compressed as independent bz2 streams
+    on a process pool and written to output in order. Only decompressors
+    that understand concatenated streams read the whole result; others stop
+    after the first block. See COMPRESS_MULTI_STREAM.
+    """
+
+    def __init__(
+        self,
+        output: BinaryIO,
+        level: int = 9,
+        block_size: int = 900 * 1000,
+        callback: Callable[[int], None] | None = None
+    ):
+        self.output = output
+        self.level = level
+        self.block_size = block_size
+        self.callback = callback
+        self.executor = get_executor()
+        self.max_pending = 2 * process_count()
+        self.pending: deque[tuple[Future[bytes], int]] = deque()
+        self.buffer = bytearray()
+        self.consumed = 0
+        self.streams = 0
+        # seconds during which blocks were being compressed, not counting
+        # time spent waiting for more input
+        self.compress_time = 0.0
+        self.busy_since = 0.0
+        # blocks that are still being compressed; notified when none are
+        self.compressing = 0
+        self.idle = Condition()
+
+    def write(self, data: bytes):
+        self.buffer += data
+        while len(self.buffer) >= self.block_size:
+            self.submit(bytes(self.buffer[:self.block_size]))
+            del self.buffer[:self.block_size]
+
+    def submit(self, block: bytes):
+        while len(self.pending) >= self.max_pending:
+            self.collect()
+        with self.idle:
+            if not self.compressing:
+                self.busy_since = monotonic()
+            self.compressing += 1
+        future = self.executor.submit(compress, block, self.level)
+        future.add_done_callback(self.compressed)
+        self.pending.append((future, len(block)))
+
+    def compressed(self, _future: Future[bytes]):
+        with self.idle:
+            self.compressing -= 1
+            if not self.compressing:
+                self.compress_time += monotonic() - self.busy_since
+                self.idle.notify_all()
+
+    def collect(self):
+        future, length = self.pending.popleft()
+        self.output.write(future.result())
+        self.streams += 1
+        self.consumed += length
+        if self.callback is not None:
+            self.callback(self.consumed)
+
+    def flush(self):
+        if self.buffer or self.streams + len(self.pending) == 0:
+            self.submit(bytes(self.buffer))
+            self.buffer.clear()
+        while self.pending:
+            self.collect()
+        # done callbacks can run just after result() returns
+        with self.idle:
+            self.idle.wait_for(lambda: not self.compressing)
+
+    def cancel(self):
+        for future, _length in self.pending:
+            future.cancel()
+        self.pending.clear()
+
+
+class StreamCompressor:
+    """Compress data written to it into a single-stream bz2 file
+
+    Every bz2 decompressor reads this, but it is made on one CPU. bz2
+    releases the GIL while it works, so other threads carry on meanwhile.
+    """
+
+    def __init__(
+        self,
+        output: BinaryIO,
+        level: int = 9,
+        block_size: int = 900 * 1000,
+        callback: Callable[[int], None] | None = None
+    ):
+        self.output = output
+        self.block_size = block_size
+        self.callback = callback
+        self.compressor = BZ2Compressor(level)
+        self.consumed = 0
+        self.compress_time = 0.0
+
+    def write(self, data: bytes):
+        started = monotonic()
+        compressed = self.compressor.compress(data)
+        self.compress_time += monotonic() - started
+        self.output.write(compressed)
+        self.consumed += len(data)
+        if self.callback is not None:
+            self.callback(self.consumed)
+
+    def flush(self):
+        started = monotonic()
+        compressed = self.compressor.flush()
+        self.compress_time += monotonic() - started
+        self.output.write(compressed)
+
+    def cancel(self):
+        pass
+
+
+Compressor = ParallelCompressor | StreamCompressor
+
+
+def create_compressor(
+    output: BinaryIO,
+    callback: Callable[[int], None] | None = None
+) -> Compressor:
+    """Create the kind of compressor COMPRESS_MULTI_STREAM asks for"""
+    if app.config['COMPRESS_MULTI_STREAM']:
+        compressor_class: type[Compressor] = ParallelCompressor
+    else:
+        compressor_class = StreamCompressor
+    return compressor_class(
+        output,
+        level=app.config['COMPRESS_LEVEL'],
+        block_size=app.config['COMPRESS_BLOCK_SIZE'],
+        callback=callback
+    )
+
+
+TASK_NAME = 'Compressing to bz2'
+
+
+def send_progress(id: int, progress: float, size: int | None = None):
+    report(id, TASK_NAME, progress, size)
+
+
+def sample_savings(
+    mapfile: BinaryIO,
+    size: int,
+    level: int,
+    block_size: int
+) -> float | None:
+    """Estimate the fraction of space bz2 saves from blocks spread over a file
+
+    Returns None if the file is too small for sampling to be worthwhile.
+    """
+    samples = app.config['COMPRESS_SAMPLE_BLOCKS']
+    if samples < 2 or size <= samples * block_size:
+        return None
+
+    executor = get_executor()
+    futures = []
+    for i in range(samples):
+        mapfile.seek((size - block_size) * i // (samples - 1))
+        futures.append(
+            executor.submit(compress, mapfile.read(block_size), level)
+        )
+    mapfile.seek(0)
+    compressed = sum(len(future.result()) for future in futures)
+    return 1 - compressed / (samples * block_size)
+
+
+def compress_file(map: Map) -> tuple[bool, float]:
+    """Write map.filename_compressed unless bz2 would save too little space
+
+    The bz2 is written under a temporary name and renamed into place once
+    it is complete, so a failed or concurrent job never leaves a partial
+    file behind or removes a finished one. Returns whether the compressed
+    file was written and how many seconds the compressor spent on it.
+    """
+    level = app.config['COMPRESS_LEVEL']
+    block_size = app.config['COMPRESS_BLOCK_SIZE']
+    min_savings = app.config['COMPRESS_MIN_SAVINGS']
+    with NamedTemporaryFile(
+        dir=path.dirname(map.filename_compressed),
+        prefix=f'.compress-{map.id}-',
+        delete_on_close=False
+    ) as tempfile:
         with open(map.filename, 'rb') as mapfile:
             size = fstat(mapfile.fileno()).st_size
-            compressed = 0
-            while True:
-                data = mapfile.read(BLOCK_SIZE)
-                if not data:
-                    break
-                tempfile.write(compressor.compress(data))
-                compressed += len(data)
-                send_progress(map.id, compressed / size)
-        tempfile.write(compressor.flush())
+            savings = sample_savings(mapfile, size, level, block_size)
+            if savings is not None and savings < min_savings:
+                send_progress(map.id, 1.0)
+                return False, 0.0
+
+            compressor = create_compressor(
+                tempfile,
+                lambda consumed: send_progress(
+                    map.id,
+                    consumed / (size or 1),
+                    size
+                )
+            )
+            try:
+                while data := mapfile.read(compressor.block_size):
+                    compressor.write(data)
+                compressor.flush()
+            finally:
+                compressor.cancel()
+
+        if size and 1 - tempfile.tell() / size < min_savings:
+            send_progress(map.id, 1.0)
+            return False, compressor.compress_time
+
         tempfile.close()
-        try:
-            link(tempfile.name, map.filename_compressed)
-        except OSError as err:
-            if err.errno == EXDEV:
-                copyfile(tempfile.name, map.filename_compressed)
-            else:
-                raise
+        # a job for a map with the same content may have finished first;
+        # its file is identical, so replacing it is harmless
+        replace(tempfile.name, map.filename_compressed)
 
     send_progress(map.id, 1.0)
+    return True, compressor.compress_time
+
+
+class Priority(IntEnum):
+    Upload = 0
+    Backfill = 1
 
 
-def compression_thread(map_id: int):
-    with app.app_context():
-        map = db.session.get(Map, map_id)
-        if map is not None:
+# (priority, sequence, map id)
+jobs: PriorityQueue[tuple[int, int, int]] = PriorityQueue()
+sequence = count()
+queued: set[int] = set()
+queued_lock = Lock()
+workers: list[Thread] = []
+workers_lock = Lock()
+# set once start has run, even if COMPRESS_WORKERS is 0
+running = False
+
+
+def claim_id() -> str:
+    return f'{gethostname()}:{getpid()}'
+
+
+def unclaimed():
+    """Condition for jobs no live process is compressing"""
+    stale = UTCDateTime.utcnow() - timedelta(
+        seconds=app.config['COMPRESS_CLAIM_TIMEOUT']
+    )
+    return or_(
+        CompressJob.claimed_by == None,  # noqa
+        CompressJob.claimed_at < stale
+    )
+
+
+def claim(map_id: int) -> bool:
+    """Take a job for this process, unless another process has it
+
+    Claims older than COMPRESS_CLAIM_TIMEOUT are assumed to belong to a
+    process that died, and are taken over.
+    """
+    claimed = db.session.execute(
+        db.update(CompressJob).where(
+            CompressJob.map_id == map_id,
+            CompressJob.failed == False,  # noqa
+            unclaimed()
+        ).values(claimed_by=claim_id(), claimed_at=UTCDateTime.utcnow())
+    ).rowcount
+    db.session.commit()
+    return claimed == 1
+
+
+def compress_map(map_id: int):
+    if not claim(map_id):
+        return
+    map = db.session.get(Map, map_id)
+    if map is None:
+        return
+    try:
+        compressed, compress_time = compress_file(map)
+    except Exception as ex:
+        print(f'failed to compress map {map.name}:', file=stderr)
+        print_exception(ex, file=stderr)
+        fail(map.id, TASK_NAME)
+        map.compress_job.failed = True
+        map.compress_job.error = str(ex) or type(ex).__name__
+        map.compress_job.claimed_by = None
+        map.compress_job.claimed_at = None
+        db.session.commit()
+        return
+
+    map.compressed = compressed
+    map.compress_level = app.config['COMPRESS_LEVEL'] if compressed else 0
+    map.compress_time = compress_time
+    map.record_files()
+    metrics.observe('fastdl_compress_seconds', map.compress_time)
+    if compressed and map.size:
+        metrics.observe(
+            'fastdl_compress_ratio',
+            map.size_compressed / map.size
+        )
+    for duplicate in map.duplicates:
+        duplicate.compressed = map.compressed
+        duplicate.compress_level = map.compress_level
+        duplicate.compress_time = map.compress_time
+        duplicate.size_compressed = map.size_compressed
+    db.session.delete(map.compress_job)
+    db.session.add(map)
+    db.session.commit()
+    if map.compressed:
+        for name in [map.name, *(dup.name for dup in map.duplicates)]:
+            forget_missing(name)
+
+
+def compression_thread():
+    while True:
+        _priority, _sequence, map_id = jobs.get()
+        with app.app_context():
             try:
-                compress_file(map)
+                compress_map(map_id)
             except Exception as ex:
-                print(f'failed to compress map {map.name}:', file=stderr)
+                print(f'compression job for map {map_id} failed:', file=stderr)
                 print_exception(ex, file=stderr)
-                try:
-                    unlink(map.filename_compressed)
-                except FileNotFoundError:
-                    pass
-                return
-            map.compressed = True
-            db.session.add(map)
-            db.session.commit()
-
-
-def schedule_compress(map: Map):
-    thread = Thread(
-        target=compression_thread,
-        args=[map.id],
-        name=f'compress-{map.id}'
+        with queued_lock:
+            queued.discard(map_id)
+
+
+def enqueue(map_id: int, priority: int):
+    with queued_lock:
+        if map_id in queued:
+            return
+        queued.add(map_id)
+    jobs.put((priority, next(sequence), map_id))
+
+
+def requeue():
+    """Queue persisted jobs and uploaded maps that were never compressed
+
+    Every process does this, so a job can be queued in several of them;
+    claim makes sure only one runs it. Failed jobs are left alone.
+    """
+    for map in db.session.scalars(
+        db.select(Map).where(
+            Map.uploaded == True,  # noqa
+            Map.compressed == False,  # noqa
+            Map.compress_level == None,  # noqa
+            ~db.select(CompressJob).where(
+                CompressJob.map_id == Map.id
+            ).exists()
+        )
+    ):
+        db.session.add(CompressJob(map=map, priority=Priority.Backfill))
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # another process added the same jobs first
+        db.session.rollback()
+
+    for map_id, priority in db.session.execute(
+        db.select(CompressJob.map_id, CompressJob.priority).where(
+            CompressJob.failed == False,  # noqa
+            unclaimed()
+        )
+    ):
+        enqueue(map_id, priority)
+
+
+def poll_thread():
+    """Pick up jobs left by other processes, or by ones that died"""
+    while True:
+        sleep(app.config['COMPRESS_POLL_INTERVAL'])
+        with app.app_context():
+            try:
+                requeue()
+            except Exception as ex:
+                print('failed to poll compression jobs:', file=stderr)
+                print_exception(ex, file=stderr)
+
+
+def get_queue_state() -> QueueState:
+    waiting = db.session.scalar(
+        db.select(count_rows()).select_from(CompressJob).where(
+            CompressJob.failed == False,  # noqa
+            unclaimed()
+        )
+    )
+    claimed = db.session.execute(
+        db.select(Map.name, CompressJob.claimed_by)
+        .join(CompressJob.map)
+        .where(
+            CompressJob.failed == False,  # noqa
+            ~unclaimed()
+        )
     )
-    thread.start()
+    return QueueState(
+        {TASK_NAME: waiting},
+        [(TASK_NAME, name, process) for name, process in claimed]
+    )
+
+
+queue_states.append(get_queue_state)
+
+
+def start():
+    global running
+    with workers_lock:
+        if running:
+            return
+        running = True
+        for i in range(app.config['COMPRESS_WORKERS']):
+            workers.append(Thread(
+                target=compression_thread,
+                name=f'compress-{i}',
+                daemon=True
+            ))
+        if workers:
+            workers.append(Thread(
+                target=poll_thread,
+                name='compress-poll',
+                daemon=True
+            ))
+        for thread in workers:
+            thread.start()
+        requeue()
+
+
+@app.before_request
+def start_workers():
+    if not running:
+        start()
+
+
+def retry(job: CompressJob):
+    """Let a failed job run again"""
+    job.failed = False
+    job.error = None
+    job.claimed_by = None
+    job.claimed_at = None
+
+
+def schedule_compress(map: Map, priority: Priority = Priority.Upload):
+    if map.compress_job is None:
+        db.session.add(CompressJob(map=map, priority=priority))
+        db.session.commit()
+    elif map.compress_job.failed:
+        retry(map.compress_job)
+        db.session.commit()
+    start()
+    enqueue(map.id, priority)
@@ -1,5 +1,43 @@
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 OVERWRITE_BUILTIN = False
+WHITELIST_TTL = 60
+STEAM_INTERFACE_CACHE_TTL = 7 * 24 * 60 * 60
+STEAM_PROFILE_CACHE_TTL = 60 * 60
+STEAM_PROFILE_REFRESH_INTERVAL = 24 * 60 * 60
+DOWNLOAD_OFFLOAD = None
+DOWNLOAD_OFFLOAD_PREFIX = '/internal/maps/'
+DOWNLOAD_TRUSTED_PROXIES = []
+DOWNLOAD_FAST_PATH = True
+MISSING_CACHE_TTL = 60
+MISSING_CACHE_SIZE = 10000
+ACCESS_LOG_FLUSH_INTERVAL = 1.0
+ACCESS_LOG_BATCH_SIZE = 500
+ACCESS_LOG_QUEUE_SIZE = 10000
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+UPLOAD_EXPIRY = 24 * 60 * 60
+COMPRESS_WORKERS = 2
+COMPRESS_POLL_INTERVAL = 60
+COMPRESS_CLAIM_TIMEOUT = 60 * 60
+COMPRESS_PROCESSES = None
+COMPRESS_LEVEL = 9
+COMPRESS_BLOCK_SIZE = 900 * 1000
+COMPRESS_MULTI_STREAM = False
+COMPRESS_SAMPLE_BLOCKS = 4
+COMPRESS_MIN_SAVINGS = 0.1
+FTP_WORKERS = 8
+FTP_CONNECTIONS_PER_SERVER = 2
+FTP_KEEPALIVE_INTERVAL = 30
+FTP_IDLE_TIMEOUT = 300
+FTP_MAX_ATTEMPTS = 8
+FTP_RETRY_DELAY = 30
+FTP_RETRY_MAX_DELAY = 3600
+FTP_POLL_INTERVAL = 10
+FTP_CLAIM_TIMEOUT = 60 * 60
+METRICS_DIR = None
+METRICS_TOKEN = None
+METRICS_FLUSH_INTERVAL = 5
+PROFILE_SAMPLE_RATE = 0
+PROFILE_DIR = None
 BUILTIN = [
     'arena_badlands.bsp',
     'arena_granary.bsp',
@@ -0,0 +1,180 @@
+from collections import OrderedDict
+from ipaddress import IPv4Address
+from os import path
+from threading import Lock
+from time import monotonic
+from typing import NamedTuple
+from urllib.parse import quote
+import re
+
+from werkzeug.utils import send_file
+from werkzeug.wrappers import Response
+
+from . import app, db, whitelist
+from .models import Map
+
+
+GAME_USER_AGENT = 'Half-Life 2'
+REFERER = re.compile(r'hl2://([0-9.]+):([0-9]+)')
+
+
+class MapFile(NamedTuple):
+    map_id: int
+    map_name: str
+    filename: str
+    mimetype: str
+    download_name: str
+    size: int
+
+
+def compressed_file(map: Map) -> MapFile:
+    return MapFile(
+        map.id,
+        map.name,
+        map.filename_compressed,
+        'application/x-bzip2',
+        map.name + '.bz2',
+        map.size_compressed
+    )
+
+
+def map_file(map: Map) -> MapFile:
+    """Get the file that should be sent for a download of map"""
+    if map.compressed:
+        return compressed_file(map)
+    return MapFile(
+        map.id,
+        map.name,
+        map.filename,
+        'application/octet-stream',
+        map.name,
+        map.size
+    )
+
+
+# names recently requested that fastdl has no file for, and when to look
+# them up again; game clients probe for .bz2, .nav, .res and other files on
+# every join, so this keeps most of those probes away from the database
+missing: OrderedDict[str, float] = OrderedDict()
+missing_lock = Lock()
+
+
+def is_missing(name: str) -> bool:
+    with missing_lock:
+        expires = missing.get(name)
+        if expires is None:
+            return False
+        if expires < monotonic():
+            del missing[name]
+            return False
+        return True
+
+
+def remember_missing(name: str):
+    ttl = app.config['MISSING_CACHE_TTL']
+    if not ttl:
+        return
+    with missing_lock:
+        missing[name] = monotonic() + ttl
+        missing.move_to_end(name)
+        while len(missing) > app.config['MISSING_CACHE_SIZE']:
+            missing.popitem(last=False)
+
+
+def forget_missing(name: str):
+    """Serve map name, and its compressed copy, again straight away
+
+    Only this process's cache is cleared; other processes catch up within
+    MISSING_CACHE_TTL seconds.
+    """
+    with missing_lock:
+        missing.pop(name, None)
+        missing.pop(name + '.bz2', None)
+
+
+def find_map_file(name: str) -> MapFile | None:
+    """Get the file to send for a request for name
+
+    name can be a map's name, or a map's name followed by .bz2 to get its
+    compressed copy.
+    """
+    if is_missing(name):
+        return None
+
+    base_name = name.removesuffix('.bz2')
+    file = None
+    for map in db.session.scalars(
+        db.select(Map).where(Map.name.in_({name, base_name}))
+    ):
+        if not map.uploaded:
+            continue
+        if map.name == name:
+            file = map_file(map)
+            break
+        if map.compressed:
+            file = compressed_file(map)
+
+    if file is None:
+        remember_missing(name)
+    return file
+
+
+def classify_client(
+    user_agent: str | None,
+    referer: str | None
+) -> tuple[int | None, str]:
+    """Get the server a game client says it is downloading for
+
+    Returns the server's id, or None, along with the outcome to count the
+    request under in the download metrics.
+    """
+    if user_agent != GAME_USER_AGENT:
+        return None, 'bad_user_agent'
+    if referer is None:
+        return None, 'bad_referer'
+
+    match = REFERER.match(referer)
+    if not match:
+        return None, 'bad_referer'
+
+    try:
+        address = IPv4Address(match.group(1))
+    except ValueError:
+        return None, 'bad_referer'
+    server_id = whitelist.lookup(address, int(match.group(2)))
+    if server_id is None:
+        return None, 'unknown_server'
+    return server_id, 'served'
+
+
+def offload_headers(file: MapFile) -> list[tuple[str, str]]:
+    """Headers telling the front-end server to send file itself"""
+    if app.config['DOWNLOAD_OFFLOAD'] == 'x-accel-redirect':
+        return [(
+            'X-Accel-Redirect',
+            app.config['DOWNLOAD_OFFLOAD_PREFIX'] +
+            quote(path.relpath(file.filename, app.config['UPLOAD_DIR']))
+        )]
+    return [('X-Sendfile', file.filename)]
+
+
+def send_map_file(file: MapFile, environ: dict) -> Response:
+    if app.config['DOWNLOAD_OFFLOAD'] is None:
+        return send_file(
+            file.filename,
+            environ,
+            mimetype=file.mimetype,
+            as_attachment=True,
+            download_name=file.download_name,
+            conditional=True,
+            response_class=app.response_class
+        )
+
+    response = app.response_class(mimetype=file.mimetype)
+    response.headers.set(
+        'Content-Disposition',
+        'attachment',
+        filename=file.download_name
+    )
+    response.headers.extend(offload_headers(file))
+    return response
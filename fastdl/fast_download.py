@@ -0,0 +1,88 @@
+from time import perf_counter
+from typing import Callable, Iterable
+
+from werkzeug.exceptions import NotFound
+
+from . import access_log, app, metrics
+from .download import (
+    GAME_USER_AGENT, classify_client, find_map_file, send_map_file
+)
+
+
+WSGIApp = Callable[[dict, Callable], Iterable[bytes]]
+
+
+class GameDownloads:
+    """Serve map downloads to game clients without the rest of Flask
+
+    Game clients never log in, so their requests skip session decoding,
+    Flask-Login and view dispatch. Everything else goes to the Flask app,
+    including refused requests with a cookie, which may be from a user
+    who is logged in.
+    """
+
+    def __init__(self, wsgi_app: WSGIApp):
+        self.wsgi_app = wsgi_app
+        # the first request goes through Flask, so that its before_request
+        # hooks start the background workers
+        self.warm = False
+
+    def __call__(self, environ: dict, start_response: Callable):
+        path = environ.get('PATH_INFO', '')
+        name = path.removeprefix('/maps/')
+        if (
+            not self.warm or
+            not app.config['DOWNLOAD_FAST_PATH'] or
+            name == path or not name or '/' in name or
+            environ.get('REQUEST_METHOD') not in ('GET', 'HEAD') or
+            environ.get('HTTP_USER_AGENT') != GAME_USER_AGENT
+        ):
+            self.warm = True
+            return self.wsgi_app(environ, start_response)
+
+        with app.app_context():
+            response = self.respond(environ, name)
+        if response is None:
+            return self.wsgi_app(environ, start_response)
+        return response(environ, start_response)
+
+    def respond(self, environ: dict, name: str) -> WSGIApp | None:
+        started = perf_counter()
+        server_id, outcome = classify_client(
+            environ.get('HTTP_USER_AGENT'),
+            environ.get('HTTP_REFERER')
+        )
+        if server_id is None:
+            if 'HTTP_COOKIE' in environ:
+                return None
+            metrics.record_download(outcome, started)
+            return NotFound()
+
+        file = find_map_file(name)
+        if file is None:
+            metrics.record_download('not_found', started)
+            return NotFound()
+
+        # HEAD requests send no map, so they are neither logged nor counted
+        get = environ['REQUEST_METHOD'] == 'GET'
+        if get:
+            try:
+                access_log.record(
+                    environ.get('REMOTE_ADDR'),
+                    server_id,
+                    file.map_id,
+                    file.size
+                )
+            except ValueError:
+                metrics.record_download('not_found', started)
+                return NotFound()
+
+        response = send_map_file(file, environ)
+        metrics.record_download(
+            'served', started, file.map_name, server_id,
+            file.size if get else 0
+        )
+        return response
+
+
+app.wsgi_app = GameDownloads(app.wsgi_app)
@@ -1,4 +1,5 @@
 from ipaddress import IPv4Address
+import re
 
 from flask_wtf import FlaskForm
 from flask_wtf.file import FileField, FileRequired
@@ -7,12 +8,14 @@ from steam.steamid import SteamID
 from werkzeug.utils import secure_filename
 from wtforms.validators import InputRequired, NumberRange, ValidationError
 from wtforms.fields import (
-    Field, BooleanField, HiddenField, IntegerField, PasswordField, StringField
+    Field, BooleanField, HiddenField, IntegerField, PasswordField, SelectField,
+    StringField
 )
 from wtforms.widgets import TextInput, HiddenInput
 
 from . import app, db
-from .models import Map, User
+from .models import Map, PushMode, User
+from .profiles import cached_vanity
 from .util import string_to_steamid
 
 
@@ -43,7 +46,19 @@ class FileExtension:
         return True
 
 
+PROFILE_URL = re.compile(
+    r'(?:https?://)?steamcommunity\.com/profiles/(\d+)/?'
+)
+CUSTOM_URL = re.compile(r'(?:https?://)?steamcommunity\.com/id/([^/]+)/?')
+
+
 class SteamIDField(Field):
+    """A Steam ID, a profile URL or a custom URL
+
+    Custom URLs are resolved from the cache. On a miss, the refresher thread
+    looks them up and the user is asked to try again, so the request never
+    waits for Steam.
+    """
     widget = TextInput()
 
     def _value(self):
@@ -53,11 +68,27 @@ class SteamIDField(Field):
             return ''
 
     def process_formdata(self, valuelist):
-        if valuelist:
-            self.data = string_to_steamid(valuelist[0])
-
-        else:
-            self.data = SteamID()
+        self.data = SteamID()
+        if not valuelist or not valuelist[0].strip():
+            return
+
+        string = valuelist[0].strip()
+        match = PROFILE_URL.fullmatch(string)
+        if match:
+            string = match[1]
+        self.data = string_to_steamid(string, resolve_customurl=False)
+        if self.data.is_valid():
+            return
+
+        match = CUSTOM_URL.fullmatch(string)
+        cached, steamid = cached_vanity(match[1] if match else string)
+        if not cached:
+            raise ValueError(
+                'Looking up this custom URL on Steam. Try again in a moment.'
+            )
+        if steamid is None:
+            raise ValueError('No Steam user has this custom URL.')
+        self.data = SteamID(steamid)
 
 
 class UserIDField(Field):
@@ -86,8 +117,8 @@ class UserIDField(Field):
             self.data = None
 
 
-def unique_map_name(form, field):
-    name = secure_filename(field.data.filename or '')
+def check_map_name(filename: str | None) -> str:
+    name = secure_filename(filename or '')
     if not name:
         raise ValidationError('Invalid map name.')
 
@@ -102,7 +133,11 @@ def unique_map_name(form, field):
         raise ValidationError(
             map.name + ' already exists. To replace it, delete it first.')
 
-    field.data.filename = name
+    return name
+
+
+def unique_map_name(form, field):
+    field.data.filename = check_map_name(field.data.filename)
     return True
 
 
@@ -129,6 +164,32 @@ class UploadForm(FlaskForm):
     ])
 
 
+class ChunkedUploadForm(FlaskForm):
+    name = StringField('Map', validators=[InputRequired('Missing map name')])
+    size = IntegerField('Size', validators=[
+        NumberRange(min=4, message='This does not look like a valid BSP file.')
+    ])
+
+    resume: Map | None = None
+
+    def validate_name(self, field):
+        if field.data.split('.')[-1].lower() != 'bsp':
+            raise ValidationError('This does not look like a valid BSP file.')
+
+        name = secure_filename(field.data)
+        map = db.session.scalar(db.select(Map).where(Map.name == name))
+        if (
+            map is not None and
+            map.upload is not None and
+            map.upload.size == self.size.data
+        ):
+            # the same file was being uploaded before; carry on with it
+            self.resume = map
+            field.data = name
+        else:
+            field.data = check_map_name(field.data)
+
+
 class NewUserForm(FlaskForm):
     steamid = SteamIDField('Steam ID', validators=[
         InputRequired('Missing Steam ID'),
@@ -211,3 +272,24 @@ class EditServerForm(NewServerForm):
         validators=[required_if_enabled],
         default='/maps'
     )
+    ftp_push = SelectField(
+        'FTP Push Mode',
+        choices=[
+            (PushMode.Map, 'Whole map'),
+            (PushMode.Compressed, 'Compressed map (needs unpack agent)'),
+            (PushMode.Delta, 'Changed blocks only'),
+        ],
+        default=PushMode.Map
+    )
+    ftp_rate_limit = IntegerField(
+        'FTP Bandwidth Limit (KiB/s)',
+        validators=[NumberRange(min=0, message='Invalid bandwidth limit')],
+        default=0
+    )
+
+
+class SettingsForm(FlaskForm):
+    ftp_rate_limit = IntegerField(
+        'FTP Bandwidth Limit (KiB/s)',
+        validators=[NumberRange(min=0, message='Invalid bandwidth limit')]
+    )
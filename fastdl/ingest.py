@@ -0,0 +1,173 @@
+from hashlib import sha256
+from os import makedirs, unlink
+from tempfile import NamedTemporaryFile
+
+from flask import Request
+
+from . import app
+from .background import fail
+from .compress import TASK_NAME, Compressor, create_compressor, send_progress
+from .storage import blob_dir, install
+
+
+MAGIC_NUMBER = b'VBSP'
+
+
+class Ingest:
+    """Hash and compress a map in one pass as its data goes by
+
+    Uploads are fed through this as they are received or assembled, so the
+    map can be stored and served compressed straight away instead of being
+    read back from disk. If map_id is given, progress is reported under it
+    as the data reaches size bytes.
+    """
+
+    def __init__(self, map_id: int | None = None, size: int | None = None):
+        self.map_id = map_id
+        self.expected_size = size
+        makedirs(blob_dir(), exist_ok=True)
+        self.compressed_file = NamedTemporaryFile(
+            dir=blob_dir(),
+            prefix='.upload-',
+            suffix='.bz2',
+            delete=False
+        )
+        self.compressor: Compressor | None = create_compressor(
+            self.compressed_file
+        )
+        self.hash = sha256()
+        self.head = b''
+        self.size = 0
+
+    def update(self, data: bytes):
+        self.hash.update(data)
+        self.size += len(data)
+
+        if len(self.head) < len(MAGIC_NUMBER):
+            self.head += data[:len(MAGIC_NUMBER) - len(self.head)]
+            if not MAGIC_NUMBER.startswith(self.head):
+                # not a map; the upload will be rejected, so stop compressing
+                self.stop_compressing()
+
+        if self.compressor is not None:
+            self.compressor.write(data)
+            if self.map_id is not None and self.expected_size:
+                send_progress(
+                    self.map_id,
+                    min(self.size / self.expected_size, 0.99),
+                    self.expected_size
+                )
+
+    def stop_compressing(self):
+        if self.compressor is not None:
+            self.compressor.cancel()
+            self.compressor = None
+            if self.map_id is not None:
+                fail(self.map_id, TASK_NAME)
+
+    def finish(self, filename: str) -> tuple[str, int | None, float | None]:
+        """Move filename, which holds the data, into the blob store
+
+        Returns the digest, the bz2 level used (0 if compressing was not
+        worth it, None if the data was not compressed) and the seconds the
+        compressor spent compressing, not counting waits for more data.
+        """
+        level = None
+        compress_time = None
+        if self.compressor is not None:
+            self.compressor.flush()
+            compress_time = self.compressor.compress_time
+            self.compressor = None
+            savings = 1 - self.compressed_file.tell() / (self.size or 1)
+            if savings < app.config['COMPRESS_MIN_SAVINGS']:
+                level = 0
+            else:
+                level = app.config['COMPRESS_LEVEL']
+            if self.map_id is not None:
+                send_progress(self.map_id, 1.0, self.size)
+
+        self.compressed_file.close()
+        digest = self.hash.hexdigest()
+        install(filename, digest)
+        if level:
+            install(self.compressed_file.name, digest, '.bz2')
+        return digest, level, compress_time
+
+    def close(self):
+        self.stop_compressing()
+        self.compressed_file.close()
+        try:
+            unlink(self.compressed_file.name)
+        except FileNotFoundError:
+            pass
+
+
+class IngestStream:
+    """File Werkzeug writes an uploaded map to as it is received
+
+    The upload is spooled to a temporary file in the blob store, and passed
+    through an Ingest on the way.
+    """
+
+    def __init__(self):
+        makedirs(blob_dir(), exist_ok=True)
+        self.file = NamedTemporaryFile(
+            dir=blob_dir(),
+            prefix='.upload-',
+            delete=False
+        )
+        self.ingest = Ingest()
+
+    def write(self, data: bytes) -> int:
+        self.file.write(data)
+        self.ingest.update(data)
+        return len(data)
+
+    def read(self, size: int = -1) -> bytes:
+        return self.file.read(size)
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        return self.file.seek(offset, whence)
+
+    def tell(self) -> int:
+        return self.file.tell()
+
+    def flush(self):
+        self.file.flush()
+
+    def finish(self, map_id: int) -> tuple[str, int | None, float | None]:
+        """Move the upload into the blob store; see Ingest.finish"""
+        self.file.close()
+        # the map only exists once the upload has been received, so this is
+        # the first its compression can be reported
+        self.ingest.map_id = map_id
+        return self.ingest.finish(self.file.name)
+
+    def close(self):
+        self.file.close()
+        self.ingest.close()
+        try:
+            unlink(self.file.name)
+        except FileNotFoundError:
+            pass
+
+
+class IngestRequest(Request):
+    def _get_file_stream(
+        self,
+        total_content_length,
+        content_type,
+        filename=None,
+        content_length=None
+    ):
+        if self.endpoint == 'upload' and filename:
+            return IngestStream()
+        return super()._get_file_stream(
+            total_content_length,
+            content_type,
+            filename,
+            content_length
+        )
+
+
+app.request_class = IngestRequest
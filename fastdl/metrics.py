@@ -0,0 +1,280 @@
+from atexit import register
+from glob import glob
+from hmac import compare_digest
+from json import JSONDecodeError, dump, load
+from math import inf
+from os import getpid, kill, makedirs, path, replace
+from sys import stderr
+from threading import Event, Lock, Thread
+from time import perf_counter, time
+from traceback import print_exception
+from typing import Callable
+
+from flask import abort, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from . import app
+
+
+# name: (type, help, histogram buckets)
+METRICS: dict[str, tuple[str, str, tuple[float, ...]]] = {
+    'fastdl_downloads_total': (
+        'counter', 'Map download requests by outcome', ()
+    ),
+    'fastdl_download_seconds': (
+        'histogram', 'Time to handle a map download request',
+        (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+    ),
+    'fastdl_map_bytes_served_total': (
+        'counter', 'Bytes of map files sent, by map', ()
+    ),
+    'fastdl_server_bytes_served_total': (
+        'counter', 'Bytes of map files sent to game clients, by server', ()
+    ),
+    'fastdl_compress_seconds': (
+        'histogram', 'Time to compress a map',
+        (1.0, 2.5, 5.0, 10.0, 25.0, 50.0, 100.0, 250.0)
+    ),
+    'fastdl_compress_ratio': (
+        'histogram', 'Compressed size of a map over its size',
+        (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0)
+    ),
+    'fastdl_ftp_bytes_total': (
+        'counter', 'Bytes pushed to game servers over FTP, by server', ()
+    ),
+    'fastdl_ftp_seconds_total': (
+        'counter', 'Time spent pushing to game servers, by server', ()
+    ),
+    'fastdl_ftp_failures_total': (
+        'counter', 'Failed FTP jobs, by server', ()
+    ),
+    'fastdl_ftp_queue_depth': (
+        'gauge', 'FTP jobs waiting, by server', ()
+    ),
+    'fastdl_db_query_seconds': (
+        'histogram', 'Time spent executing database statements',
+        (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25)
+    ),
+}
+
+Labels = tuple[tuple[str, str], ...]
+Values = dict[tuple[str, Labels], float]
+
+# counters and histogram buckets only ever go up, so the values of every
+# process can be added up; gauges only count for processes still running
+counters: Values = {}
+gauges: Values = {}
+lock = Lock()
+# functions that set gauges, called before values are written or exported
+collectors: list[Callable[[], None]] = []
+
+started = time()
+stopping = Event()
+thread: Thread | None = None
+thread_lock = Lock()
+
+
+def labels_key(labels: dict[str, object]) -> Labels:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def inc(name: str, amount: float = 1, **labels):
+    key = (name, labels_key(labels))
+    with lock:
+        counters[key] = counters.get(key, 0) + amount
+    ensure_started()
+
+
+def observe(name: str, value: float, **labels):
+    base = labels_key(labels)
+    with lock:
+        for bound in METRICS[name][2] + (inf,):
+            if value <= bound:
+                key = (name + '_bucket', base + (('le', format_le(bound)),))
+                counters[key] = counters.get(key, 0) + 1
+        for suffix, amount in (('_sum', value), ('_count', 1)):
+            key = (name + suffix, base)
+            counters[key] = counters.get(key, 0) + amount
+    ensure_started()
+
+
+def set_gauge(name: str, value: float, **labels):
+    with lock:
+        gauges[(name, labels_key(labels))] = value
+
+
+def record_download(
+    outcome: str,
+    started: float,
+    map_name: str | None = None,
+    server_id: int | None = None,
+    size: int = 0
+):
+    """Count a map download request that began at perf_counter() started"""
+    inc('fastdl_downloads_total', outcome=outcome)
+    observe('fastdl_download_seconds', perf_counter() - started)
+    if map_name is not None:
+        inc('fastdl_map_bytes_served_total', size, map=map_name)
+    if server_id is not None:
+        inc('fastdl_server_bytes_served_total', size, server=server_id)
+
+
+def format_le(bound: float) -> str:
+    return '+Inf' if bound == inf else repr(bound)
+
+
+def snapshot() -> tuple[Values, Values]:
+    for collect in collectors:
+        try:
+            collect()
+        except Exception as ex:
+            print_exception(ex, file=stderr)
+    with lock:
+        return dict(counters), dict(gauges)
+
+
+# per-process files in METRICS_DIR, so that every worker's values can be
+# exported by whichever one is scraped
+
+def process_file() -> str:
+    return path.join(
+        app.config['METRICS_DIR'],
+        f'{getpid()}-{started:.0f}.json'
+    )
+
+
+def is_running(pid: int) -> bool:
+    try:
+        kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def write_values():
+    counters, gauges = snapshot()
+    filename = process_file()
+    makedirs(path.dirname(filename), exist_ok=True)
+    with open(filename + '.tmp', 'w') as file:
+        dump({
+            'counters': [[*key, value] for key, value in counters.items()],
+            'gauges': [[*key, value] for key, value in gauges.items()],
+        }, file)
+    replace(filename + '.tmp', filename)
+
+
+def read_values() -> tuple[Values, Values]:
+    """Add up the values of every process"""
+    counters, gauges = snapshot()
+    if app.config['METRICS_DIR'] is None:
+        return counters, gauges
+
+    own = path.basename(process_file())
+    for filename in glob(path.join(app.config['METRICS_DIR'], '*.json')):
+        name = path.basename(filename)
+        if name == own:
+            continue
+        try:
+            with open(filename) as file:
+                values = load(file)
+        except (OSError, JSONDecodeError):
+            continue
+        for metric, labels, value in values['counters']:
+            key = (metric, tuple(map(tuple, labels)))
+            counters[key] = counters.get(key, 0) + value
+        if is_running(int(name.split('-')[0])):
+            for metric, labels, value in values['gauges']:
+                key = (metric, tuple(map(tuple, labels)))
+                gauges[key] = gauges.get(key, 0) + value
+    return counters, gauges
+
+
+def writer_thread():
+    while not stopping.wait(app.config['METRICS_FLUSH_INTERVAL']):
+        try:
+            write_values()
+        except Exception as ex:
+            print('failed to write metrics:', file=stderr)
+            print_exception(ex, file=stderr)
+
+
+def ensure_started():
+    global thread
+    if thread is None and app.config['METRICS_DIR'] is not None:
+        with thread_lock:
+            if thread is None:
+                thread = Thread(
+                    target=writer_thread,
+                    name='metrics',
+                    daemon=True
+                )
+                thread.start()
+
+
+@register
+def shutdown():
+    stopping.set()
+    if thread is not None:
+        thread.join()
+        write_values()
+
+
+def format_value(value: float) -> str:
+    """Exact text for a sample; byte counts would lose digits to :g"""
+    if isinstance(value, int) or value.is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def render(counters: Values, gauges: Values) -> str:
+    lines = []
+    for name, (type, help, _buckets) in METRICS.items():
+        values = gauges if type == 'gauge' else counters
+        if type == 'histogram':
+            names = (name + '_bucket', name + '_sum', name + '_count')
+        else:
+            names = (name,)
+        samples = sorted(
+            (key, value) for key, value in values.items() if key[0] in names
+        )
+        lines.append(f'# HELP {name} {help}')
+        lines.append(f'# TYPE {name} {type}')
+        for (metric, labels), value in samples:
+            if labels:
+                label_text = ','.join(
+                    '{}="{}"'.format(
+                        label,
+                        value.replace('\\', '\\\\').replace('"', '\\"')
+                    )
+                    for label, value in labels
+                )
+                metric += '{' + label_text + '}'
+            lines.append(f'{metric} {format_value(value)}')
+    return '\n'.join(lines) + '\n'
+
+
+@app.route('/metrics')
+def export_metrics():
+    token = app.config['METRICS_TOKEN']
+    if token is not None:
+        given = request.headers.get('Authorization', '')
+        if not compare_digest(given.encode(), f'Bearer {token}'.encode()):
+            abort(401)
+    return app.response_class(
+        render(*read_values()),
+        mimetype='text/plain; version=0.0.4'
+    )
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_query_timer(conn, cursor, statement, parameters, context, many):
+    conn.info.setdefault('query_started', []).append(perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def stop_query_timer(conn, cursor, statement, parameters, context, many):
+    started = conn.info['query_started'].pop()
+    observe('fastdl_db_query_seconds', perf_counter() - started)
@@ -1,4 +1,5 @@
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
+from enum import StrEnum
 from ipaddress import IPv4Address
 from os import path, stat, unlink
 from typing import Optional
@@ -7,9 +8,9 @@ from flask import url_for
 from flask_login import AnonymousUserMixin
 from steam.steamid import SteamID
 from sqlalchemy.sql import sqltypes
-from sqlalchemy.sql.functions import count
 
-from . import app, db, login_manager, steam_api
+from . import app, db, login_manager
+from .storage import blob_path, hash_file, partial_path
 
 
 class UTCDateTime(sqltypes.TypeDecorator):
@@ -62,17 +63,6 @@ class User(db.Model):
     def steamid(self):
         return SteamID(self.steamid64)
 
-    def refresh_name(self):
-        self.name = steam_api.ISteamUser.GetPlayerSummaries(  # type: ignore
-            steamids=str(self.steamid64)
-        ).get(
-            'response',
-            {}
-        ).get(
-            'players',
-            [{}]
-        )[0].get('personaname')
-
 
 @login_manager.user_loader
 def load_user(id):
@@ -91,6 +81,16 @@ class IPMixin:
         self._ip = address.packed
 
 
+class PushMode(StrEnum):
+    """What is sent to a server over FTP"""
+    # the map itself
+    Map = 'map'
+    # the bz2, for agent/unpack.py on the server to extract
+    Compressed = 'compressed'
+    # the map, starting from the first block that changed since last time
+    Delta = 'delta'
+
+
 class Server(IPMixin, db.Model):
     id: int = db.Column(db.Integer, primary_key=True, autoincrement=True)
     _ip: bytes = db.Column('ip', db.BINARY(4), nullable=False)
@@ -106,6 +106,13 @@ class Server(IPMixin, db.Model):
     ftp_user: str = db.Column(db.String(128), nullable=False, default='')
     ftp_pass: str = db.Column(db.String(128), nullable=False, default='')
     ftp_dir: str = db.Column(db.String(128), nullable=False, default='')
+    ftp_push: str = db.Column(
+        db.String(16),
+        nullable=False,
+        default=PushMode.Map
+    )
+    # KiB/s, or 0 for no limit
+    ftp_rate_limit: int = db.Column(db.Integer, nullable=False, default=0)
 
     def __repr__(self):
         return '<{} {}:{}>'.format(
@@ -116,9 +123,7 @@ class Server(IPMixin, db.Model):
 
     @property
     def maps_served(self) -> int:
-        return db.session.scalar(
-            db.select(count(Access.id)).where(Access.server == self)
-        ) or 0
+        return self.stats.served if self.stats else 0
 
     @classmethod
     def get_by_address(
@@ -132,20 +137,14 @@ class Server(IPMixin, db.Model):
             address = IPv4Address(address)
         return db.session.scalar(
             db.select(cls).where(
-                cls._ip == address.packed and cls.port == port
+                cls._ip == address.packed,
+                cls.port == port
             )
         )
 
     @property
     def bandwidth(self) -> int:
-        sizes = {}
-        total = 0
-        for access in self.accesses:
-            if access.map.id not in sizes:
-                sizes[access.map.id] = access.map.size
-            total += sizes[access.map.id]
-
-        return total
+        return self.stats.bytes_served if self.stats else 0
 
     @property
     def display(self):
@@ -162,9 +161,23 @@ class Map(db.Model):
     name = db.Column(db.String(128), unique=True, nullable=False)
     uploaded = db.Column(db.Boolean, nullable=False)
     compressed = db.Column(db.Boolean, nullable=False, default=False)
+    # bz2 level used, or 0 if compressing was not worth it
+    compress_level = db.Column(db.Integer, nullable=True)
+    compress_time = db.Column(db.Float, nullable=True)
+    # sha256 of the content; None for maps stored under their own name
+    digest = db.Column(db.String(64), nullable=True, index=True)
+    # what the files looked like when last recorded, so that pages don't
+    # need to stat them; see record_files and `flask maps rescan`
+    size = db.Column(db.BigInteger, nullable=False, default=0)
+    size_compressed = db.Column(db.BigInteger, nullable=False, default=0)
+    mtime = db.Column(db.Float, nullable=True)
+    # sha256 of the content, including for maps stored under their own name
+    content_hash = db.Column(db.String(64), nullable=True)
 
     @property
     def filename(self):
+        if self.digest is not None:
+            return blob_path(self.digest)
         return path.join(app.config['UPLOAD_DIR'], self.name)
 
     @property
@@ -175,39 +188,80 @@ class Map(db.Model):
     def url(self):
         return url_for('download_map', name=self.name)
 
-    @property
-    def size(self):
-        try:
-            return stat(self.filename).st_size
-        except IOError:
-            return 0
+    def record_files(self):
+        """Store the size, mtime and hash of the map's files
 
-    @property
-    def size_compressed(self):
-        if not self.compressed:
-            return 0
-        try:
-            return stat(self.filename_compressed).st_size
-        except IOError:
-            return 0
+        Maps in the blob store are named by their hash, so only maps stored
+        under their own name are read to hash them.
+        """
+        self.record_size()
+        self.content_hash = self.digest or hash_file(self.filename)
+
+    def record_size(self):
+        info = stat(self.filename)
+        self.size = info.st_size
+        self.mtime = info.st_mtime
+        self.record_compressed_file()
+
+    def record_compressed_file(self):
+        if self.compressed:
+            self.size_compressed = path.getsize(self.filename_compressed)
+        else:
+            self.size_compressed = 0
+
+    @classmethod
+    def record_unscanned(cls) -> int:
+        """Record the sizes of maps added before they were kept
+
+        This only stats the files. Maps in the blob store take their hash
+        from their name; other maps are hashed when they are first pushed,
+        or by `flask maps rescan`. Returns how many maps were recorded.
+        """
+        recorded = 0
+        for map in db.session.scalars(db.select(cls).where(
+            cls.uploaded == True,  # noqa
+            cls.mtime == None  # noqa
+        )):
+            try:
+                map.record_size()
+            except OSError:
+                # missing; `flask maps prune` deals with those
+                continue
+            if map.content_hash is None:
+                map.content_hash = map.digest
+            recorded += 1
+        db.session.commit()
+        return recorded
 
     @property
-    def bandwidth(self):
-        return self.size * self.times_served
+    def bandwidth(self) -> int:
+        return self.stats.bytes_served if self.stats else 0
 
     @property
     def times_served(self) -> int:
-        return db.session.scalar(
-            db.select(count(Access.id)).where(Access.map == self)
-        ) or 0
+        return self.stats.served if self.stats else 0
 
     def __repr__(self):
         return '<{} {}>'.format(self.__class__.__name__, self.name)
 
+    @property
+    def duplicates(self) -> list['Map']:
+        """Other maps with the same content"""
+        if self.digest is None:
+            return []
+        return list(db.session.scalars(
+            db.select(Map).where(Map.digest == self.digest, Map.id != self.id)
+        ))
+
     def delete(self):
+        if self.duplicates:
+            return
         unlink(self.filename)
-        if self.compressed:
+        try:
             unlink(self.filename_compressed)
+        except FileNotFoundError:
+            if self.compressed:
+                raise
 
 
 class Access(IPMixin, db.Model):
@@ -239,3 +293,232 @@ class Access(IPMixin, db.Model):
         nullable=False,
         default=UTCDateTime.utcnow
     )
+
+
+class StatsMixin:
+    served = db.Column(db.Integer, nullable=False, default=0)
+    bytes_served = db.Column(db.BigInteger, nullable=False, default=0)
+    last_access = db.Column(UTCDateTime, nullable=True)
+
+
+class MapStats(StatsMixin, db.Model):
+    map_id = db.Column(
+        db.Integer,
+        db.ForeignKey(Map.id),
+        primary_key=True
+    )
+    map = db.relationship(
+        Map,
+        backref=db.backref(
+            'stats',
+            lazy='joined',
+            uselist=False,
+            cascade='all,delete'
+        )
+    )
+
+
+class ServerStats(StatsMixin, db.Model):
+    server_id = db.Column(
+        db.Integer,
+        db.ForeignKey(Server.id),
+        primary_key=True
+    )
+    server = db.relationship(
+        Server,
+        backref=db.backref(
+            'stats',
+            lazy='joined',
+            uselist=False,
+            cascade='all,delete'
+        )
+    )
+
+
+class CompressJob(db.Model):
+    map_id = db.Column(
+        db.Integer,
+        db.ForeignKey(Map.id),
+        primary_key=True
+    )
+    map = db.relationship(
+        Map,
+        backref=db.backref(
+            'compress_job',
+            uselist=False,
+            cascade='all,delete'
+        )
+    )
+
+    priority = db.Column(db.Integer, nullable=False)
+    queued_time = db.Column(
+        UTCDateTime,
+        nullable=False,
+        default=UTCDateTime.utcnow
+    )
+    # the process compressing the map, so that no other process starts it
+    claimed_by = db.Column(db.String(128), nullable=True)
+    claimed_at = db.Column(UTCDateTime, nullable=True)
+    # compressing failed; the job is kept, and skipped, until it is retried
+    failed = db.Column(db.Boolean, nullable=False, default=False)
+    error = db.Column(db.Text, nullable=True)
+
+
+class Upload(db.Model):
+    """A map being uploaded in chunks"""
+    map_id = db.Column(
+        db.Integer,
+        db.ForeignKey(Map.id),
+        primary_key=True
+    )
+    map = db.relationship(
+        Map,
+        backref=db.backref('upload', uselist=False, cascade='all,delete')
+    )
+
+    size = db.Column(db.BigInteger, nullable=False)
+    chunk_size = db.Column(db.Integer, nullable=False)
+    started = db.Column(
+        UTCDateTime,
+        nullable=False,
+        default=UTCDateTime.utcnow
+    )
+
+    @property
+    def filename(self):
+        return partial_path(self.map_id)
+
+    @property
+    def chunk_count(self) -> int:
+        return -(-self.size // self.chunk_size)
+
+    def chunk_length(self, index: int) -> int:
+        return min(self.chunk_size, self.size - index * self.chunk_size)
+
+    def discard(self):
+        """Remove the partly assembled file"""
+        try:
+            unlink(self.filename)
+        except FileNotFoundError:
+            pass
+
+    @classmethod
+    def expire(cls) -> list[str]:
+        """Remove uploads started more than UPLOAD_EXPIRY seconds ago
+
+        Their maps are deleted too, so the names can be used again.
+        Returns the names of the maps.
+        """
+        cutoff = UTCDateTime.utcnow() - timedelta(
+            seconds=app.config['UPLOAD_EXPIRY']
+        )
+        names = []
+        for upload in db.session.scalars(
+            db.select(cls).where(cls.started < cutoff)
+        ):
+            upload.discard()
+            names.append(upload.map.name)
+            db.session.delete(upload.map)
+        db.session.commit()
+        return names
+
+
+class UploadChunk(db.Model):
+    map_id = db.Column(
+        db.Integer,
+        db.ForeignKey(Upload.map_id),
+        primary_key=True
+    )
+    upload = db.relationship(
+        Upload,
+        backref=db.backref('chunks', lazy=True, cascade='all,delete')
+    )
+    index = db.Column(db.Integer, primary_key=True)
+    sha256 = db.Column(db.String(64), nullable=True)
+
+
+class ServerFile(db.Model):
+    """A map as it was last pushed to a server over FTP"""
+    server_id = db.Column(
+        db.Integer,
+        db.ForeignKey(Server.id),
+        primary_key=True
+    )
+    server = db.relationship(
+        Server,
+        backref=db.backref('files', lazy=True, cascade='all,delete')
+    )
+    name = db.Column(db.String(128), primary_key=True)
+
+    # size and sha256 of the map, even if the bz2 was sent
+    size = db.Column(db.BigInteger, nullable=False)
+    digest = db.Column(db.String(64), nullable=False)
+    compressed = db.Column(db.Boolean, nullable=False)
+    # concatenated sha256 of each block, for pushing only what changed
+    blocks = db.Column(db.LargeBinary, nullable=True)
+    pushed = db.Column(
+        UTCDateTime,
+        nullable=False,
+        default=UTCDateTime.utcnow
+    )
+
+
+class DistributionState(StrEnum):
+    Pending = 'pending'
+    Done = 'done'
+    # gave up after FTP_MAX_ATTEMPTS
+    Failed = 'failed'
+
+
+class Distribution(db.Model):
+    """Whether a map has been pushed to a server over FTP"""
+    map_id = db.Column(
+        db.Integer,
+        db.ForeignKey(Map.id),
+        primary_key=True
+    )
+    map = db.relationship(
+        Map,
+        backref=db.backref('distributions', lazy=True, cascade='all,delete')
+    )
+    server_id = db.Column(
+        db.Integer,
+        db.ForeignKey(Server.id),
+        primary_key=True
+    )
+    server = db.relationship(
+        Server,
+        backref=db.backref('distributions', lazy=True, cascade='all,delete')
+    )
+
+    state = db.Column(
+        db.String(16),
+        nullable=False,
+        default=DistributionState.Pending
+    )
+    priority = db.Column(db.Integer, nullable=False, default=0)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt = db.Column(
+        UTCDateTime,
+        nullable=False,
+        default=UTCDateTime.utcnow
+    )
+    last_error = db.Column(db.Text, nullable=True)
+    # the process pushing it, so several processes never push it at once
+    claimed_by = db.Column(db.String(128), nullable=True)
+    claimed_at = db.Column(UTCDateTime, nullable=True)
+
+
+class Setting(db.Model):
+    """A setting changed at runtime from the admin interface"""
+    name = db.Column(db.String(64), primary_key=True)
+    value = db.Column(db.Text, nullable=False)
+
+    @classmethod
+    def get_int(cls, name: str, default: int = 0) -> int:
+        setting = db.session.get(cls, name)
+        return int(setting.value) if setting is not None else default
+
+    @classmethod
+    def set(cls, name: str, value):
+        db.session.merge(cls(name=name, value=str(value)))
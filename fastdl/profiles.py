@@ -0,0 +1,184 @@
+from sys import stderr
+from threading import Event, Lock, Thread
+from time import monotonic
+from traceback import print_exception
+
+from . import app, db, steam_api
+from .models import User
+
+
+# GetPlayerSummaries takes at most this many steamids per call
+BATCH_SIZE = 100
+# expired entries are dropped once a cache grows past this
+PRUNE_SIZE = 1000
+
+# steamid64: (persona name or None if there is no such user, expiry)
+names: dict[int, tuple[str | None, float]] = {}
+# vanity URL: (steamid64 or None if there is no such user, expiry)
+vanity_ids: dict[str, tuple[int | None, float]] = {}
+# looked up by the refresher thread for the users page, which can't wait
+pending_ids: set[int] = set()
+pending_vanities: set[str] = set()
+lock = Lock()
+
+wake = Event()
+thread: Thread | None = None
+thread_lock = Lock()
+
+
+def store(cache: dict, key, value):
+    now = monotonic()
+    with lock:
+        if len(cache) > PRUNE_SIZE:
+            expired = [old for old, entry in cache.items() if entry[1] < now]
+            for old in expired:
+                del cache[old]
+        cache[key] = (value, now + app.config['STEAM_PROFILE_CACHE_TTL'])
+
+
+def lookup(cache: dict, key):
+    """Get (True, value) from cache, or (False, None) if it isn't fresh"""
+    with lock:
+        entry = cache.get(key)
+    if entry is None or entry[1] < monotonic():
+        return False, None
+    return True, entry[0]
+
+
+def fetch_names(steamids: list[int]) -> dict[int, str]:
+    """Get the persona names of steamids from Steam, in batches
+
+    Users Steam doesn't know are left out, and cached as unknown.
+    """
+    found = {}
+    for start in range(0, len(steamids), BATCH_SIZE):
+        batch = steamids[start:start + BATCH_SIZE]
+        players = steam_api.ISteamUser.GetPlayerSummaries(
+            steamids=','.join(map(str, batch))
+        ).get('response', {}).get('players', [])
+        for player in players:
+            steamid = int(player['steamid'])
+            found[steamid] = player['personaname']
+            store(names, steamid, player['personaname'])
+        for steamid in batch:
+            if steamid not in found:
+                store(names, steamid, None)
+    return found
+
+
+def cached_name(steamid: int) -> tuple[bool, str | None]:
+    """Get (True, name) if steamid's name is cached, None if it is unknown
+
+    Otherwise returns (False, None) and has the refresher thread look it up.
+    """
+    cached, name = lookup(names, steamid)
+    if not cached:
+        request_lookup(steamid=steamid)
+    return cached, name
+
+
+def cached_vanity(vanity: str) -> tuple[bool, int | None]:
+    """Like cached_name, for the steamid64 a custom URL belongs to"""
+    cached, steamid = lookup(vanity_ids, vanity)
+    if not cached:
+        request_lookup(vanity=vanity)
+    return cached, steamid
+
+
+def get_name(steamid: int) -> str | None:
+    """Get the persona name of steamid, asking Steam if it isn't cached"""
+    cached, name = lookup(names, steamid)
+    if cached:
+        return name
+    return fetch_names([steamid]).get(steamid)
+
+
+def resolve_vanity(vanity: str) -> int | None:
+    cached, steamid = lookup(vanity_ids, vanity)
+    if cached:
+        return steamid
+    response = steam_api.ISteamUser.ResolveVanityURL(
+        vanityurl=vanity
+    ).get('response', {})
+    steamid = int(response['steamid']) if 'steamid' in response else None
+    store(vanity_ids, vanity, steamid)
+    return steamid
+
+
+def refresh_users() -> int:
+    """Update the names of all users from Steam
+
+    Returns how many names changed.
+    """
+    steamids = list(db.session.scalars(db.select(User.steamid64)))
+    # don't keep a transaction open while waiting for Steam
+    db.session.rollback()
+
+    changed = 0
+    for steamid, name in fetch_names(steamids).items():
+        changed += db.session.execute(
+            db.update(User).where(
+                User.steamid64 == steamid,
+                User.name != name
+            ).values(name=name)
+        ).rowcount
+    db.session.commit()
+    return changed
+
+
+def resolve_pending():
+    """Look up what the users page asked for, filling the caches"""
+    with lock:
+        vanities = list(pending_vanities)
+        pending_vanities.clear()
+        steamids = list(pending_ids)
+        pending_ids.clear()
+    for vanity in vanities:
+        steamid = resolve_vanity(vanity)
+        if steamid is not None:
+            # the user is likely to be added next
+            steamids.append(steamid)
+    if steamids:
+        fetch_names(steamids)
+
+
+def refresher_thread():
+    while True:
+        woken = wake.wait(app.config['STEAM_PROFILE_REFRESH_INTERVAL'])
+        wake.clear()
+        with app.app_context():
+            try:
+                resolve_pending()
+                if not woken:
+                    refresh_users()
+            except Exception as ex:
+                print('failed to refresh user names:', file=stderr)
+                print_exception(ex, file=stderr)
+
+
+def request_lookup(steamid: int | None = None, vanity: str | None = None):
+    """Have the refresher thread look up a steamid or custom URL soon"""
+    with lock:
+        if steamid is not None:
+            pending_ids.add(steamid)
+        if vanity is not None:
+            pending_vanities.add(vanity)
+    wake.set()
+
+
+def start():
+    global thread
+    with thread_lock:
+        if thread is None:
+            thread = Thread(
+                target=refresher_thread,
+                name='profile-refresh',
+                daemon=True
+            )
+            thread.start()
+
+
+@app.before_request
+def start_refresher():
+    if thread is None:
+        start()
@@ -0,0 +1,210 @@
+from cProfile import Profile
+from functools import wraps
+from glob import glob
+from json import JSONDecodeError, dump, load
+import os
+from os import getpid, makedirs, path
+from random import randrange
+from sys import stderr
+from threading import Lock, local
+from time import perf_counter, time_ns
+
+from flask import before_render_template, request, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from . import app
+
+
+class RequestProfile:
+    """What one sampled request spent its time on"""
+
+    def __init__(self):
+        self.started = perf_counter()
+        self.queries = 0
+        self.query_time = 0.0
+        self.query_started: list[float] = []
+        self.stats = 0
+        self.render_time = 0.0
+        self.render_started: list[float] = []
+        self.profiler: Profile | None = None
+
+
+# the profile of the request the current thread is handling, if sampled
+current = local()
+
+
+def current_profile() -> RequestProfile | None:
+    return getattr(current, 'profile', None)
+
+
+original_stat = os.stat
+
+
+@wraps(original_stat)
+def counting_stat(*args, **kwargs):
+    profile = current_profile()
+    if profile is not None:
+        profile.stats += 1
+    return original_stat(*args, **kwargs)
+
+
+# os.path.getsize, isfile and friends, and send_file, all go through
+# os.stat, so it is wrapped while any sampled request is running, and put
+# back as soon as none is
+stat_lock = Lock()
+stat_users = 0
+
+
+def wrap_stat():
+    global stat_users
+    with stat_lock:
+        if not stat_users:
+            os.stat = counting_stat
+        stat_users += 1
+
+
+def unwrap_stat():
+    global stat_users
+    with stat_lock:
+        stat_users -= 1
+        if not stat_users:
+            os.stat = original_stat
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_query(conn, cursor, statement, parameters, context, many):
+    profile = current_profile()
+    if profile is not None:
+        profile.query_started.append(perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def finish_query(conn, cursor, statement, parameters, context, many):
+    profile = current_profile()
+    if profile is not None and profile.query_started:
+        profile.queries += 1
+        profile.query_time += perf_counter() - profile.query_started.pop()
+
+
+@before_render_template.connect_via(app)
+def start_render(sender, template, context, **extra):
+    profile = current_profile()
+    if profile is not None:
+        profile.render_started.append(perf_counter())
+
+
+@template_rendered.connect_via(app)
+def finish_render(sender, template, context, **extra):
+    profile = current_profile()
+    if profile is not None and profile.render_started:
+        started = profile.render_started.pop()
+        # a template rendered from inside another is already counted
+        if not profile.render_started:
+            profile.render_time += perf_counter() - started
+
+
+@app.before_request
+def start_profile():
+    rate = app.config['PROFILE_SAMPLE_RATE']
+    if not rate or randrange(rate):
+        return
+    # websockets stay open for as long as the page does
+    if request.headers.get('Upgrade', '').lower() == 'websocket':
+        return
+
+    profile = current.profile = RequestProfile()
+    wrap_stat()
+    if app.config['PROFILE_DIR'] is not None:
+        profiler = Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # only one thread can run cProfile at a time
+            return
+        profile.profiler = profiler
+
+
+def finish_profile(response=None):
+    profile = current_profile()
+    if profile is None:
+        return
+    current.profile = None
+    unwrap_stat()
+    if profile.profiler is not None:
+        profile.profiler.disable()
+
+    summary = {
+        'endpoint': request.endpoint or 'unmatched',
+        'method': request.method,
+        'path': request.path,
+        'time': perf_counter() - profile.started,
+        'queries': profile.queries,
+        'query_time': profile.query_time,
+        'stats': profile.stats,
+        'render_time': profile.render_time,
+    }
+    print(
+        'profile {method} {path} ({endpoint}): {time_ms:.1f} ms, '
+        '{queries} queries in {query_ms:.1f} ms, {stats} stats, '
+        '{render_ms:.1f} ms rendering'.format(
+            time_ms=summary['time'] * 1000,
+            query_ms=summary['query_time'] * 1000,
+            render_ms=summary['render_time'] * 1000,
+            **summary
+        ),
+        file=stderr
+    )
+    if response is not None:
+        response.headers.add('Server-Timing', ', '.join([
+            'sql;dur={:.2f};desc="{} queries"'.format(
+                summary['query_time'] * 1000, summary['queries']
+            ),
+            'render;dur={:.2f}'.format(summary['render_time'] * 1000),
+            'total;dur={:.2f}'.format(summary['time'] * 1000),
+        ]))
+
+    if profile.profiler is not None:
+        base = path.join(
+            app.config['PROFILE_DIR'],
+            f'{summary["endpoint"]}.{time_ns()}.{getpid()}'
+        )
+        try:
+            makedirs(app.config['PROFILE_DIR'], exist_ok=True)
+            profile.profiler.dump_stats(base + '.prof')
+            with open(base + '.json', 'w') as file:
+                dump(summary, file)
+        except OSError as err:
+            print(f'failed to save profile: {err}', file=stderr)
+
+
+@app.after_request
+def add_profile(response):
+    finish_profile(response)
+    return response
+
+
+@app.teardown_request
+def discard_profile(_error):
+    # after_request is skipped when a view raises
+    finish_profile()
+
+
+def load_profiles(directory: str) -> dict[str, list[tuple[dict, str]]]:
+    """Get the saved profiles in directory, by endpoint
+
+    Each profile is its summary and the name of its cProfile dump.
+    """
+    profiles: dict[str, list[tuple[dict, str]]] = {}
+    for filename in glob(path.join(directory, '*.json')):
+        dump_name = filename.removesuffix('.json') + '.prof'
+        try:
+            with open(filename) as file:
+                summary = load(file)
+        except (OSError, JSONDecodeError):
+            continue
+        if path.isfile(dump_name):
+            profiles.setdefault(summary['endpoint'], []).append(
+                (summary, dump_name)
+            )
+    return profiles
@@ -0,0 +1,40 @@
+from threading import Lock
+from time import monotonic, sleep
+
+
+class TokenBucket:
+    """Limit throughput to rate bytes per second, shared between threads
+
+    A rate of 0 means unlimited. Up to burst seconds worth of unused
+    allowance is saved up. Callers that go over the limit sleep off the
+    debt outside the lock, so concurrent transfers share the rate evenly.
+    """
+
+    def __init__(self, rate: int = 0, burst: float = 1.0):
+        self.lock = Lock()
+        self.rate = rate
+        self.burst = burst
+        self.tokens = 0.0
+        self.updated = monotonic()
+
+    def set_rate(self, rate: int):
+        with self.lock:
+            if rate != self.rate:
+                self.rate = rate
+                self.tokens = 0.0
+                self.updated = monotonic()
+
+    def consume(self, amount: int):
+        with self.lock:
+            if not self.rate:
+                return
+            now = monotonic()
+            self.tokens = min(
+                self.tokens + (now - self.updated) * self.rate,
+                self.rate * self.burst
+            )
+            self.updated = now
+            self.tokens -= amount
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            sleep(wait)
@@ -0,0 +1,133 @@
+document.addEventListener('DOMContentLoaded', () => {
+  'use strict';
+
+  const proto = window.location.protocol === 'https:' ? 'wss' : 'ws';
+  const url = `${proto}://${window.location.host}/tasks/feed`;
+
+  const status = document.querySelector('#status');
+  const queues = document.querySelector('#queues');
+  const claimed = document.querySelector('#claimed');
+  const tbody = document.querySelector('#tasks');
+  const empty = tbody.querySelector('.empty');
+  const rows = new Map();
+
+  const formatPercent = (p) => `${Math.round(p * 1000) / 10}%`;
+  const formatRate = (rate) => (
+    rate === null ? '-' : (rate / 1e6).toFixed(1)
+  );
+  const formatEta = (eta) => {
+    if (eta === null) {
+      return '-';
+    }
+    const seconds = Math.round(eta);
+    return seconds < 60 ?
+      `${seconds}s` :
+      `${Math.floor(seconds / 60)}m ${seconds % 60}s`;
+  };
+  const STATE_CLASSES = {
+    running: '',
+    done: 'table-success',
+    failed: 'table-danger',
+  };
+
+  const cell = (row, text) => {
+    const td = document.createElement('td');
+    td.innerText = text;
+    row.appendChild(td);
+    return td;
+  };
+
+  const showTask = (task) => {
+    const key = `${task.m} ${task.t}`;
+    let row = rows.get(key);
+    if (row === undefined) {
+      const tr = document.createElement('tr');
+      row = {
+        tr,
+        name: cell(tr, task.n),
+        type: cell(tr, task.t),
+        state: cell(tr, ''),
+        progress: document.createElement('progress'),
+        rate: null,
+        eta: null,
+      };
+      row.progress.max = 1.0;
+      row.progress.className = 'w-100';
+      cell(tr, '').appendChild(row.progress);
+      row.rate = cell(tr, '');
+      row.eta = cell(tr, '');
+      rows.set(key, row);
+      tbody.appendChild(tr);
+    }
+    row.tr.className = STATE_CLASSES[task.s] || '';
+    row.state.innerText = task.s;
+    row.progress.value = task.p;
+    row.progress.title = formatPercent(task.p);
+    row.rate.innerText = formatRate(task.rate);
+    row.eta.innerText = formatEta(task.eta);
+    empty.style.display = rows.size > 0 ? 'none' : '';
+  };
+
+  const showList = (ul, items, emptyText) => {
+    ul.innerHTML = '';
+    if (items.length === 0) {
+      const li = document.createElement('li');
+      const em = document.createElement('em');
+      em.innerText = emptyText;
+      li.appendChild(em);
+      ul.appendChild(li);
+    }
+    items.forEach((text) => {
+      const li = document.createElement('li');
+      li.innerText = text;
+      ul.appendChild(li);
+    });
+  };
+
+  const showQueues = (depths) => {
+    const waiting = Object.entries(depths).filter(([, depth]) => depth > 0);
+    showList(
+      queues,
+      waiting.sort().map(([type, depth]) => `${type}: ${depth}`),
+      'Nothing is waiting.',
+    );
+  };
+
+  const showClaimed = (jobs) => {
+    showList(
+      claimed,
+      jobs.map((job) => `${job.t}: ${job.n} (${job.by})`),
+      'No jobs are being worked on.',
+    );
+  };
+
+  let delay = 1000;
+  const connect = () => {
+    const socket = new WebSocket(url);
+    socket.addEventListener('open', () => {
+      delay = 1000;
+      status.innerText = 'Live';
+      // the server starts with a snapshot of everything it knows about
+      rows.forEach((row) => row.tr.remove());
+      rows.clear();
+      empty.style.display = '';
+    });
+    socket.addEventListener('message', (msg) => {
+      try {
+        const {tasks, queues: depths, claimed: jobs} = JSON.parse(msg.data);
+        tasks.forEach(showTask);
+        // the queues are only sent when they change
+        if (depths !== undefined) {
+          showQueues(depths);
+          showClaimed(jobs);
+        }
+      } catch (e) {console.error('websocket message error', e);}
+    });
+    socket.addEventListener('close', () => {
+      status.innerText = 'Disconnected, reconnecting...';
+      setTimeout(connect, delay);
+      delay = Math.min(delay * 2, 30000);
+    });
+  };
+  connect();
+});
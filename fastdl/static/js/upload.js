@@ -6,10 +6,35 @@ document.addEventListener('DOMContentLoaded', () => {
 
   const formatPercent = (p) => `${Math.round(p * 1000) / 10}%`
 
+  const uploadUrl = `${window.location.pathname.replace(/\/$/, '')}/chunked`;
+  const PARALLEL_CHUNKS = 4;
+  const MAX_ATTEMPTS = 5;
+
+  const sleep = (ms) => new Promise((resolve) => setTimeout(resolve, ms));
+
+  // hex sha256 of a blob, or null where WebCrypto is unavailable (plain http)
+  const sha256 = async (blob) => {
+    if (!window.crypto || !window.crypto.subtle) {
+      return null;
+    }
+    const digest = await window.crypto.subtle.digest(
+      'SHA-256',
+      await blob.arrayBuffer()
+    );
+    return Array.from(
+      new Uint8Array(digest),
+      (byte) => byte.toString(16).padStart(2, '0')
+    ).join('');
+  };
+
   const container = document.querySelector('main');
+  const form = document.querySelector('form');
   const input = document.querySelector('#map');
   const csrf = document.querySelector('#csrf_token');
-  document.querySelector('form').addEventListener('submit', (event) => {
+  // maps that fit in one chunk are sent in a single request, which the
+  // server hashes and compresses as it arrives
+  const chunkSize = Number(form.dataset.chunkSize);
+  form.addEventListener('submit', (event) => {
     event.preventDefault();
     event.stopPropagation();
 
@@ -66,7 +91,7 @@ document.addEventListener('DOMContentLoaded', () => {
 
         const p = document.createElement('p');
         p.innerText = type + ' ';
-        p.appendChild(percent);
+        p.appendChild(bar.percent);
 
         cardBody.insertBefore(p, cancelButton);
         cardBody.insertBefore(bar.progress, cancelButton);
@@ -96,49 +121,164 @@ document.addEventListener('DOMContentLoaded', () => {
         reject('This does not appear to be a valid BSP.');
       });
       reader.readAsArrayBuffer(file.slice(0, magicNumber.length));
-    }).then((file) => new Promise((resolve, reject) => {
-      const xhr = new XMLHttpRequest();
+    }).then((file) => {
+      let cancelled = false;
+      const requests = new Set();
       cancel = () => {
-        xhr.abort();
-        reject('Cancelled');
-      }
+        cancelled = true;
+        requests.forEach((xhr) => xhr.abort());
+      };
+      cancelButton.addEventListener('click', cancel);
 
-      const form_data = new FormData();
-      form_data.set('map', file, file.name);
-      form_data.set('csrf_token', csrf.value);
+      const send = (method, url, body, headers, onProgress) => (
+        new Promise((resolve, reject) => {
+          if (cancelled) {
+            return reject('Cancelled');
+          }
+          const xhr = new XMLHttpRequest();
+          requests.add(xhr);
+          xhr.responseType = 'json';
+          xhr.open(method, url);
+          xhr.setRequestHeader('Accept', 'application/json');
+          Object.entries(headers).forEach(([name, value]) => {
+            xhr.setRequestHeader(name, value);
+          });
+          xhr.addEventListener('loadend', () => requests.delete(xhr));
+          xhr.addEventListener('load', () => {
+            if (xhr.response && xhr.response.success) {
+              resolve(xhr.response);
+            } else if (xhr.response && xhr.response.error) {
+              reject(xhr.response.error);
+            } else {
+              reject(`Server error ${xhr.status}`);
+            }
+          });
+          xhr.addEventListener('error', () => reject('Network error'));
+          xhr.addEventListener('abort', () => reject('Cancelled'));
+          if (onProgress) {
+            xhr.upload.addEventListener('progress', onProgress);
+          }
+          xhr.send(body);
+        })
+      );
 
-      cancelButton.addEventListener('click', cancel);
-      xhr.responseType = 'json';
-      xhr.open('POST', window.location.href);
-      xhr.setRequestHeader('Accept', 'application/json');
-      xhr.addEventListener('load', function () {
-        if (xhr.response.success) {
-          resolve(xhr.response);
-        } else {
-          reject(xhr.response.error);
+      const loaded = new Map();
+      const showProgress = () => {
+        let total = 0;
+        loaded.forEach((bytes) => {
+          total += bytes;
+        });
+        progressBar.max = file.size;
+        progressBar.value = total;
+        percent.innerText = formatPercent(total / file.size);
+      };
+
+      const sendChunk = async (upload, index) => {
+        const start = index * upload.chunk_size;
+        const chunk = file.slice(start, start + upload.chunk_size);
+        const headers = {'X-CSRFToken': csrf.value};
+        const checksum = await sha256(chunk);
+        if (checksum !== null) {
+          headers['X-Chunk-SHA256'] = checksum;
         }
-      });
-      xhr.addEventListener('error', reject);
-      xhr.upload.addEventListener('progress', function (e) {
-        if (e.lengthComputable) {
-          progressBar.max = e.total;
-          progressBar.value = e.loaded;
-          percent.innerText = formatPercent(e.loaded / e.total);
-        } else {
-          progressBar.removeAttribute('value');
+
+        for (let attempt = 1; ; attempt += 1) {
+          try {
+            await send(
+              'PUT',
+              `${uploadUrl}/${upload.id}/${index}`,
+              chunk,
+              headers,
+              (e) => {
+                loaded.set(index, e.loaded);
+                showProgress();
+              }
+            );
+            loaded.set(index, chunk.size);
+            showProgress();
+            return;
+          } catch (error) {
+            loaded.set(index, 0);
+            if (cancelled || attempt >= MAX_ATTEMPTS) {
+              throw error;
+            }
+            await sleep(1000 * 2 ** attempt);
+          }
         }
+      };
+
+      if (file.size <= chunkSize) {
+        const body = new FormData();
+        body.append('csrf_token', csrf.value);
+        body.append('map', file);
+        return send(
+          'POST',
+          window.location.pathname,
+          body,
+          {},
+          (e) => {
+            // e.loaded counts the multipart framing too
+            loaded.set(0, Math.min(e.loaded, file.size));
+            showProgress();
+          }
+        );
+      }
+
+      return send('POST', uploadUrl, JSON.stringify({
+        name: file.name,
+        size: file.size,
+        csrf_token: csrf.value,
+      }), {'Content-Type': 'application/json'}).then(async (upload) => {
+        // resuming an earlier attempt: skip chunks the server already has,
+        // unless they differ from this file
+        const pending = [];
+        const received = new Map(upload.received);
+        const count = Math.ceil(file.size / upload.chunk_size);
+        for (let index = 0; index < count; index += 1) {
+          const start = index * upload.chunk_size;
+          const chunk = file.slice(start, start + upload.chunk_size);
+          if (
+            received.has(index) &&
+            [null, received.get(index)].includes(await sha256(chunk))
+          ) {
+            loaded.set(index, chunk.size);
+          } else {
+            pending.push(index);
+          }
+        }
+        showProgress();
+
+        const worker = async () => {
+          try {
+            while (pending.length > 0) {
+              await sendChunk(upload, pending.shift());
+            }
+          } catch (error) {
+            cancel();
+            throw error;
+          }
+        };
+        await Promise.all(Array.from({length: PARALLEL_CHUNKS}, worker));
+
+        return send(
+          'POST',
+          `${uploadUrl}/${upload.id}/finish`,
+          null,
+          {'X-CSRFToken': csrf.value}
+        );
       });
-      xhr.send(form_data);
-    })).then(({id}) => {
+    }).then(({id}) => {
       status.innerText = 'Uploaded successfully';
       card.classList.add('bg-success');
 
       const messageHandler = (msg) => {
         try {
-          const {m, t, p} = JSON.parse(msg.data);
-          if (m === id) {
-            backgroundProgressBar(t, p);
-          }
+          // each frame is a batch of the latest progress of several tasks
+          JSON.parse(msg.data).forEach(({m, t, p}) => {
+            if (m === id) {
+              backgroundProgressBar(t, p);
+            }
+          });
         } catch (e) {console.error('websocket message error', e);}
       };
       socket.addEventListener('message', messageHandler);
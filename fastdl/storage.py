@@ -0,0 +1,75 @@
+from hashlib import sha256
+from os import makedirs, link, path, unlink
+from tempfile import NamedTemporaryFile
+from typing import BinaryIO
+
+from . import app
+
+
+BLOCK_SIZE = 1024 * 1024
+
+
+def blob_dir() -> str:
+    return path.join(app.config['UPLOAD_DIR'], 'blobs')
+
+
+def blob_path(digest: str) -> str:
+    return path.join(blob_dir(), digest[:2], digest)
+
+
+def partial_path(map_id: int) -> str:
+    """Where a map being uploaded in chunks is assembled"""
+    return path.join(blob_dir(), f'.partial-{map_id}')
+
+
+def install(source: str, digest: str, suffix: str = '') -> bool:
+    """Hard link source into the blob store under digest
+
+    Returns False if a blob with that digest was already stored.
+    """
+    filename = blob_path(digest) + suffix
+    makedirs(path.dirname(filename), exist_ok=True)
+    try:
+        link(source, filename)
+    except FileExistsError:
+        return False
+    return True
+
+
+def store(stream: BinaryIO) -> tuple[str, bool]:
+    """Copy stream into the blob store, hashing it on the way
+
+    Returns the digest and whether the content was new.
+    """
+    hash = sha256()
+    makedirs(blob_dir(), exist_ok=True)
+    with NamedTemporaryFile(
+        dir=blob_dir(),
+        prefix='.upload-',
+        delete_on_close=False
+    ) as tempfile:
+        while data := stream.read(BLOCK_SIZE):
+            hash.update(data)
+            tempfile.write(data)
+        tempfile.close()
+        digest = hash.hexdigest()
+        return digest, install(tempfile.name, digest)
+
+
+def hash_file(filename: str) -> str:
+    hash = sha256()
+    with open(filename, 'rb') as file:
+        while data := file.read(BLOCK_SIZE):
+            hash.update(data)
+    return hash.hexdigest()
+
+
+def adopt(filename: str, compressed: bool) -> str:
+    """Move an existing map into the blob store, returning its digest"""
+    digest = hash_file(filename)
+    install(filename, digest)
+    unlink(filename)
+    if compressed:
+        install(filename + '.bz2', digest, '.bz2')
+        unlink(filename + '.bz2')
+    return digest
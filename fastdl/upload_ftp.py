@@ -1,20 +1,35 @@
-from enum import Enum
-from ftplib import FTP, FTP_TLS
+from collections import deque
+from datetime import timedelta
+from enum import Enum, IntEnum
+from ftplib import FTP, FTP_TLS, error_perm
+from hashlib import sha256
 from io import BufferedReader
 from os import fstat, path
-from queue import Empty, Queue
 from ssl import CERT_NONE, create_default_context
-from threading import Thread
-from weakref import WeakValueDictionary
+from sys import stderr
+from threading import Condition, Thread
+from time import monotonic, sleep
+from traceback import print_exception
+from typing import NamedTuple
 
-from . import app, db
-from .background import subscribers
-from .models import Map, Server
+from sqlalchemy import or_
+from sqlalchemy.sql.functions import count
+
+from . import app, db, metrics
+from .background import QueueState, fail, queue_states, report
+from .compress import claim_id
+from .models import (
+    Distribution, DistributionState, Map, PushMode, Server, ServerFile,
+    Setting, UTCDateTime
+)
+from .ratelimit import TokenBucket
+from .storage import hash_file
 
 
 BLOCK_SIZE = 16 * 1024
+DELTA_BLOCK_SIZE = 1024 * 1024
+HASH_SIZE = 32
 SESSION_TIMEOUT = 60
-EMPTY_LIST = []
 
 
 class FTPAction(Enum):
@@ -22,21 +37,94 @@ class FTPAction(Enum):
     Delete = 2
 
 
-ActionQueue = Queue[tuple[FTPAction, str, int]]
-ftp_sessions: WeakValueDictionary[int, ActionQueue] = WeakValueDictionary()
+class Priority(IntEnum):
+    Upload = 0
+    Resync = 1
+
+
+class FTPJob(NamedTuple):
+    action: FTPAction
+    map_name: str
+    map_id: int
+    priority: Priority = Priority.Upload
+
+
+class Push(NamedTuple):
+    source: str
+    remote_name: str
+    # where to resume the remote file from, if only the end changed
+    offset: int
+    previous_size: int | None
+    size: int
+    digest: str
+    compressed: bool
+    blocks: bytes | None
+    # a bz2 pushed earlier that the agent must not extract over this push
+    stale: str | None
+
+
+class ServerQueue:
+    """Pending jobs and open connections for one server"""
+
+    def __init__(self, server_id: int):
+        self.server_id = server_id
+        self.task_name = ''
+        self.pending: deque[FTPJob] = deque()
+        self.active = 0
+        # names being transferred; jobs for the same file run in order
+        self.busy: set[str] = set()
+        # idle connections and when they were last used
+        self.idle: list[tuple[FTP, float]] = []
+        self.bucket = TokenBucket()
+
+    def take(self, priority: Priority) -> FTPJob | None:
+        if self.active >= app.config['FTP_CONNECTIONS_PER_SERVER']:
+            return None
+        waiting = set()
+        for job in self.pending:
+            if job.map_name in self.busy or job.map_name in waiting:
+                continue
+            if job.priority == priority:
+                self.pending.remove(job)
+                self.active += 1
+                self.busy.add(job.map_name)
+                return job
+            waiting.add(job.map_name)
+        return None
+
+
+# guards everything below, and is notified whenever a job may be runnable
+condition = Condition()
+servers: dict[int, ServerQueue] = {}
+# servers with pending jobs, in the order they are offered to workers
+rotation: deque[ServerQueue] = deque()
+# (map id, server id) of uploads waiting or running
+queued: set[tuple[int, int]] = set()
+workers: list[Thread] = []
+# shared by every push, on top of each server's own limit
+global_bucket = TokenBucket()
 
 
 class ProgressCallback:
-    def __init__(self, id: int, type: str, fp: BufferedReader):
+    def __init__(
+        self,
+        id: int,
+        type: str,
+        fp: BufferedReader,
+        buckets: tuple[TokenBucket, ...] = ()
+    ):
         self.id = id
         self.type = type
         self.size = fstat(fp.fileno()).st_size
         self.consumed = 0
+        self.buckets = buckets
 
     def __call__(self, data: bytes):
+        # called by storbinary after each block, so sleeping here throttles
+        for bucket in self.buckets:
+            bucket.consume(len(data))
         self.consumed += len(data)
-        for subscriber in subscribers.get(self.id, EMPTY_LIST):
-            subscriber(self.id, self.type, self.consumed / self.size)
+        report(self.id, self.type, self.consumed / self.size, self.size)
 
 
 def open_ftp_session(server: Server):
@@ -61,54 +149,620 @@ def open_ftp_session(server: Server):
     return ftp
 
 
-def ftp_session_thread(server_id: int, queue: ActionQueue):
-    ftp: FTP
-    task_name: str
-    map_dir: str
+def close_quietly(ftp: FTP):
+    try:
+        ftp.quit()
+    except Exception:
+        ftp.close()
+
+
+def next_job() -> tuple[ServerQueue, FTPJob]:
+    """Wait for a job, taking servers in turn so none of them starves
+
+    New uploads go before resyncs on every server.
+    """
+    with condition:
+        while True:
+            for priority in Priority:
+                for _ in range(len(rotation)):
+                    queue = rotation[0]
+                    rotation.rotate(-1)
+                    job = queue.take(priority)
+                    if job is not None:
+                        if not queue.pending:
+                            rotation.remove(queue)
+                        return queue, job
+            condition.wait()
+
+
+def get_connection(queue: ServerQueue) -> FTP | None:
+    with condition:
+        if queue.idle:
+            return queue.idle.pop()[0]
+
     with app.app_context():
-        map_dir = app.config['UPLOAD_DIR']
-        server = db.session.get(Server, server_id)
+        server = db.session.get(Server, queue.server_id)
         if not server or not server.ftp_enabled:
-            return
-        task_name = 'Uploading to ' + server.description
-        ftp = open_ftp_session(server)
-        del server
+            return None
+        return open_ftp_session(server)
 
-    try:
-        while True:
-            [action, map_name, map_id] = queue.get(timeout=SESSION_TIMEOUT)
-            if action == FTPAction.Upload:
-                with open(path.join(map_dir, map_name), 'rb') as map_file:
-                    progress = ProgressCallback(map_id, task_name, map_file)
-                    ftp.storbinary(
-                        'STOR ' + map_name,
-                        map_file,
-                        callback=progress
-                    )
-            elif action == FTPAction.Delete:
-                ftp.delete(map_name)
-
-    except Empty:
-        ftp.close()
+
+def block_hashes(filename: str) -> bytes:
+    hashes = []
+    with open(filename, 'rb') as file:
+        while data := file.read(DELTA_BLOCK_SIZE):
+            hashes.append(sha256(data).digest())
+    return b''.join(hashes)
+
+
+def first_changed_block(old: bytes, new: bytes) -> int:
+    length = min(len(old), len(new))
+    for i in range(0, length, HASH_SIZE):
+        if old[i:i + HASH_SIZE] != new[i:i + HASH_SIZE]:
+            return i // HASH_SIZE
+    return length // HASH_SIZE
+
+
+def plan_push(server_id: int, map_id: int) -> Push | None:
+    """Work out what to send, or None if the server is up to date"""
+    map = db.session.get(Map, map_id)
+    server = db.session.get(Server, server_id)
+    if map is None or server is None:
+        return None
+    mode = server.ftp_push
+    if map.content_hash is None:
+        # added before hashes were kept; see Map.record_unscanned
+        map.content_hash = map.digest or hash_file(map.filename)
+        db.session.commit()
+    digest = map.content_hash
+    compressed = mode == PushMode.Compressed and map.compressed
+    pushed = db.session.get(ServerFile, (server_id, map.name))
+    if (
+        pushed is not None and
+        pushed.digest == digest and
+        pushed.compressed == compressed
+    ):
+        return None
+
+    size = map.size_compressed if compressed else map.size
+    blocks = None
+    offset = 0
+    if mode == PushMode.Delta:
+        blocks = block_hashes(map.filename)
+        if (
+            pushed is not None and
+            pushed.blocks is not None and
+            not pushed.compressed and
+            size >= pushed.size
+        ):
+            # FTP can only append to or overwrite the end of a file, so
+            # everything from the first changed block on is sent again
+            changed = first_changed_block(pushed.blocks, blocks)
+            offset = changed * DELTA_BLOCK_SIZE
+
+    return Push(
+        source=map.filename_compressed if compressed else map.filename,
+        remote_name=map.name + '.bz2' if compressed else map.name,
+        offset=offset,
+        previous_size=pushed.size if pushed is not None else None,
+        size=size,
+        digest=digest,
+        compressed=compressed,
+        blocks=blocks,
+        stale=(
+            map.name + '.bz2'
+            if pushed is not None and pushed.compressed and not compressed
+            else None
+        )
+    )
+
+
+def record_push(server_id: int, map_name: str, push: Push):
+    file = db.session.get(ServerFile, (server_id, map_name))
+    if file is None:
+        file = ServerFile(server_id=server_id, name=map_name)
+    file.size = push.size
+    file.digest = push.digest
+    file.compressed = push.compressed
+    file.blocks = push.blocks
+    file.pushed = UTCDateTime.utcnow()
+    db.session.add(file)
+    db.session.commit()
+
+
+def upload(ftp: FTP, push: Push, job: FTPJob, queue: ServerQueue) -> int:
+    """Send push to the server, returning how many bytes were sent"""
+    if push.stale is not None:
+        try:
+            ftp.delete(push.stale)
+        except error_perm:
+            # already extracted
+            pass
+
+    offset = push.offset
+    if offset:
+        ftp.voidcmd('TYPE I')
+        try:
+            remote_size = ftp.size(push.remote_name)
+        except error_perm:
+            remote_size = None
+        if remote_size != push.previous_size:
+            # changed behind our back; the ledger can't be trusted
+            offset = 0
+
+    with open(push.source, 'rb') as map_file:
+        progress = ProgressCallback(
+            job.map_id,
+            queue.task_name,
+            map_file,
+            (global_bucket, queue.bucket)
+        )
+        if offset:
+            map_file.seek(offset)
+            progress.consumed = offset
+            try:
+                ftp.storbinary(
+                    'STOR ' + push.remote_name,
+                    map_file,
+                    blocksize=BLOCK_SIZE,
+                    callback=progress,
+                    rest=offset
+                )
+                return push.size - offset
+            except error_perm:
+                # the server doesn't support resuming; send everything
+                map_file.seek(0)
+                progress.consumed = 0
+        ftp.storbinary(
+            'STOR ' + push.remote_name,
+            map_file,
+            blocksize=BLOCK_SIZE,
+            callback=progress
+        )
+    return push.size
+
+
+def delete(ftp: FTP, server_id: int, job: FTPJob):
+    with app.app_context():
+        pushed = db.session.get(ServerFile, (server_id, job.map_name))
+        compressed = pushed is not None and pushed.compressed
+        if pushed is not None:
+            db.session.delete(pushed)
+            db.session.commit()
+
+    if not compressed:
+        ftp.delete(job.map_name)
+        return
+    # the bz2 is only left if the agent has not extracted it yet
+    for name in (job.map_name, job.map_name + '.bz2'):
+        try:
+            ftp.delete(name)
+        except error_perm:
+            pass
+
+
+def unclaimed():
+    """Condition for distributions no live process is pushing"""
+    stale = UTCDateTime.utcnow() - timedelta(
+        seconds=app.config['FTP_CLAIM_TIMEOUT']
+    )
+    return or_(
+        Distribution.claimed_by == None,  # noqa
+        Distribution.claimed_at < stale
+    )
+
+
+def claim(server_id: int, map_id: int) -> bool:
+    """Take a pending push for this process, unless another process has it"""
+    claimed = db.session.execute(
+        db.update(Distribution).where(
+            Distribution.map_id == map_id,
+            Distribution.server_id == server_id,
+            Distribution.state == DistributionState.Pending,
+            unclaimed()
+        ).values(claimed_by=claim_id(), claimed_at=UTCDateTime.utcnow())
+    ).rowcount
+    db.session.commit()
+    return claimed == 1
 
 
-def get_or_create_ftp_queue(server_id: int) -> ActionQueue:
-    queue = ftp_sessions.get(server_id)
+def finish_distribution(server_id: int, map_id: int, error: str | None):
+    distribution = db.session.get(Distribution, (map_id, server_id))
+    if distribution is None:
+        # the map or server was deleted in the meantime
+        return
+    distribution.claimed_by = None
+    distribution.claimed_at = None
+    distribution.last_error = error
+    if error is None:
+        distribution.state = DistributionState.Done
+    else:
+        attempts = distribution.attempts = distribution.attempts + 1
+        if attempts >= app.config['FTP_MAX_ATTEMPTS']:
+            distribution.state = DistributionState.Failed
+        else:
+            delay = min(
+                app.config['FTP_RETRY_DELAY'] * 2 ** (attempts - 1),
+                app.config['FTP_RETRY_MAX_DELAY']
+            )
+            distribution.next_attempt = (
+                UTCDateTime.utcnow() + timedelta(seconds=delay)
+            )
+    db.session.commit()
+
+
+def ftp_worker_thread():
+    while True:
+        queue, job = next_job()
+        ftp = None
+        error = None
+        claimed = False
+        try:
+            if job.action == FTPAction.Upload:
+                with app.app_context():
+                    claimed = claim(queue.server_id, job.map_id)
+                    if claimed:
+                        push = plan_push(queue.server_id, job.map_id)
+                if not claimed:
+                    # another process is pushing it, or already has
+                    pass
+                elif push is None:
+                    report(job.map_id, queue.task_name, 1.0)
+                else:
+                    ftp = get_connection(queue)
+                    if ftp is None:
+                        error = 'FTP is disabled for this server'
+                    else:
+                        started = monotonic()
+                        sent = upload(ftp, push, job, queue)
+                        metrics.inc(
+                            'fastdl_ftp_seconds_total',
+                            monotonic() - started,
+                            server=queue.server_id
+                        )
+                        metrics.inc(
+                            'fastdl_ftp_bytes_total',
+                            sent,
+                            server=queue.server_id
+                        )
+                        with app.app_context():
+                            record_push(queue.server_id, job.map_name, push)
+            elif job.action == FTPAction.Delete:
+                ftp = get_connection(queue)
+                if ftp is not None:
+                    delete(ftp, queue.server_id, job)
+        except Exception as ex:
+            error = str(ex) or type(ex).__name__
+            print(
+                f'{job.action.name.lower()} of {job.map_name} '
+                f'on server {queue.server_id} failed:',
+                file=stderr
+            )
+            print_exception(ex, file=stderr)
+            if job.action == FTPAction.Upload:
+                fail(job.map_id, queue.task_name)
+            if ftp is not None:
+                ftp.close()
+                ftp = None
+        if error is not None:
+            metrics.inc('fastdl_ftp_failures_total', server=queue.server_id)
+
+        if claimed:
+            with app.app_context():
+                try:
+                    finish_distribution(queue.server_id, job.map_id, error)
+                except Exception as ex:
+                    print_exception(ex, file=stderr)
+
+        with condition:
+            queue.active -= 1
+            queue.busy.discard(job.map_name)
+            queued.discard((job.map_id, queue.server_id))
+            if ftp is not None:
+                queue.idle.append((ftp, monotonic()))
+            if queue.pending and queue not in rotation:
+                rotation.append(queue)
+            condition.notify_all()
+
+
+def keepalive_thread():
+    """Keep idle connections open with NOOP, closing long unused ones"""
+    interval = app.config['FTP_KEEPALIVE_INTERVAL']
+    while True:
+        with condition:
+            condition.wait(interval)
+            now = monotonic()
+            stale = []
+            for queue in servers.values():
+                for entry in queue.idle[:]:
+                    if now - entry[1] >= interval:
+                        queue.idle.remove(entry)
+                        stale.append((queue, entry))
+
+        for queue, (ftp, last_used) in stale:
+            if now - last_used >= app.config['FTP_IDLE_TIMEOUT']:
+                close_quietly(ftp)
+                continue
+            try:
+                ftp.voidcmd('NOOP')
+            except Exception:
+                ftp.close()
+                continue
+            with condition:
+                # keep the original time so the idle timeout still applies
+                queue.idle.append((ftp, last_used))
+
+
+def enqueue(server_id: int, description: str, rate_limit: int, job: FTPJob):
+    """Add a job to a server's queue; the caller must hold condition
+
+    rate_limit is the server's limit in KiB/s, applied to a new queue so it
+    is not unlimited until the next poll.
+    """
+    queue = servers.get(server_id)
     if queue is None:
-        queue = Queue()
-        ftp_sessions[server_id] = queue
-        thread = Thread(
-            target=ftp_session_thread,
-            args=[server_id, queue]
+        queue = servers[server_id] = ServerQueue(server_id)
+        queue.bucket.set_rate(rate_limit * 1024)
+    queue.task_name = task_name(description)
+    if job.action == FTPAction.Upload:
+        if (job.map_id, server_id) in queued:
+            # already waiting, perhaps as a resync; let it jump the queue
+            for i, waiting in enumerate(queue.pending):
+                if (
+                    waiting.action == FTPAction.Upload and
+                    waiting.map_id == job.map_id and
+                    waiting.priority > job.priority
+                ):
+                    queue.pending[i] = job
+            return
+        queued.add((job.map_id, server_id))
+    queue.pending.append(job)
+    if queue not in rotation:
+        rotation.append(queue)
+
+
+def requeue():
+    """Queue pushes that are due, including ones left from a restart"""
+    due = db.session.execute(
+        db.select(
+            Distribution.map_id,
+            Distribution.server_id,
+            Distribution.priority,
+            Map.name,
+            Server.description,
+            Server.ftp_rate_limit
+        )
+        .join(Distribution.map)
+        .join(Distribution.server)
+        .where(
+            Distribution.state == DistributionState.Pending,
+            Distribution.next_attempt <= UTCDateTime.utcnow(),
+            unclaimed(),
+            Server.ftp_enabled == True  # noqa
         )
-        thread.start()
+    ).all()
+    with condition:
+        for map_id, server_id, priority, name, description, limit in due:
+            enqueue(
+                server_id,
+                description,
+                limit,
+                FTPJob(FTPAction.Upload, name, map_id, Priority(priority))
+            )
+        condition.notify_all()
+
+
+def load_limits():
+    """Apply the bandwidth limits set in the admin interface, in KiB/s"""
+    global_bucket.set_rate(Setting.get_int('ftp_rate_limit') * 1024)
+    limits = dict(db.session.execute(
+        db.select(Server.id, Server.ftp_rate_limit)
+    ).all())
+    with condition:
+        for queue in servers.values():
+            queue.bucket.set_rate(limits.get(queue.server_id, 0) * 1024)
+
+
+def poll_thread():
+    """Pick up due pushes and changed limits, also from other processes"""
+    while True:
+        with app.app_context():
+            try:
+                load_limits()
+                requeue()
+            except Exception as ex:
+                print('failed to poll FTP pushes:', file=stderr)
+                print_exception(ex, file=stderr)
+        sleep(app.config['FTP_POLL_INTERVAL'])
+
+
+def task_name(description: str) -> str:
+    return 'Uploading to ' + description
+
+
+def get_queue_state() -> QueueState:
+    pending = (
+        db.select(Server.description)
+        .join(Distribution.server)
+        .where(
+            Distribution.state == DistributionState.Pending,
+            Server.ftp_enabled == True  # noqa
+        )
+    )
+    waiting = db.session.execute(
+        pending.add_columns(count())
+        .where(unclaimed())
+        .group_by(Server.id)
+    )
+    claimed = db.session.execute(
+        pending.add_columns(Map.name, Distribution.claimed_by)
+        .join(Distribution.map)
+        .where(~unclaimed())
+    )
+    return QueueState(
+        {task_name(description): n for description, n in waiting},
+        [
+            (task_name(description), name, process)
+            for description, name, process in claimed
+        ]
+    )
+
+
+queue_states.append(get_queue_state)
+
+
+def collect_metrics():
+    with condition:
+        depths = [
+            (queue.server_id, len(queue.pending))
+            for queue in servers.values()
+        ]
+    for server_id, depth in depths:
+        metrics.set_gauge('fastdl_ftp_queue_depth', depth, server=server_id)
+
+
+metrics.collectors.append(collect_metrics)
+
+
+def start():
+    with condition:
+        if workers:
+            return
+        for i in range(app.config['FTP_WORKERS']):
+            workers.append(Thread(
+                target=ftp_worker_thread,
+                name=f'ftp-{i}',
+                daemon=True
+            ))
+        workers.append(Thread(
+            target=keepalive_thread,
+            name='ftp-keepalive',
+            daemon=True
+        ))
+        workers.append(Thread(
+            target=poll_thread,
+            name='ftp-poll',
+            daemon=True
+        ))
+        for thread in workers:
+            thread.start()
+
+
+@app.before_request
+def start_workers():
+    if not workers:
+        start()
 
-    return queue
+
+def close_connections(server_id: int):
+    """Drop idle connections to a server whose settings have changed"""
+    with condition:
+        queue = servers.get(server_id)
+        if queue is None:
+            return
+        idle = queue.idle
+        queue.idle = []
+    for ftp, _last_used in idle:
+        close_quietly(ftp)
+
+
+def list_remote(ftp: FTP) -> dict[str, int | None]:
+    """Files in the current directory, with their size if known"""
+    try:
+        return {
+            name: int(facts['size']) if 'size' in facts else None
+            for name, facts in ftp.mlsd(facts=['type', 'size'])
+            if facts.get('type') == 'file'
+        }
+    except error_perm:
+        # no MLSD; fall back to bare names
+        return {path.basename(name): None for name in ftp.nlst()}
+
+
+def mark_pending(map_id: int, server_id: int, priority: Priority):
+    distribution = db.session.get(Distribution, (map_id, server_id))
+    if distribution is None:
+        distribution = Distribution(map_id=map_id, server_id=server_id)
+    distribution.state = DistributionState.Pending
+    distribution.priority = priority
+    distribution.attempts = 0
+    distribution.next_attempt = UTCDateTime.utcnow()
+    distribution.last_error = None
+    db.session.add(distribution)
+
+
+def reconcile(server: Server, listing: dict[str, int | None]) -> int:
+    """Mark maps missing from a server's listing as pending
+
+    Maps the server has but that were not pushed by fastdl are recorded as
+    pushed if the listing shows the same size. Returns how many maps are
+    missing.
+    """
+    pushed = {file.name: file for file in server.files}
+    missing = 0
+    for map in db.session.scalars(
+        db.select(Map).where(Map.uploaded == True)  # noqa
+    ):
+        file = pushed.get(map.name)
+        if file is None:
+            present = (
+                map.content_hash is not None and
+                listing.get(map.name) == map.size
+            )
+            if present:
+                db.session.add(ServerFile(
+                    server=server,
+                    name=map.name,
+                    size=map.size,
+                    digest=map.content_hash,
+                    compressed=False
+                ))
+        elif (
+            map.content_hash is not None and
+            file.digest != map.content_hash
+        ):
+            present = False
+        elif file.compressed:
+            # the agent may or may not have extracted it yet
+            present = map.name in listing or map.name + '.bz2' in listing
+        else:
+            present = (
+                map.name in listing and
+                listing[map.name] in (None, file.size)
+            )
+
+        if present:
+            distribution = db.session.get(Distribution, (map.id, server.id))
+            if distribution is None:
+                distribution = Distribution(map=map, server=server)
+            distribution.state = DistributionState.Done
+            db.session.add(distribution)
+        else:
+            if file is not None:
+                # whatever is there can't be built on
+                db.session.delete(file)
+            mark_pending(map.id, server.id, Priority.Resync)
+            missing += 1
+    db.session.commit()
+    return missing
 
 
 def schedule_ftp_action(action: FTPAction, map: Map):
-    for server in db.session.scalars(
+    start()
+    job = FTPJob(action, map.name, map.id)
+    targets = db.session.scalars(
         db.select(Server).where(Server.ftp_enabled == True)  # noqa
-    ):
-        queue = get_or_create_ftp_queue(server.id)
-        queue.put((action, map.name, map.id))
+    ).all()
+    if action == FTPAction.Upload:
+        for server in targets:
+            mark_pending(map.id, server.id, Priority.Upload)
+        db.session.commit()
+    with condition:
+        for server in targets:
+            enqueue(
+                server.id,
+                server.description,
+                server.ftp_rate_limit,
+                job
+            )
+        condition.notify_all()
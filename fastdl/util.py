@@ -1,16 +1,13 @@
 from steam.steamid import SteamID
-from . import steam_api
+
+from .profiles import resolve_vanity
 
 
 def string_to_steamid(string, resolve_customurl=True):
     try:
         steamid = SteamID(string)
         if not steamid.is_valid() and resolve_customurl:
-            steamid = SteamID(
-                steam_api.ISteamUser.ResolveVanityURL(  # pyright: ignore
-                    vanityurl=string
-                ).get('response', {}).get('steamid')
-            )
+            steamid = SteamID(resolve_vanity(string))
         return steamid
     except ValueError:
         return SteamID()
@@ -1,27 +1,46 @@
 from functools import wraps
-from ipaddress import IPv4Address
-import re
+from hashlib import sha256
+from os import makedirs, unlink
+from threading import Lock
+from time import perf_counter
 
 from flask import (
-    render_template, redirect, url_for, flash, request, abort, send_file,
-    jsonify
+    render_template, redirect, url_for, flash, request, abort, jsonify
 )
 from flask_login import current_user  # type: ignore
 from flask_login import login_required, login_user, logout_user
+from flask_wtf.csrf import validate_csrf
+from sqlalchemy.exc import IntegrityError
 from steam_openid import SteamOpenID
+from wtforms.validators import ValidationError
 
 
-from . import app, db
+from . import access_log, app, db, metrics, whitelist
 from .compress import schedule_compress
+from .download import (
+    classify_client, find_map_file, forget_missing, send_map_file
+)
 from .forms import (
-    EditServerForm, IDForm, NewServerForm, NewUserForm, UploadForm
+    ChunkedUploadForm, EditServerForm, IDForm, NewServerForm, NewUserForm,
+    SettingsForm, UploadForm
+)
+from .ingest import IngestStream
+from .models import (
+    AnonymousUser, User, Server, Map, Access, PushMode, Setting, Upload,
+    UploadChunk
+)
+from .profiles import cached_name
+from .storage import BLOCK_SIZE, blob_dir, install, store
+from .upload_ftp import (
+    FTPAction, close_connections, load_limits, schedule_ftp_action
 )
-from .models import AnonymousUser, User, Server, Map, Access
-from .upload_ftp import FTPAction, schedule_ftp_action
 
 
 current_user: User | AnonymousUser
 
+maps_recorded = False
+maps_recorded_lock = Lock()
+
 
 def create_openid():
     return SteamOpenID(
@@ -41,6 +60,18 @@ def admin_required(view):
     return check_admin
 
 
+@app.before_request
+def record_unscanned_maps():
+    """Fill in the sizes of maps from older versions, once per process"""
+    global maps_recorded
+    if maps_recorded:
+        return
+    with maps_recorded_lock:
+        if not maps_recorded:
+            Map.record_unscanned()
+            maps_recorded = True
+
+
 @app.route('/')
 def index():
     if current_user.is_authenticated:
@@ -122,6 +153,7 @@ def create_server():
             )
             db.session.add(server)
             db.session.commit()
+            whitelist.invalidate()
             flash(server.display + ' added.', 'success')
 
     else:
@@ -142,6 +174,8 @@ def update_server(server: Server, form: EditServerForm):
             server.ftp_tls = form.ftp_tls.data
             server.ftp_tls_verify = form.ftp_tls_verify.data
             server.ftp_dir = form.ftp_dir.data
+            server.ftp_push = form.ftp_push.data
+            server.ftp_rate_limit = form.ftp_rate_limit.data
             server.ftp_user = form.ftp_user.data
             if form.ftp_pass.data:
                 server.ftp_pass = form.ftp_pass.data
@@ -154,6 +188,8 @@ def update_server(server: Server, form: EditServerForm):
             server.ftp_tls = True
             server.ftp_tls_verify = True
             server.ftp_dir = '/'
+            server.ftp_push = PushMode.Map
+            server.ftp_rate_limit = 0
             server.ftp_user = ''
             server.ftp_pass = ''
 
@@ -175,6 +211,9 @@ def edit_server(id):
         if update_server(server, form):
             db.session.add(server)
             db.session.commit()
+            whitelist.invalidate()
+            close_connections(server.id)
+            load_limits()
             flash('Server details updated.', 'success')
             return redirect(url_for('servers'))
     return render_template('edit_server.html', form=form, server=server)
@@ -186,8 +225,11 @@ def delete_server():
     form = IDForm(model=Server)
     if form.validate():
         display = form.instance.display
+        id = form.instance.id
         db.session.delete(form.instance)
         db.session.commit()
+        whitelist.invalidate()
+        close_connections(id)
         flash(display + ' deleted.', 'success')
     else:
         flash('Invalid server.', 'danger')
@@ -205,56 +247,50 @@ def maps():
     )
 
 
+@app.route('/tasks')
+@login_required
+def tasks():
+    return render_template('tasks.html')
+
+
 @app.route('/maps/<name>')
 def download_map(name):
-    map: Map = db.first_or_404(db.select(Map).where(Map.name == name))
-    if not map.uploaded:
+    started = perf_counter()
+    file = find_map_file(name)
+    if file is None:
+        metrics.record_download('not_found', started)
         abort(404)
 
+    # HEAD requests send no map, so they are neither logged nor counted
+    get = request.method == 'GET'
+    server_id = None
     if not current_user.is_authenticated:
-        try:
-            if request.headers['User-Agent'] != 'Half-Life 2':
-                abort(404)
-
-            match = re.match(
-                r'hl2://([0-9.]+):([0-9]+)',
-                request.headers['Referer']
-            )
-            if not match:
-                abort(404)
+        server_id, outcome = classify_client(
+            request.headers.get('User-Agent'),
+            request.headers.get('Referer')
+        )
+        if server_id is None:
+            metrics.record_download(outcome, started)
+            abort(404)
 
-            addr = IPv4Address(match.group(1))
-            port = int(match.group(2))
-            server = Server.get_by_address(addr, port)
-            if server is None:
+        if get:
+            try:
+                access_log.record(
+                    request.remote_addr,
+                    server_id,
+                    file.map_id,
+                    file.size
+                )
+            except ValueError:
+                metrics.record_download('not_found', started)
                 abort(404)
 
-            access = Access(  # type: ignore
-                ip=request.remote_addr,
-                map=map,
-                server=server
-            )
-            db.session.add(access)
-            db.session.commit()
-
-        except (KeyError, ValueError):
-            abort(404)
-
-    if map.compressed:
-        name = map.name + '.bz2'
-        filename = map.filename_compressed
-        mimetype = 'application/x-bzip2'
-    else:
-        name = map.name
-        filename = map.filename
-        mimetype = 'application/octet-stream'
-    return send_file(
-        filename,
-        mimetype=mimetype,
-        as_attachment=True,
-        download_name=name,
-        conditional=True
+    response = send_map_file(file, request.environ)
+    metrics.record_download(
+        'served', started, file.map_name, server_id,
+        file.size if get else 0
     )
+    return response
 
 
 @login_required
@@ -263,7 +299,15 @@ def delete_map():
     form = IDForm(model=Map)
     if form.validate():
         map = form.instance
-        if not map.uploaded:
+        if map.upload is not None:
+            if not current_user.admin:
+                flash('Only admins can cancel an upload.', 'danger')
+            else:
+                map.upload.discard()
+                db.session.delete(map)
+                db.session.commit()
+                flash('Cancelled the upload of ' + map.name, 'success')
+        elif not map.uploaded:
             flash(
                 'Wait for the map to finish uploading before deleting it.',
                 'danger'
@@ -287,6 +331,43 @@ def delete_map():
     return redirect(url_for('maps'))
 
 
+def finish_upload(
+    map: Map,
+    digest: str,
+    compress_level: int | None = None,
+    compress_time: float | None = None
+):
+    """Mark map as uploaded with content digest and start processing it
+
+    compress_level and compress_time describe a compressed file that was
+    already produced during the upload. Otherwise, if a map with the same
+    content already exists, its compressed file is reused rather than
+    compressing the content again.
+    """
+    map.digest = digest
+    map.uploaded = True
+    duplicate = next((dup for dup in map.duplicates if dup.uploaded), None)
+    if compress_level is not None:
+        map.compressed = compress_level > 0
+        map.compress_level = compress_level
+        map.compress_time = compress_time
+    elif duplicate is not None:
+        map.compressed = duplicate.compressed
+        map.compress_level = duplicate.compress_level
+        map.compress_time = duplicate.compress_time
+    map.record_files()
+    db.session.add(map)
+    db.session.commit()
+    forget_missing(map.name)
+
+    if compress_level is None and (duplicate is None or (
+        duplicate.compress_level is None and
+        duplicate.compress_job is None
+    )):
+        schedule_compress(map)
+    schedule_ftp_action(FTPAction.Upload, map)
+
+
 @login_required
 @app.route('/upload', methods=['GET', 'POST'])
 def upload():
@@ -302,13 +383,12 @@ def upload():
             db.session.add(map)
             db.session.commit()
 
-            form.map.data.save(map.filename)
-            map.uploaded = True
-            db.session.add(map)
-            db.session.commit()
-
-            schedule_compress(map)
-            schedule_ftp_action(FTPAction.Upload, map)
+            stream = form.map.data.stream
+            if isinstance(stream, IngestStream):
+                finish_upload(map, *stream.finish(map.id))
+            else:
+                digest, _new = store(stream)
+                finish_upload(map, digest)
 
             if should_return_json:
                 return jsonify({
@@ -329,6 +409,165 @@ def upload():
     return render_template('upload.html', form=form)
 
 
+def json_error(message: str, status: int = 400):
+    return jsonify({'success': False, 'error': message}), status
+
+
+def csrf_error() -> str | None:
+    if not app.config.get('WTF_CSRF_ENABLED', True):
+        return None
+    try:
+        validate_csrf(request.headers.get('X-CSRFToken'))
+    except ValidationError as err:
+        return str(err)
+    return None
+
+
+def get_upload(id: int) -> Upload:
+    upload = db.session.get(Upload, id)
+    if upload is None:
+        abort(404)
+    return upload
+
+
+def upload_state(upload: Upload):
+    return jsonify({
+        'success': True,
+        'id': upload.map.id,
+        'name': upload.map.name,
+        'size': upload.size,
+        'chunk_size': upload.chunk_size,
+        'received': sorted(
+            [chunk.index, chunk.sha256] for chunk in upload.chunks
+        )
+    })
+
+
+@app.route('/upload/chunked', methods=['POST'])
+@login_required
+def start_chunked_upload():
+    # uploads given up on would otherwise hold on to their names forever
+    Upload.expire()
+    form = ChunkedUploadForm()
+    if not form.validate():
+        return json_error(form.errors[next(iter(form.errors.keys()))][0])
+
+    map = form.resume
+    if map is None:
+        map = Map(name=form.name.data, uploaded=False)
+        map.upload = Upload(
+            size=form.size.data,
+            chunk_size=app.config['UPLOAD_CHUNK_SIZE']
+        )
+        db.session.add(map)
+        db.session.commit()
+        makedirs(blob_dir(), exist_ok=True)
+        with open(map.upload.filename, 'wb') as file:
+            file.truncate(map.upload.size)
+
+    return upload_state(map.upload)
+
+
+@app.route('/upload/chunked/<int:id>')
+@login_required
+def chunked_upload_status(id):
+    return upload_state(get_upload(id))
+
+
+@app.route('/upload/chunked/<int:id>/<int:index>', methods=['PUT'])
+@login_required
+def put_upload_chunk(id, index):
+    error = csrf_error()
+    if error:
+        return json_error(error)
+
+    upload = get_upload(id)
+    if index >= upload.chunk_count:
+        return json_error('Chunk out of range.')
+
+    expected = upload.chunk_length(index)
+    received = 0
+    hash = sha256()
+    with open(upload.filename, 'r+b') as file:
+        file.seek(index * upload.chunk_size)
+        while data := request.stream.read(BLOCK_SIZE):
+            received += len(data)
+            if received > expected:
+                break
+            hash.update(data)
+            file.write(data)
+
+    if received != expected:
+        return json_error('Chunk has the wrong length.')
+    checksum = request.headers.get('X-Chunk-SHA256')
+    if checksum is not None and checksum.lower() != hash.hexdigest():
+        return json_error('Chunk checksum mismatch.')
+
+    try:
+        db.session.merge(
+            UploadChunk(map_id=id, index=index, sha256=hash.hexdigest())
+        )
+        db.session.commit()
+    except IntegrityError:
+        # the same chunk was retried and recorded concurrently
+        db.session.rollback()
+
+    return jsonify({'success': True})
+
+
+@app.route('/upload/chunked/<int:id>/finish', methods=['POST'])
+@login_required
+def finish_chunked_upload(id):
+    error = csrf_error()
+    if error:
+        return json_error(error)
+
+    upload = get_upload(id)
+    missing = upload.chunk_count - len(upload.chunks)
+    if missing:
+        return json_error(f'{missing} chunks have not been uploaded.')
+
+    map = upload.map
+    with open(upload.filename, 'rb') as file:
+        magic_number = file.read(4)
+    if magic_number != b'VBSP':
+        unlink(upload.filename)
+        db.session.delete(map)
+        db.session.commit()
+        return json_error('This does not look like a valid BSP file.')
+
+    # one pass over the assembled file checks every chunk against the hash
+    # it was received with and hashes the whole map; compressing it is left
+    # to the job queue, so the request does not wait for bz2
+    checksums = {chunk.index: chunk.sha256 for chunk in upload.chunks}
+    corrupt = []
+    hash = sha256()
+    with open(upload.filename, 'rb') as file:
+        for index in range(upload.chunk_count):
+            data = file.read(upload.chunk_length(index))
+            expected = checksums[index]
+            if expected and sha256(data).hexdigest() != expected:
+                corrupt.append(index)
+            hash.update(data)
+
+    if corrupt:
+        for chunk in upload.chunks:
+            if chunk.index in corrupt:
+                db.session.delete(chunk)
+        db.session.commit()
+        return json_error(
+            f'{len(corrupt)} chunks were damaged; upload them again.'
+        )
+
+    digest = hash.hexdigest()
+    install(upload.filename, digest)
+    unlink(upload.filename)
+    db.session.delete(upload)
+    finish_upload(map, digest)
+
+    return jsonify({'success': True, 'name': map.name, 'id': map.id})
+
+
 @admin_required
 @app.route('/users')
 def users():
@@ -404,19 +643,45 @@ def create_user():
         if user:
             flash(user.name + ' already added.', 'danger')
         else:
-            user = User(
-                steamid64=id64,
-                admin=form.admin.data
-            )
-            user.refresh_name()
-            if user.name is not None:
+            # a name that isn't cached is looked up in the background
+            cached, name = cached_name(id64)
+            if not cached:
+                flash(
+                    'Looking up this Steam user. Try again in a moment.',
+                    'warning'
+                )
+            elif name is None:
+                flash('No such steam user.', 'danger')
+            else:
+                user = User(
+                    steamid64=id64,
+                    admin=form.admin.data,
+                    name=name
+                )
                 db.session.add(user)
                 db.session.commit()
                 flash(user.name + ' added.', 'success')
-            else:
-                flash('No such steam user.', 'danger')
 
     else:
         flash(next(iter(form.errors['steamid'])), 'danger')
 
     return redirect(url_for('users'))
+
+
+@app.route('/settings', methods=['GET', 'POST'])
+@admin_required
+def settings():
+    form = SettingsForm()
+    if request.method == 'POST':
+        if form.validate():
+            Setting.set('ftp_rate_limit', form.ftp_rate_limit.data)
+            db.session.commit()
+            load_limits()
+            flash('Settings saved.', 'success')
+            return redirect(url_for('settings'))
+        for error_list in form.errors.values():
+            for error in error_list:
+                flash(error, 'danger')
+    else:
+        form.ftp_rate_limit.data = Setting.get_int('ftp_rate_limit')
+    return render_template('settings.html', form=form)
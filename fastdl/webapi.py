@@ -0,0 +1,67 @@
+from json import JSONDecodeError, dump, load
+from os import path, replace
+from sys import stderr
+from threading import Lock
+from time import time
+from typing import Any
+
+from . import app
+
+
+class LazyWebAPI:
+    """The Steam WebAPI client, created when it is first used
+
+    Creating a client needs the list of Steam's interfaces. It is kept in
+    STEAM_INTERFACE_CACHE, so starting fastdl doesn't wait for Steam and
+    works while Steam can't be reached.
+    """
+
+    def __init__(self):
+        self.api: Any = None
+        self.lock = Lock()
+
+    def __getattr__(self, name: str):
+        if self.api is None:
+            with self.lock:
+                if self.api is None:
+                    self.api = create_webapi()
+        return getattr(self.api, name)
+
+
+def create_webapi():
+    # steam.webapi pulls in requests, which is slow to import
+    from steam.webapi import WebAPI
+
+    api = WebAPI(app.config['STEAM_API_KEY'], auto_load_interfaces=False)
+    api.load_interfaces(get_interfaces(api))
+    return api
+
+
+def get_interfaces(api) -> dict:
+    """Get the interface list from the cache, or from Steam if it is old"""
+    filename = app.config['STEAM_INTERFACE_CACHE']
+    cached = None
+    try:
+        with open(filename) as file:
+            cached = load(file)
+        age = time() - path.getmtime(filename)
+        if age < app.config['STEAM_INTERFACE_CACHE_TTL']:
+            return cached
+    except (OSError, JSONDecodeError):
+        pass
+
+    try:
+        interfaces = api.fetch_interfaces()
+    except Exception as ex:
+        if cached is None:
+            raise
+        print(f'using cached Steam interfaces: {ex}', file=stderr)
+        return cached
+
+    try:
+        with open(filename + '.tmp', 'w') as file:
+            dump(interfaces, file)
+        replace(filename + '.tmp', filename)
+    except OSError as err:
+        print(f'failed to cache Steam interfaces: {err}', file=stderr)
+    return interfaces
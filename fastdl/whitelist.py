@@ -0,0 +1,46 @@
+from ipaddress import IPv4Address
+from threading import Lock
+from time import monotonic
+
+from . import app, db
+from .models import Server
+
+
+Index = dict[tuple[bytes, int], int]
+
+_index: Index | None = None
+_expires = 0.0
+_lock = Lock()
+
+
+def load() -> Index:
+    return {
+        (ip, port): id
+        for id, ip, port in db.session.execute(
+            db.select(Server.id, Server._ip, Server.port)
+        )
+    }
+
+
+def lookup(address: IPv4Address, port: int) -> int | None:
+    """Get the id of the whitelisted server at address:port, if any"""
+    global _index, _expires
+    index = _index
+    if index is None or monotonic() > _expires:
+        with _lock:
+            index = _index
+            if index is None or monotonic() > _expires:
+                index = _index = load()
+                _expires = monotonic() + app.config['WHITELIST_TTL']
+    return index.get((address.packed, port))
+
+
+def invalidate():
+    """Drop the index so the next lookup reloads it from the database
+
+    This only affects the current process; other processes pick up the
+    change once their copy is older than WHITELIST_TTL seconds.
+    """
+    global _index
+    with _lock:
+        _index = None
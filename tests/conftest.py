@@ -0,0 +1,81 @@
+from ipaddress import IPv4Address
+from os import environ, makedirs, path
+from shutil import rmtree
+from tempfile import mkdtemp
+
+import pytest
+
+
+# fastdl reads its configuration when it is imported
+directory = mkdtemp(prefix='fastdl-test-')
+upload_dir = path.join(directory, 'uploads')
+settings = path.join(directory, 'fastdl.cfg')
+with open(settings, 'w') as cfg:
+    cfg.write(f'''
+SECRET_KEY = 'test'
+STEAM_API_KEY = 'test'
+SQLALCHEMY_DATABASE_URI = 'sqlite:///{path.join(directory, 'test.sqlite')}'
+UPLOAD_DIR = {upload_dir!r}
+STEAM_INTERFACE_CACHE = {path.join(directory, 'steam_interfaces.json')!r}
+WTF_CSRF_ENABLED = False
+COMPRESS_WORKERS = 0
+COMPRESS_PROCESSES = 1
+FTP_WORKERS = 0
+''')
+environ['FASTDL_SETTINGS'] = settings
+
+from fastdl import app as fastdl_app, db  # noqa: E402
+from fastdl import access_log, download, whitelist  # noqa: E402
+from fastdl.models import Map, Server  # noqa: E402
+
+
+@pytest.fixture
+def app():
+    makedirs(upload_dir, exist_ok=True)
+    with fastdl_app.app_context():
+        db.create_all()
+        yield fastdl_app
+        db.session.remove()
+        db.drop_all()
+    rmtree(upload_dir)
+
+
+@pytest.fixture
+def make_map(app):
+    """Create an uploaded map stored under its own name"""
+    def make_map(name: str, data: bytes, compressed: bytes | None = None):
+        map = Map(name=name, uploaded=True, compressed=compressed is not None)
+        with open(map.filename, 'wb') as file:
+            file.write(data)
+        if compressed is not None:
+            with open(map.filename_compressed, 'wb') as file:
+                file.write(compressed)
+        map.record_files()
+        db.session.add(map)
+        db.session.commit()
+        return map
+    return make_map
+
+
+@pytest.fixture
+def accesses(app, monkeypatch):
+    """Accesses the server logs, as (address, server id, map id, size)
+
+    The game server at 203.0.113.10:27015 is whitelisted.
+    """
+    records = []
+    monkeypatch.setattr(
+        access_log,
+        'record',
+        lambda *access: records.append(access)
+    )
+    db.session.add(Server(
+        ip=IPv4Address('203.0.113.10'),
+        port=27015,
+        description='test'
+    ))
+    db.session.commit()
+    whitelist.invalidate()
+    download.missing.clear()
+    yield records
+    whitelist.invalidate()
@@ -0,0 +1,103 @@
+from datetime import timedelta
+from ipaddress import IPv4Address
+from queue import Queue
+from types import SimpleNamespace
+
+import pytest
+
+from fastdl import access_log, db
+from fastdl.models import Access, MapStats, Server, ServerStats, UTCDateTime
+
+
+ADDRESS = IPv4Address('198.51.100.7').packed
+
+
+@pytest.fixture
+def server(app):
+    server = Server(
+        ip=IPv4Address('203.0.113.10'),
+        port=27015,
+        description='test'
+    )
+    db.session.add(server)
+    db.session.commit()
+    return server
+
+
+def stats(model, id: int) -> tuple:
+    db.session.expire_all()
+    row = db.session.get(model, id)
+    return row.served, row.bytes_served, row.last_access
+
+
+def test_stats_accumulate_across_batches(server, make_map):
+    map = make_map('cp_test.bsp', b'VBSP map')
+    other = make_map('cp_other.bsp', b'VBSP other')
+    first = UTCDateTime.utcnow()
+    later = first + timedelta(minutes=5)
+
+    access_log.write([
+        (ADDRESS, server.id, map.id, 100, first),
+        (ADDRESS, server.id, map.id, 100, first),
+    ])
+    access_log.write([
+        (ADDRESS, server.id, map.id, 100, later),
+        (ADDRESS, server.id, other.id, 10, first),
+    ])
+
+    assert stats(MapStats, map.id) == (3, 300, later)
+    assert stats(MapStats, other.id) == (1, 10, first)
+    assert stats(ServerStats, server.id) == (4, 310, later)
+    assert db.session.scalar(db.select(db.func.count(Access.id))) == 4
+
+
+class RacingConnection:
+    """Inserts a row, as another process would, before the first update"""
+
+    def __init__(self, connection, insert):
+        self.connection = connection
+        self.insert = insert
+
+    def execute(self, statement, *args):
+        if self.insert is not None and statement.is_update:
+            insert, self.insert = self.insert, None
+            self.connection.execute(insert)
+            return SimpleNamespace(rowcount=0)
+        return self.connection.execute(statement, *args)
+
+    def begin_nested(self):
+        return self.connection.begin_nested()
+
+
+def test_row_inserted_by_another_process_is_added_to(server, make_map):
+    map = make_map('cp_test.bsp', b'VBSP map')
+    time = UTCDateTime.utcnow()
+    other = db.insert(MapStats).values(
+        map_id=map.id,
+        served=5,
+        bytes_served=500,
+        last_access=time - timedelta(minutes=5)
+    )
+
+    with db.engine.begin() as connection:
+        access_log.add_stats(
+            RacingConnection(connection, other),
+            MapStats,
+            MapStats.map_id,
+            {map.id: [2, 200, time]}
+        )
+
+    assert stats(MapStats, map.id) == (7, 700, time)
+
+
+def test_full_queue_counts_dropped(app, monkeypatch):
+    monkeypatch.setattr(access_log, 'queue', Queue(maxsize=1))
+    monkeypatch.setattr(access_log, 'ensure_started', lambda: None)
+    monkeypatch.setattr(access_log, 'dropped', 0)
+
+    access_log.record('198.51.100.7', 1, 1, 100)
+    access_log.record('198.51.100.7', 1, 1, 100)
+    access_log.record('198.51.100.7', 1, 1, 100)
+
+    assert access_log.pending() == 1
+    assert access_log.dropped == 2
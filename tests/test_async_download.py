@@ -0,0 +1,79 @@
+import asyncio
+
+from fastdl import async_download
+
+
+REFERER = 'hl2://203.0.113.10:27015'
+
+
+def fetch(method: str, path: str, **headers: str) -> bytes:
+    headers = {
+        'User-Agent': 'Half-Life 2',
+        'Referer': REFERER,
+        'Connection': 'close',
+        **headers,
+    }
+    request = f'{method} {path} HTTP/1.1\r\n' + ''.join(
+        f'{name.replace("_", "-")}: {value}\r\n'
+        for name, value in headers.items()
+    ) + '\r\n'
+
+    async def run() -> bytes:
+        server = await asyncio.start_server(
+            async_download.handle_connection,
+            '127.0.0.1',
+            0
+        )
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(request.encode('latin-1'))
+            response = await reader.read()
+            writer.close()
+        return response
+
+    return asyncio.run(run())
+
+
+def test_get_is_logged_under_peer_address(accesses, make_map):
+    map = make_map('cp_test.bsp', b'VBSP map')
+    response = fetch(
+        'GET', '/maps/cp_test.bsp',
+        X_Forwarded_For='198.51.100.7'
+    )
+    assert response.startswith(b'HTTP/1.1 200 OK')
+    assert response.endswith(b'\r\n\r\nVBSP map')
+    assert accesses == [('127.0.0.1', 1, map.id, 8)]
+
+
+def test_forwarded_for_from_trusted_proxy(
+    app, accesses, make_map, monkeypatch
+):
+    make_map('cp_test.bsp', b'VBSP map')
+    monkeypatch.setitem(
+        app.config,
+        'DOWNLOAD_TRUSTED_PROXIES',
+        ['127.0.0.1', '10.0.0.1']
+    )
+    fetch(
+        'GET', '/maps/cp_test.bsp',
+        X_Forwarded_For='192.0.2.1, 198.51.100.7, 10.0.0.1'
+    )
+    assert accesses[0][0] == '198.51.100.7'
+
+
+def test_head_is_not_logged(accesses, make_map):
+    make_map('cp_test.bsp', b'VBSP map')
+    response = fetch('HEAD', '/maps/cp_test.bsp')
+    assert b'\r\nContent-Length: 8\r\n' in response
+    assert response.endswith(b'\r\n\r\n')
+    assert accesses == []
+
+
+def test_download_name_is_quoted(accesses, make_map):
+    make_map('cp "quoted".bsp', b'VBSP map')
+    response = fetch('GET', '/maps/cp%20%22quoted%22.bsp')
+    assert (
+        b'\r\nContent-Disposition: attachment; '
+        b'filename="cp \\"quoted\\".bsp"\r\n'
+    ) in response
@@ -0,0 +1,103 @@
+from datetime import timedelta
+from ipaddress import IPv4Address
+
+import pytest
+
+from fastdl import background, db, upload_ftp
+from fastdl.background import (
+    TASK_RETENTION, TASK_TIMEOUT, Outbox, expire, get_queue_states, report,
+    subscribe
+)
+from fastdl.compress import TASK_NAME
+from fastdl.ingest import Ingest
+from fastdl.models import (
+    CompressJob, Distribution, DistributionState, Server, UTCDateTime
+)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(background, 'monotonic', lambda: now[0])
+    monkeypatch.setattr(background, 'latest', {})
+    monkeypatch.setattr(background, 'subscribers', {})
+    return now
+
+
+def test_silent_task_fails(clock):
+    outbox = Outbox()
+    subscribe(1, outbox)
+    report(1, 'Pushing', 0.5)
+    outbox.take()
+
+    clock[0] += TASK_TIMEOUT / 2
+    expire()
+    assert background.latest[(1, 'Pushing')].state == 'running'
+
+    clock[0] += TASK_TIMEOUT
+    expire()
+    [task] = outbox.take()
+    assert task.state == 'failed'
+    assert task.progress == 0.5
+
+
+def test_finished_task_is_forgotten(clock):
+    report(1, 'Pushing', 1.0)
+    clock[0] += TASK_RETENTION + 1
+    expire()
+    assert background.latest == {}
+
+
+def test_ingest_reports_compression(app, clock):
+    outbox = Outbox()
+    subscribe(1, outbox)
+    ingest = Ingest(1, 8)
+    try:
+        ingest.update(b'VBSP')
+        [task] = outbox.take()
+        assert (task.type, task.state, task.progress) == (
+            TASK_NAME, 'running', 0.5
+        )
+    finally:
+        ingest.close()
+    # given up without finishing
+    [task] = outbox.take()
+    assert task.state == 'failed'
+
+
+def test_queues_cover_every_process(app, make_map):
+    maps = [make_map(f'cp_{i}.bsp', b'VBSP') for i in range(4)]
+    server = Server(
+        ip=IPv4Address('203.0.113.10'),
+        port=27015,
+        description='test',
+        ftp_enabled=True
+    )
+    now = UTCDateTime.utcnow()
+    stale = now - timedelta(seconds=app.config['COMPRESS_CLAIM_TIMEOUT'] + 1)
+    db.session.add_all([
+        server,
+        CompressJob(map=maps[0], priority=0),
+        CompressJob(map=maps[1], priority=0, claimed_by='a:1', claimed_at=now),
+        CompressJob(map=maps[2], priority=0, failed=True),
+        # its process died, so the job is waiting again
+        CompressJob(
+            map=maps[3], priority=0, claimed_by='b:1', claimed_at=stale
+        ),
+        Distribution(map=maps[0], server=server),
+        Distribution(map=maps[1], server=server),
+        Distribution(map=maps[2], server=server, state=DistributionState.Done),
+        Distribution(
+            map=maps[3], server=server, claimed_by='a:1', claimed_at=now
+        ),
+    ])
+    db.session.commit()
+
+    pushing = upload_ftp.task_name('test')
+    assert get_queue_states() == {
+        'queues': {TASK_NAME: 2, pushing: 2},
+        'claimed': [
+            {'t': TASK_NAME, 'n': 'cp_1.bsp', 'by': 'a:1'},
+            {'t': pushing, 'n': 'cp_3.bsp', 'by': 'a:1'},
+        ]
+    }
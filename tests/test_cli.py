@@ -0,0 +1,146 @@
+from ipaddress import IPv4Address
+from os import unlink
+
+import pytest
+from sqlalchemy import inspect, text
+
+from fastdl import cli, db
+from fastdl.models import Map, PushMode, Server
+from fastdl.storage import hash_file
+
+
+@pytest.fixture
+def hashed(monkeypatch):
+    """Names of the files rescan hashes"""
+    filenames = []
+
+    def counting_hash_file(filename):
+        filenames.append(filename)
+        return hash_file(filename)
+
+    monkeypatch.setattr(cli, 'hash_file', counting_hash_file)
+    return filenames
+
+
+def test_upgrade_adds_missing_columns(app):
+    db.session.add(Server(
+        ip=IPv4Address('203.0.113.10'),
+        port=27015,
+        description='old'
+    ))
+    db.session.commit()
+    for statement in [
+        'DROP INDEX ix_map_digest',
+        'ALTER TABLE map DROP COLUMN digest',
+        'ALTER TABLE map DROP COLUMN size',
+        'ALTER TABLE map DROP COLUMN compress_level',
+        'ALTER TABLE server DROP COLUMN ftp_push',
+        'DROP TABLE upload_chunk',
+        "INSERT INTO map (name, uploaded, compressed, size_compressed) "
+        "VALUES ('cp_old.bsp', 1, 0, 0)",
+    ]:
+        db.session.execute(text(statement))
+    db.session.commit()
+    db.session.expunge_all()
+
+    result = app.test_cli_runner().invoke(args=['db', 'upgrade'])
+    assert result.exception is None, result.output
+    assert 'added column map.digest' in result.output
+    assert 'added column server.ftp_push' in result.output
+    assert 'added index ix_map_digest' in result.output
+
+    inspector = inspect(db.engine)
+    assert 'upload_chunk' in inspector.get_table_names()
+    map = db.session.scalar(db.select(Map))
+    assert (map.size, map.digest, map.compress_level) == (0, None, None)
+    assert db.session.scalar(db.select(Server)).ftp_push == PushMode.Map
+
+    result = app.test_cli_runner().invoke(args=['db', 'upgrade'])
+    assert result.output == ''
+
+
+def rescan(app, *args):
+    result = app.test_cli_runner().invoke(args=['maps', 'rescan', *args])
+    assert result.exception is None, result.output
+    return result.output
+
+
+def forget_files(map: Map):
+    """Make map look like a row from before sizes were recorded"""
+    map.size = map.size_compressed = 0
+    map.mtime = map.content_hash = None
+    db.session.commit()
+
+
+def test_rescan_fills_in_old_rows(app, make_map):
+    map = make_map('cp_test.bsp', b'VBSP map', compressed=b'bz2')
+    content_hash = map.content_hash
+    forget_files(map)
+
+    assert '1 of 1 maps changed' in rescan(app)
+    db.session.refresh(map)
+    assert map.size == 8
+    assert map.size_compressed == 3
+    assert map.mtime is not None
+    assert map.content_hash == content_hash
+
+
+def test_upgrade_records_old_maps(app, make_map, hashed):
+    map = make_map('cp_test.bsp', b'VBSP map', compressed=b'bz2')
+    forget_files(map)
+
+    result = app.test_cli_runner().invoke(args=['db', 'upgrade'])
+    assert 'recorded the sizes of 1 maps' in result.output
+    db.session.refresh(map)
+    assert (map.size, map.size_compressed) == (8, 3)
+    assert map.mtime is not None
+    # hashing is left until the map is pushed
+    assert map.content_hash is None
+    assert hashed == []
+
+
+def test_first_request_records_old_maps(app, make_map, monkeypatch):
+    app.load_views()
+    from fastdl import views
+    monkeypatch.setattr(views, 'maps_recorded', False)
+    map = make_map('cp_test.bsp', b'VBSP map')
+    forget_files(map)
+
+    app.test_client().get('/login')
+    db.session.refresh(map)
+    assert map.size == 8
+
+
+def test_rescan_only_hashes_changed_files(app, make_map, hashed):
+    map = make_map('cp_test.bsp', b'VBSP map')
+    make_map('cp_other.bsp', b'VBSP other')
+    assert '0 of 2 maps changed' in rescan(app)
+    assert hashed == []
+
+    with open(map.filename, 'ab') as file:
+        file.write(b'more')
+    assert '1 of 2 maps changed' in rescan(app)
+    assert hashed == [map.filename]
+    db.session.refresh(map)
+    assert map.size == 12
+    assert map.content_hash == hash_file(map.filename)
+
+
+def test_rescan_rehash(app, make_map, hashed):
+    make_map('cp_test.bsp', b'VBSP map')
+    make_map('cp_other.bsp', b'VBSP other')
+    rescan(app, '--rehash')
+    assert len(hashed) == 2
+
+
+def test_rescan_skips_missing_files(app, make_map):
+    gone = make_map('cp_gone.bsp', b'VBSP map')
+    map = make_map('cp_test.bsp', b'VBSP map')
+    unlink(gone.filename)
+    forget_files(map)
+
+    output = rescan(app)
+    assert 'could not read cp_gone.bsp' in output
+    assert '1 of 2 maps changed' in output
+    db.session.refresh(map)
+    assert map.size == 8
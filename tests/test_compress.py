@@ -0,0 +1,234 @@
+from bz2 import BZ2Decompressor, decompress
+from datetime import timedelta
+from io import BytesIO
+from os import listdir, path, urandom
+from queue import PriorityQueue
+from time import sleep
+
+import pytest
+from sqlalchemy.sql.functions import count
+
+from fastdl import compress, db
+from fastdl.compress import (
+    ParallelCompressor, StreamCompressor, create_compressor
+)
+from fastdl.models import CompressJob, UTCDateTime
+
+
+BLOCK_SIZE = 100 * 1000
+# compressible, and several blocks long
+DATA = (urandom(1000) + bytes(9000)) * 45
+
+
+def first_stream(data: bytes) -> bytes:
+    """Decompress data the way decoders without multi-stream support do"""
+    return BZ2Decompressor().decompress(data)
+
+
+@pytest.fixture
+def compress_data(app, monkeypatch):
+    monkeypatch.setitem(app.config, 'COMPRESS_BLOCK_SIZE', BLOCK_SIZE)
+
+    def compress_data(data: bytes, multi_stream: bool) -> bytes:
+        monkeypatch.setitem(app.config, 'COMPRESS_MULTI_STREAM', multi_stream)
+        output = BytesIO()
+        compressor = create_compressor(output)
+        for start in range(0, len(data), 64 * 1024):
+            compressor.write(data[start:start + 64 * 1024])
+        compressor.flush()
+        return output.getvalue()
+    return compress_data
+
+
+def test_single_stream_is_the_default(app):
+    assert isinstance(create_compressor(BytesIO()), StreamCompressor)
+
+
+def test_single_stream_round_trip(compress_data):
+    compressed = compress_data(DATA, multi_stream=False)
+    decompressor = BZ2Decompressor()
+    assert decompressor.decompress(compressed) == DATA
+    assert decompressor.eof
+    assert decompressor.unused_data == b''
+
+
+def test_multi_stream_round_trip(compress_data):
+    compressed = compress_data(DATA, multi_stream=True)
+    # BZ2File and bz2.decompress read on
+    assert decompress(compressed) == DATA
+    # other decoders stop at the end of the first block
+    assert first_stream(compressed) == DATA[:BLOCK_SIZE]
+
+
+@pytest.mark.parametrize('multi_stream', [False, True])
+def test_empty_input(compress_data, multi_stream):
+    assert decompress(compress_data(b'', multi_stream)) == b''
+
+
+@pytest.mark.parametrize('multi_stream', [False, True])
+def test_compress_time_leaves_out_waits_for_input(
+    app, monkeypatch, multi_stream
+):
+    monkeypatch.setitem(app.config, 'COMPRESS_MULTI_STREAM', multi_stream)
+    monkeypatch.setitem(app.config, 'COMPRESS_BLOCK_SIZE', BLOCK_SIZE)
+    compressor = create_compressor(BytesIO())
+    compressor.write(DATA[:BLOCK_SIZE])
+    # an upload arriving slowly
+    sleep(0.5)
+    compressor.write(DATA[BLOCK_SIZE:])
+    compressor.flush()
+    assert 0 < compressor.compress_time < 0.5
+
+
+def test_parallel_compressor_reports_progress(app):
+    consumed = []
+    compressor = ParallelCompressor(
+        BytesIO(),
+        level=1,
+        block_size=BLOCK_SIZE,
+        callback=consumed.append
+    )
+    compressor.write(DATA)
+    compressor.flush()
+    assert consumed[-1] == len(DATA)
+    assert compressor.streams == -(-len(DATA) // BLOCK_SIZE)
+
+
+@pytest.fixture
+def queue(app, monkeypatch):
+    """Compression queue of this process, emptied for each test"""
+    monkeypatch.setattr(compress, 'jobs', PriorityQueue())
+    monkeypatch.setattr(compress, 'queued', set())
+    # schedule_compress should not start the real workers
+    monkeypatch.setattr(compress, 'running', True)
+    return compress.queued
+
+
+def add_job(map, **values) -> CompressJob:
+    job = CompressJob(map=map, priority=compress.Priority.Upload, **values)
+    db.session.add(job)
+    db.session.commit()
+    return job
+
+
+def test_requeue_backfills_uncompressed_maps(queue, make_map):
+    map = make_map('cp_test.bsp', b'VBSP' + DATA)
+    done = make_map('cp_done.bsp', b'VBSP' + DATA, compressed=b'bz2')
+    done.compress_level = 9
+    db.session.commit()
+
+    compress.requeue()
+    assert queue == {map.id}
+    assert map.compress_job.priority == compress.Priority.Backfill
+    assert done.compress_job is None
+
+
+def test_requeue_skips_failed_and_claimed_jobs(queue, make_map):
+    failed = make_map('cp_failed.bsp', b'VBSP' + DATA)
+    add_job(failed, failed=True, error='disk full')
+    claimed = make_map('cp_claimed.bsp', b'VBSP' + DATA)
+    add_job(claimed, claimed_by='other:1', claimed_at=UTCDateTime.utcnow())
+    stale = make_map('cp_stale.bsp', b'VBSP' + DATA)
+    add_job(
+        stale,
+        claimed_by='other:2',
+        claimed_at=UTCDateTime.utcnow() - timedelta(days=1)
+    )
+
+    compress.requeue()
+    assert queue == {stale.id}
+    assert db.session.scalar(db.select(count(CompressJob.map_id))) == 3
+
+
+def test_job_is_claimed_once(queue, make_map):
+    map = make_map('cp_test.bsp', b'VBSP' + DATA)
+    add_job(map)
+    assert compress.claim(map.id)
+    assert not compress.claim(map.id)
+
+
+def test_job_claimed_elsewhere_is_left_alone(queue, make_map):
+    map = make_map('cp_test.bsp', b'VBSP' + DATA)
+    add_job(map, claimed_by='other:1', claimed_at=UTCDateTime.utcnow())
+
+    compress.compress_map(map.id)
+    db.session.refresh(map)
+    assert not map.compressed
+    assert map.compress_job is not None
+    assert not path.exists(map.filename_compressed)
+
+
+def test_compress_map(queue, make_map):
+    map = make_map('cp_test.bsp', b'VBSP' + DATA)
+    # as if from before sizes were recorded
+    map.size = 0
+    map.mtime = map.content_hash = None
+    compress.schedule_compress(map)
+    assert queue == {map.id}
+
+    compress.compress_map(map.id)
+    db.session.refresh(map)
+    assert map.compressed
+    assert map.compress_level == 9
+    assert 0 < map.compress_time < 1
+    assert map.compress_job is None
+    with open(map.filename_compressed, 'rb') as file:
+        assert decompress(file.read()) == b'VBSP' + DATA
+    assert map.size_compressed == path.getsize(map.filename_compressed)
+    assert map.size == len(DATA) + 4
+    assert map.content_hash is not None
+
+
+class BrokenCompressor(StreamCompressor):
+    def write(self, data: bytes):
+        super().write(data)
+        raise OSError('disk full')
+
+
+def test_failed_job_is_kept_and_leaves_files_alone(
+    queue, make_map, monkeypatch
+):
+    map = make_map('cp_test.bsp', b'VBSP' + DATA)
+    # finished by another job for the same content
+    with open(map.filename_compressed, 'wb') as file:
+        file.write(b'finished')
+    add_job(map)
+    monkeypatch.setattr(
+        compress,
+        'create_compressor',
+        lambda output, callback=None: BrokenCompressor(output)
+    )
+
+    compress.compress_map(map.id)
+    db.session.refresh(map)
+    assert map.compress_job.failed
+    assert map.compress_job.error == 'disk full'
+    assert map.compress_level is None
+    with open(map.filename_compressed, 'rb') as file:
+        assert file.read() == b'finished'
+    assert not [
+        name for name in listdir(path.dirname(map.filename))
+        if name.startswith('.compress-')
+    ]
+
+    # not retried on its own, nor given a new job
+    compress.requeue()
+    assert queue == set()
+
+    compress.schedule_compress(map)
+    assert not map.compress_job.failed
+    assert queue == {map.id}
+
+
+def test_retry_compress_command(queue, make_map):
+    map = make_map('cp_test.bsp', b'VBSP' + DATA)
+    add_job(map, failed=True, error='disk full')
+
+    result = compress.app.test_cli_runner().invoke(
+        args=['maps', 'retry-compress']
+    )
+    assert 'retrying cp_test.bsp: disk full' in result.output
+    db.session.refresh(map)
+    assert not map.compress_job.failed
+    compress.requeue()
+    assert queue == {map.id}
@@ -0,0 +1,76 @@
+import pytest
+
+from fastdl import db, download
+from fastdl.models import Map
+
+
+@pytest.fixture(autouse=True)
+def clear_missing():
+    download.missing.clear()
+    yield
+    download.missing.clear()
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(download, 'monotonic', lambda: now[0])
+    return now
+
+
+def test_finds_map_and_compressed_copy(make_map):
+    map = make_map('cp_test.bsp', b'VBSP map', compressed=b'bz2')
+
+    file = download.find_map_file('cp_test.bsp')
+    assert file.map_id == map.id
+    assert file.filename == map.filename_compressed
+    assert file.download_name == 'cp_test.bsp.bz2'
+
+    file = download.find_map_file('cp_test.bsp.bz2')
+    assert file.filename == map.filename_compressed
+    assert file.size == 3
+
+
+def test_bz2_of_uncompressed_map_is_missing(make_map):
+    make_map('cp_test.bsp', b'VBSP map')
+    assert download.find_map_file('cp_test.bsp.bz2') is None
+    assert download.find_map_file('cp_test.bsp').size == 8
+
+
+def test_map_still_uploading_is_missing(app):
+    db.session.add(Map(name='cp_test.bsp', uploaded=False))
+    db.session.commit()
+    assert download.find_map_file('cp_test.bsp') is None
+
+
+def test_missing_name_is_remembered(make_map, clock):
+    assert download.find_map_file('cp_test.bsp') is None
+    make_map('cp_test.bsp', b'VBSP map')
+    assert download.find_map_file('cp_test.bsp') is None
+
+    clock[0] += download.app.config['MISSING_CACHE_TTL'] + 1
+    assert download.find_map_file('cp_test.bsp') is not None
+
+
+def test_forget_missing_clears_compressed_name(make_map, clock):
+    assert download.find_map_file('cp_test.bsp') is None
+    assert download.find_map_file('cp_test.bsp.bz2') is None
+    make_map('cp_test.bsp', b'VBSP map', compressed=b'bz2')
+
+    download.forget_missing('cp_test.bsp')
+    assert download.find_map_file('cp_test.bsp') is not None
+    assert download.find_map_file('cp_test.bsp.bz2') is not None
+
+
+def test_cache_is_bounded(app, monkeypatch):
+    monkeypatch.setitem(app.config, 'MISSING_CACHE_SIZE', 2)
+    for name in ('a.nav', 'b.nav', 'c.nav'):
+        download.find_map_file(name)
+    assert list(download.missing) == ['b.nav', 'c.nav']
+
+
+def test_cache_can_be_disabled(make_map, monkeypatch):
+    monkeypatch.setitem(download.app.config, 'MISSING_CACHE_TTL', 0)
+    assert download.find_map_file('cp_test.bsp') is None
+    make_map('cp_test.bsp', b'VBSP map')
+    assert download.find_map_file('cp_test.bsp') is not None
@@ -0,0 +1,93 @@
+import pytest
+from werkzeug.test import Client
+
+from fastdl.fast_download import GameDownloads
+
+
+GAME = {
+    'User-Agent': 'Half-Life 2',
+    'Referer': 'hl2://203.0.113.10:27015',
+}
+
+
+@pytest.fixture
+def flask_calls():
+    """Requests that fell through to Flask, which answers 418"""
+    return []
+
+
+@pytest.fixture
+def client(app, accesses, flask_calls):
+    def flask(environ, start_response):
+        flask_calls.append(environ['PATH_INFO'])
+        start_response('418 I\'m a teapot', [])
+        return [b'']
+
+    downloads = GameDownloads(flask)
+    downloads.warm = True
+    return Client(downloads)
+
+
+def test_game_client_is_served_without_flask(
+    client, accesses, flask_calls, make_map
+):
+    map = make_map('cp_test.bsp', b'VBSP map')
+    response = client.get('/maps/cp_test.bsp', headers=GAME)
+    assert response.status_code == 200
+    assert response.data == b'VBSP map'
+    assert accesses == [(None, 1, map.id, 8)]
+    assert flask_calls == []
+
+
+def test_head_is_not_logged(client, accesses, flask_calls, make_map):
+    make_map('cp_test.bsp', b'VBSP map')
+    response = client.head('/maps/cp_test.bsp', headers=GAME)
+    assert response.status_code == 200
+    assert response.headers['Content-Length'] == '8'
+    assert accesses == []
+    assert flask_calls == []
+
+
+def test_refused_without_cookie_is_answered_here(
+    client, accesses, flask_calls, make_map
+):
+    make_map('cp_test.bsp', b'VBSP map')
+    response = client.get(
+        '/maps/cp_test.bsp',
+        headers={**GAME, 'Referer': 'hl2://198.51.100.1:27015'}
+    )
+    assert response.status_code == 404
+    assert accesses == []
+    assert flask_calls == []
+
+
+def test_refused_with_cookie_falls_through_to_flask(
+    client, accesses, flask_calls, make_map
+):
+    make_map('cp_test.bsp', b'VBSP map')
+    # perhaps a logged-in user, whom Flask serves without a Referer
+    client.set_cookie('session', 'x')
+    response = client.get(
+        '/maps/cp_test.bsp',
+        headers={'User-Agent': 'Half-Life 2'}
+    )
+    assert response.status_code == 418
+    assert flask_calls == ['/maps/cp_test.bsp']
+    assert accesses == []
+
+
+def test_other_requests_go_to_flask(client, flask_calls):
+    client.get('/maps/cp_test.bsp')
+    client.get('/maps/', headers=GAME)
+    client.post('/maps/cp_test.bsp', headers=GAME)
+    assert flask_calls == ['/maps/cp_test.bsp', '/maps/', '/maps/cp_test.bsp']
+
+
+def test_flask_view_does_not_log_head(app, accesses, make_map, monkeypatch):
+    monkeypatch.setitem(app.config, 'DOWNLOAD_FAST_PATH', False)
+    map = make_map('cp_test.bsp', b'VBSP map')
+    client = app.test_client()
+    assert client.head('/maps/cp_test.bsp', headers=GAME).status_code == 200
+    assert accesses == []
+    assert client.get('/maps/cp_test.bsp', headers=GAME).status_code == 200
+    assert accesses == [('127.0.0.1', 1, map.id, 8)]
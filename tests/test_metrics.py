@@ -0,0 +1,16 @@
+from fastdl.metrics import labels_key, render
+
+
+def test_values_are_rendered_exactly():
+    served = labels_key({'map': 'cp_test.bsp'})
+    output = render({
+        ('fastdl_map_bytes_served_total', served): 1234567890123,
+        ('fastdl_compress_seconds_sum', ()): 0.1 + 0.2,
+        ('fastdl_compress_seconds_count', ()): 2.0,
+    }, {})
+    lines = output.splitlines()
+    assert (
+        'fastdl_map_bytes_served_total{map="cp_test.bsp"} 1234567890123'
+    ) in lines
+    assert 'fastdl_compress_seconds_sum 0.30000000000000004' in lines
+    assert 'fastdl_compress_seconds_count 2' in lines
@@ -0,0 +1,166 @@
+from threading import Event
+
+import pytest
+from werkzeug.datastructures import MultiDict
+
+from fastdl import db, profiles
+from fastdl.forms import NewUserForm
+from fastdl.models import User
+
+
+STEAMID = 76561197960287930
+VANITY_URL = 'https://steamcommunity.com/id/gaben'
+
+
+class StubUser:
+    def __init__(self, names: dict[int, str]):
+        self.names = names
+        self.batches: list[list[int]] = []
+        self.vanity_lookups = 0
+
+    def GetPlayerSummaries(self, steamids: str) -> dict:
+        batch = [int(steamid) for steamid in steamids.split(',')]
+        self.batches.append(batch)
+        return {'response': {'players': [
+            {'steamid': str(steamid), 'personaname': self.names[steamid]}
+            for steamid in batch
+            if steamid in self.names
+        ]}}
+
+    def ResolveVanityURL(self, vanityurl: str) -> dict:
+        self.vanity_lookups += 1
+        if vanityurl != 'gaben':
+            return {'response': {'success': 42}}
+        return {'response': {'success': 1, 'steamid': str(STEAMID)}}
+
+
+class StubAPI:
+    def __init__(self, names: dict[int, str]):
+        self.ISteamUser = StubUser(names)
+
+
+@pytest.fixture
+def steam(monkeypatch):
+    # the tests resolve what is pending themselves
+    monkeypatch.setattr(profiles, 'start', lambda: None)
+    api = StubAPI({STEAMID + i: f'player {i}' for i in range(250)})
+    monkeypatch.setattr(profiles, 'steam_api', api)
+    monkeypatch.setattr(profiles, 'names', {})
+    monkeypatch.setattr(profiles, 'vanity_ids', {})
+    monkeypatch.setattr(profiles, 'pending_ids', set())
+    monkeypatch.setattr(profiles, 'pending_vanities', set())
+    monkeypatch.setattr(profiles, 'wake', Event())
+    return api.ISteamUser
+
+
+def test_names_are_fetched_in_batches(steam):
+    steamids = [STEAMID + i for i in range(250)]
+    names = profiles.fetch_names(steamids + [1])
+    assert [len(batch) for batch in steam.batches] == [100, 100, 51]
+    assert len(names) == 250
+    assert names[STEAMID + 249] == 'player 249'
+
+
+def test_names_expire(app, steam, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(profiles, 'monotonic', lambda: now[0])
+    assert profiles.get_name(STEAMID) == 'player 0'
+    assert profiles.get_name(STEAMID) == 'player 0'
+    assert len(steam.batches) == 1
+
+    now[0] += app.config['STEAM_PROFILE_CACHE_TTL'] + 1
+    assert profiles.cached_name(STEAMID) == (False, None)
+    assert profiles.get_name(STEAMID) == 'player 0'
+    assert len(steam.batches) == 2
+
+
+def test_refresh_users(app, steam):
+    db.session.add_all([
+        User(steamid64=STEAMID, name='old name'),
+        User(steamid64=STEAMID + 1, name='player 1'),
+        User(steamid64=1, name='unknown to steam'),
+    ])
+    db.session.commit()
+
+    assert profiles.refresh_users() == 1
+    assert db.session.get(User, STEAMID).name == 'player 0'
+    assert db.session.get(User, 1).name == 'unknown to steam'
+
+
+def new_user_form(app, steamid: str) -> NewUserForm:
+    with app.test_request_context(method='POST'):
+        form = NewUserForm(formdata=MultiDict({'steamid': steamid}))
+        form.validate()
+        return form
+
+
+def test_form_takes_ids_and_profile_urls(app, steam):
+    for string in (
+        str(STEAMID),
+        '[U:1:22202]',
+        f'https://steamcommunity.com/profiles/{STEAMID}/',
+    ):
+        form = new_user_form(app, string)
+        assert form.steamid.data.as_64 == STEAMID
+        assert not form.errors
+
+
+def test_custom_url_is_looked_up_in_the_background(app, steam):
+    form = new_user_form(app, VANITY_URL)
+    assert 'Try again' in form.errors['steamid'][0]
+    assert steam.vanity_lookups == 0
+    assert profiles.pending_vanities == {'gaben'}
+    assert profiles.wake.is_set()
+
+    profiles.resolve_pending()
+    assert steam.vanity_lookups == 1
+    assert profiles.pending_vanities == set()
+    # the name is fetched too, ready for the user to be added
+    assert profiles.cached_name(STEAMID) == (True, 'player 0')
+
+    form = new_user_form(app, VANITY_URL)
+    assert form.steamid.data.as_64 == STEAMID
+    assert not form.errors
+    assert steam.vanity_lookups == 1
+
+
+def test_unknown_custom_url_is_rejected(app, steam):
+    new_user_form(app, 'nobody')
+    profiles.resolve_pending()
+    form = new_user_form(app, 'nobody')
+    assert 'No Steam user' in form.errors['steamid'][0]
+
+
+@pytest.fixture
+def admin(app):
+    db.session.add(User(steamid64=1, admin=True, name='admin'))
+    db.session.commit()
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = '1'
+    return client
+
+
+def added(steamid: int) -> str | None:
+    db.session.expire_all()
+    user = db.session.get(User, steamid)
+    return user and user.name
+
+
+def test_create_user_checks_the_user_exists(app, steam, admin):
+    admin.post('/user/create', data={'steamid': str(STEAMID)})
+    assert added(STEAMID) is None
+    assert profiles.pending_ids == {STEAMID}
+
+    profiles.resolve_pending()
+    admin.post('/user/create', data={'steamid': str(STEAMID)})
+    assert added(STEAMID) == 'player 0'
+
+
+def test_create_user_rejects_unknown_users(app, steam, admin):
+    unknown = STEAMID + 1000
+    admin.post('/user/create', data={'steamid': str(unknown)})
+    profiles.resolve_pending()
+    admin.post('/user/create', data={'steamid': str(unknown)})
+    assert added(unknown) is None
+    assert profiles.cached_name(unknown) == (True, None)
@@ -0,0 +1,23 @@
+import os
+
+from fastdl import profiling
+from fastdl.profiling import unwrap_stat, wrap_stat
+
+
+def test_stat_is_wrapped_only_while_profiling():
+    assert os.stat is profiling.original_stat
+    wrap_stat()
+    wrap_stat()
+    assert os.stat is profiling.counting_stat
+    unwrap_stat()
+    assert os.stat is profiling.counting_stat
+    unwrap_stat()
+    assert os.stat is profiling.original_stat
+
+
+def test_sampled_request(app, monkeypatch):
+    monkeypatch.setitem(app.config, 'PROFILE_SAMPLE_RATE', 1)
+    monkeypatch.setitem(app.config, 'PROFILE_DIR', None)
+    response = app.test_client().get('/login')
+    assert 'total;dur=' in response.headers['Server-Timing']
+    assert os.stat is profiling.original_stat
@@ -0,0 +1,59 @@
+import pytest
+
+from fastdl import ratelimit
+from fastdl.ratelimit import TokenBucket
+
+
+class Sleeps(list):
+    clock: list[float]
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """Seconds slept, on a clock that only moves when slept or advanced"""
+    now = [1000.0]
+    slept = Sleeps()
+
+    def sleep(seconds: float):
+        slept.append(seconds)
+        now[0] += seconds
+
+    monkeypatch.setattr(ratelimit, 'monotonic', lambda: now[0])
+    monkeypatch.setattr(ratelimit, 'sleep', sleep)
+    slept.clock = now
+    return slept
+
+
+def test_unlimited_never_sleeps(sleeps):
+    bucket = TokenBucket()
+    for _ in range(10):
+        bucket.consume(10 ** 9)
+    assert sleeps == []
+
+
+def test_sleeps_off_going_over_the_rate(sleeps):
+    bucket = TokenBucket(1000)
+    bucket.consume(500)
+    bucket.consume(1000)
+    bucket.consume(1000)
+    assert sleeps == [0.5, 1.0, 1.0]
+
+
+def test_idle_allowance_is_capped_at_burst(sleeps):
+    bucket = TokenBucket(1000, burst=2.0)
+    sleeps.clock[0] += 60
+    bucket.consume(2000)
+    assert sleeps == []
+    bucket.consume(500)
+    assert sleeps == [0.5]
+
+
+def test_new_rate_starts_without_allowance(sleeps):
+    bucket = TokenBucket(1000)
+    sleeps.clock[0] += 1
+    bucket.set_rate(100)
+    bucket.consume(100)
+    assert sleeps == [1.0]
+    bucket.set_rate(0)
+    bucket.consume(10 ** 9)
+    assert sleeps == [1.0]
@@ -0,0 +1,201 @@
+from bz2 import decompress
+from datetime import timedelta
+from hashlib import sha256
+from io import BytesIO
+from os import path
+
+import pytest
+
+from fastdl import compress, db, upload_ftp
+from fastdl.models import Map, Upload, User
+from fastdl.storage import partial_path
+
+
+CHUNK = 4096
+MAP = b'VBSP' + bytes(range(256)) * 40
+
+
+@pytest.fixture
+def client(app, monkeypatch):
+    # pushing to game servers is not what these tests are about
+    monkeypatch.setattr(upload_ftp, 'start', lambda: None)
+    monkeypatch.setitem(app.config, 'UPLOAD_CHUNK_SIZE', CHUNK)
+    db.session.add(User(steamid64=1, admin=True, name='test'))
+    db.session.commit()
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = '1'
+    return client
+
+
+def start(client, name: str = 'cp_test.bsp', size: int = len(MAP)) -> dict:
+    return client.post(
+        '/upload/chunked',
+        json={'name': name, 'size': size}
+    ).get_json()
+
+
+def chunk(index: int, data: bytes = MAP) -> bytes:
+    return data[index * CHUNK:(index + 1) * CHUNK]
+
+
+def put(client, id: int, index: int, data: bytes, **headers) -> dict:
+    return client.put(
+        f'/upload/chunked/{id}/{index}',
+        data=data,
+        headers=headers
+    ).get_json()
+
+
+def finish(client, id: int) -> dict:
+    return client.post(f'/upload/chunked/{id}/finish').get_json()
+
+
+def assert_stored(map: Map, data: bytes):
+    assert map.uploaded
+    assert map.digest == sha256(data).hexdigest()
+    assert map.size == len(data)
+    with open(map.filename, 'rb') as file:
+        assert file.read() == data
+
+
+def assert_compressed(map: Map, data: bytes):
+    assert map.compressed
+    assert map.compress_level == 9
+    assert map.compress_time is not None
+    assert map.compress_job is None
+    with open(map.filename_compressed, 'rb') as file:
+        assert decompress(file.read()) == data
+
+
+def assert_queued(map: Map, data: bytes):
+    """Check that finishing left compression to the job queue, then run it"""
+    assert not map.compressed
+    assert map.compress_job is not None
+    compress.compress_map(map.id)
+    db.session.refresh(map)
+    assert_compressed(map, data)
+
+
+def test_resume_and_finish(client):
+    upload = start(client)
+    assert upload['chunk_size'] == CHUNK
+    assert upload['received'] == []
+    assert put(client, upload['id'], 0, chunk(0))['success']
+    assert put(client, upload['id'], 2, chunk(2))['success']
+
+    resumed = start(client)
+    assert resumed['id'] == upload['id']
+    assert resumed['received'] == [
+        [0, sha256(chunk(0)).hexdigest()],
+        [2, sha256(chunk(2)).hexdigest()],
+    ]
+    assert finish(client, upload['id'])['error'] == (
+        '1 chunks have not been uploaded.'
+    )
+
+    assert put(client, upload['id'], 1, chunk(1))['success']
+    assert finish(client, upload['id'])['success']
+    map = db.session.get(Map, upload['id'])
+    assert_stored(map, MAP)
+    assert db.session.get(Upload, map.id) is None
+    assert not path.exists(partial_path(map.id))
+    assert_queued(map, MAP)
+
+
+def test_wrong_chunk_length(client):
+    upload = start(client)
+    response = put(client, upload['id'], 0, chunk(0)[:-1])
+    assert response['error'] == 'Chunk has the wrong length.'
+
+
+def test_damaged_chunk_is_uploaded_again(client):
+    upload = start(client)
+    for index in range(3):
+        put(client, upload['id'], index, chunk(index))
+
+    # a retry that arrives damaged overwrites the good copy
+    damaged = bytes(CHUNK)
+    response = put(
+        client, upload['id'], 1, damaged,
+        X_Chunk_SHA256=sha256(chunk(1)).hexdigest()
+    )
+    assert response['error'] == 'Chunk checksum mismatch.'
+
+    assert finish(client, upload['id'])['error'] == (
+        '1 chunks were damaged; upload them again.'
+    )
+    assert [index for index, _ in start(client)['received']] == [0, 2]
+
+    put(client, upload['id'], 1, chunk(1))
+    assert finish(client, upload['id'])['success']
+    map = db.session.get(Map, upload['id'])
+    assert_stored(map, MAP)
+    assert_queued(map, MAP)
+
+
+def test_not_a_map_is_rejected(client):
+    data = b'nope' + MAP[4:]
+    upload = start(client)
+    for index in range(3):
+        put(client, upload['id'], index, chunk(index, data))
+    assert 'valid BSP' in finish(client, upload['id'])['error']
+    assert db.session.get(Map, upload['id']) is None
+
+
+def test_small_map_in_one_request(client):
+    response = client.post(
+        '/upload',
+        data={'map': (BytesIO(MAP), 'cp_small.bsp')},
+        headers={'Accept': 'application/json'}
+    ).get_json()
+    assert response['success']
+    map = db.session.get(Map, response['id'])
+    assert_stored(map, MAP)
+    # compressed on the way, rather than queued
+    assert_compressed(map, MAP)
+
+
+def test_prune_keeps_uploads_in_progress(app, client, make_map):
+    upload = start(client)
+    gone = make_map('cp_gone.bsp', MAP)
+    gone.delete()
+
+    result = app.test_cli_runner().invoke(args=['maps', 'prune'])
+    assert result.output == 'pruned cp_gone.bsp\n'
+    assert db.session.get(Map, upload['id']) is not None
+
+
+def test_abandoned_upload_expires(app, client):
+    upload = start(client)
+    put(client, upload['id'], 0, chunk(0))
+    map = db.session.get(Map, upload['id'])
+    map.upload.started -= timedelta(seconds=app.config['UPLOAD_EXPIRY'] + 1)
+    db.session.commit()
+
+    # a different file under the same name takes the name over
+    retry = start(client, size=len(MAP) - 1)
+    assert retry['success']
+    assert retry['size'] == len(MAP) - 1
+    assert retry['received'] == []
+
+
+def test_prune_expires_abandoned_uploads(app, client):
+    upload = start(client)
+    map = db.session.get(Map, upload['id'])
+    map.upload.started -= timedelta(seconds=app.config['UPLOAD_EXPIRY'] + 1)
+    db.session.commit()
+
+    result = app.test_cli_runner().invoke(args=['maps', 'prune'])
+    assert result.output == 'expired upload of cp_test.bsp\n'
+    assert db.session.get(Map, upload['id']) is None
+    assert not path.exists(partial_path(upload['id']))
+
+
+def test_admin_can_cancel_upload(client):
+    upload = start(client)
+    put(client, upload['id'], 0, chunk(0))
+
+    client.post('/map/delete', data={'id': upload['id']})
+    assert db.session.get(Map, upload['id']) is None
+    assert not path.exists(partial_path(upload['id']))
@@ -0,0 +1,247 @@
+from datetime import timedelta
+from hashlib import sha256
+from ipaddress import IPv4Address
+from os import urandom
+
+import pytest
+
+from fastdl import db, upload_ftp
+from fastdl.models import (
+    Distribution, DistributionState, PushMode, Server, ServerFile,
+    UTCDateTime
+)
+from fastdl.upload_ftp import (
+    block_hashes, claim, finish_distribution, plan_push, reconcile, requeue
+)
+
+
+BLOCK = 1024
+
+
+@pytest.fixture(autouse=True)
+def small_blocks(monkeypatch):
+    monkeypatch.setattr(upload_ftp, 'DELTA_BLOCK_SIZE', BLOCK)
+
+
+@pytest.fixture
+def server(app):
+    server = Server(
+        ip=IPv4Address('203.0.113.10'),
+        port=27015,
+        description='test',
+        ftp_push=PushMode.Delta
+    )
+    db.session.add(server)
+    db.session.commit()
+    return server
+
+
+def pushed(server, map, data: bytes, compressed: bool = False):
+    """Record data as what was last pushed of map"""
+    with open(map.filename, 'wb') as file:
+        file.write(data)
+    db.session.add(ServerFile(
+        server=server,
+        name=map.name,
+        size=len(data),
+        digest=sha256(data).hexdigest(),
+        compressed=compressed,
+        blocks=block_hashes(map.filename)
+    ))
+    db.session.commit()
+
+
+def change(map, data: bytes):
+    with open(map.filename, 'wb') as file:
+        file.write(data)
+    map.record_files()
+    db.session.commit()
+
+
+def test_first_push_sends_everything(server, make_map):
+    map = make_map('cp_test.bsp', urandom(4 * BLOCK))
+    push = plan_push(server.id, map.id)
+    assert push.offset == 0
+    assert push.previous_size is None
+    assert push.size == 4 * BLOCK
+    assert push.blocks == block_hashes(map.filename)
+
+
+def test_up_to_date_server_is_skipped(server, make_map):
+    data = urandom(4 * BLOCK)
+    map = make_map('cp_test.bsp', data)
+    pushed(server, map, data)
+    assert plan_push(server.id, map.id) is None
+
+
+def test_resumes_from_first_changed_block(server, make_map):
+    old = urandom(4 * BLOCK)
+    map = make_map('cp_test.bsp', old)
+    pushed(server, map, old)
+
+    new = bytearray(old)
+    new[2 * BLOCK + 10] ^= 0xff
+    new[3 * BLOCK + 10] ^= 0xff
+    change(map, bytes(new))
+    push = plan_push(server.id, map.id)
+    assert push.offset == 2 * BLOCK
+    assert push.previous_size == 4 * BLOCK
+
+
+def test_appended_data_resends_last_partial_block(server, make_map):
+    old = urandom(3 * BLOCK + BLOCK // 2)
+    map = make_map('cp_test.bsp', old)
+    pushed(server, map, old)
+
+    change(map, old + urandom(BLOCK))
+    assert plan_push(server.id, map.id).offset == 3 * BLOCK
+
+
+def test_appended_whole_blocks(server, make_map):
+    old = urandom(3 * BLOCK)
+    map = make_map('cp_test.bsp', old)
+    pushed(server, map, old)
+
+    change(map, old + urandom(2 * BLOCK))
+    assert plan_push(server.id, map.id).offset == 3 * BLOCK
+
+
+def test_shrunk_map_is_sent_whole(server, make_map):
+    old = urandom(4 * BLOCK)
+    map = make_map('cp_test.bsp', old)
+    pushed(server, map, old)
+
+    change(map, old[:2 * BLOCK])
+    assert plan_push(server.id, map.id).offset == 0
+
+
+def test_compressed_push_is_not_built_on(server, make_map):
+    old = urandom(4 * BLOCK)
+    map = make_map('cp_test.bsp', old)
+    pushed(server, map, old, compressed=True)
+
+    change(map, old + urandom(BLOCK))
+    push = plan_push(server.id, map.id)
+    assert push.offset == 0
+    assert push.stale == 'cp_test.bsp.bz2'
+
+
+def test_whole_map_mode_sends_everything(server, make_map):
+    server.ftp_push = PushMode.Map
+    old = urandom(4 * BLOCK)
+    map = make_map('cp_test.bsp', old)
+    pushed(server, map, old)
+
+    change(map, old + urandom(BLOCK))
+    push = plan_push(server.id, map.id)
+    assert push.offset == 0
+    assert push.blocks is None
+
+
+def distribute(server, map, **values) -> Distribution:
+    distribution = Distribution(map=map, server=server, **values)
+    db.session.add(distribution)
+    db.session.commit()
+    return distribution
+
+
+def test_push_is_claimed_once(server, make_map):
+    map = make_map('cp_test.bsp', urandom(BLOCK))
+    distribution = distribute(server, map)
+    assert claim(server.id, map.id)
+    assert not claim(server.id, map.id)
+
+    finish_distribution(server.id, map.id, None)
+    db.session.refresh(distribution)
+    assert distribution.state == DistributionState.Done
+    assert distribution.claimed_by is None
+    # done pushes are not pushed again
+    assert not claim(server.id, map.id)
+
+
+def test_failed_push_can_be_claimed_again(server, make_map):
+    map = make_map('cp_test.bsp', urandom(BLOCK))
+    distribution = distribute(server, map)
+    assert claim(server.id, map.id)
+    finish_distribution(server.id, map.id, 'connection refused')
+    db.session.refresh(distribution)
+    assert distribution.state == DistributionState.Pending
+    assert claim(server.id, map.id)
+
+
+def test_stale_claim_is_taken_over(app, server, make_map):
+    map = make_map('cp_test.bsp', urandom(BLOCK))
+    timeout = app.config['FTP_CLAIM_TIMEOUT']
+    distribution = distribute(
+        server, map,
+        claimed_by='elsewhere:1',
+        claimed_at=UTCDateTime.utcnow() - timedelta(seconds=timeout - 60)
+    )
+    assert not claim(server.id, map.id)
+
+    distribution.claimed_at -= timedelta(seconds=120)
+    db.session.commit()
+    assert claim(server.id, map.id)
+
+
+def test_new_queue_gets_server_limit(monkeypatch, server, make_map):
+    monkeypatch.setattr(upload_ftp, 'servers', {})
+    monkeypatch.setattr(upload_ftp, 'rotation', upload_ftp.deque())
+    monkeypatch.setattr(upload_ftp, 'queued', set())
+    server.ftp_enabled = True
+    server.ftp_rate_limit = 100
+    distribute(server, make_map('cp_test.bsp', urandom(BLOCK)))
+
+    requeue()
+    assert upload_ftp.servers[server.id].bucket.rate == 100 * 1024
+
+
+def test_push_uses_recorded_hash(monkeypatch, server, make_map):
+    data = urandom(BLOCK)
+    map = make_map('cp_test.bsp', data)
+    hashed = []
+    monkeypatch.setattr(upload_ftp, 'hash_file', hashed.append)
+    assert plan_push(server.id, map.id).digest == sha256(data).hexdigest()
+    assert hashed == []
+
+
+def test_push_hashes_old_maps_once(monkeypatch, server, make_map):
+    data = urandom(BLOCK)
+    map = make_map('cp_test.bsp', data)
+    map.content_hash = None
+    db.session.commit()
+    hashed = []
+
+    def hash_file(filename):
+        hashed.append(filename)
+        return sha256(data).hexdigest()
+
+    monkeypatch.setattr(upload_ftp, 'hash_file', hash_file)
+    plan_push(server.id, map.id)
+    plan_push(server.id, map.id)
+    assert hashed == [map.filename]
+    assert map.content_hash == sha256(data).hexdigest()
+
+
+def test_reconcile_adopts_maps_outside_the_blob_store(server, make_map):
+    data = urandom(4 * BLOCK)
+    map = make_map('cp_test.bsp', data)
+    assert map.digest is None
+
+    assert reconcile(server, {map.name: len(data)}) == 0
+    file = db.session.get(ServerFile, (server.id, map.name))
+    assert file.digest == sha256(data).hexdigest()
+    distribution = db.session.get(Distribution, (map.id, server.id))
+    assert distribution.state == DistributionState.Done
+
+
+def test_reconcile_requeues_changed_maps(server, make_map):
+    old = urandom(4 * BLOCK)
+    map = make_map('cp_test.bsp', old)
+    pushed(server, map, old)
+    change(map, urandom(4 * BLOCK))
+
+    assert reconcile(server, {map.name: 4 * BLOCK}) == 1
+    assert db.session.get(ServerFile, (server.id, map.name)) is None
+    distribution = db.session.get(Distribution, (map.id, server.id))
+    assert distribution.state == DistributionState.Pending
@@ -0,0 +1,86 @@
+from io import StringIO
+from json import dump, load
+from os import path, unlink, utime
+from time import time
+from types import SimpleNamespace
+
+import pytest
+
+from fastdl import webapi
+from fastdl.webapi import LazyWebAPI, get_interfaces
+
+
+OLD = {'apilist': {'interfaces': [{'name': 'ISteamOld'}]}}
+NEW = {'apilist': {'interfaces': [{'name': 'ISteamNew'}]}}
+
+
+class FakeAPI:
+    def __init__(self, interfaces: dict | None = None):
+        self.interfaces = interfaces
+        self.fetched = 0
+
+    def fetch_interfaces(self) -> dict:
+        self.fetched += 1
+        if self.interfaces is None:
+            raise ConnectionError('Steam is down')
+        return self.interfaces
+
+
+@pytest.fixture
+def cache(app):
+    """Write OLD to the interface cache, as if age seconds ago"""
+    filename = app.config['STEAM_INTERFACE_CACHE']
+
+    def cache(age: float):
+        with open(filename, 'w') as file:
+            dump(OLD, file)
+        written = time() - age
+        utime(filename, (written, written))
+    yield cache
+    if path.exists(filename):
+        unlink(filename)
+
+
+def test_client_is_created_on_first_use(monkeypatch):
+    created = []
+
+    def create_webapi():
+        created.append(True)
+        return SimpleNamespace(ISteamUser='user', ISteamApps='apps')
+
+    monkeypatch.setattr(webapi, 'create_webapi', create_webapi)
+    api = LazyWebAPI()
+    assert created == []
+    assert api.ISteamUser == 'user'
+    assert api.ISteamApps == 'apps'
+    assert created == [True]
+
+
+def test_fresh_cache_is_used_without_asking_steam(app, cache):
+    cache(0)
+    api = FakeAPI(NEW)
+    assert get_interfaces(api) == OLD
+    assert api.fetched == 0
+
+
+def test_old_cache_is_refreshed(app, cache):
+    cache(app.config['STEAM_INTERFACE_CACHE_TTL'] + 1)
+    api = FakeAPI(NEW)
+    assert get_interfaces(api) == NEW
+    with open(app.config['STEAM_INTERFACE_CACHE']) as file:
+        assert load(file) == NEW
+
+
+def test_old_cache_is_used_while_steam_is_down(app, cache, monkeypatch):
+    errors = StringIO()
+    monkeypatch.setattr(webapi, 'stderr', errors)
+    cache(app.config['STEAM_INTERFACE_CACHE_TTL'] + 1)
+    api = FakeAPI()
+    assert get_interfaces(api) == OLD
+    assert api.fetched == 1
+    assert 'Steam is down' in errors.getvalue()
+
+
+def test_no_cache_and_no_steam_fails(app, cache):
+    with pytest.raises(ConnectionError):
+        get_interfaces(FakeAPI())
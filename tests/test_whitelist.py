@@ -0,0 +1,60 @@
+from ipaddress import IPv4Address
+
+import pytest
+
+from fastdl import db, whitelist
+from fastdl.models import Server
+
+
+ADDRESS = IPv4Address('203.0.113.10')
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(whitelist, 'monotonic', lambda: now[0])
+    whitelist.invalidate()
+    yield now
+    whitelist.invalidate()
+
+
+def add_server(port: int) -> Server:
+    server = Server(ip=ADDRESS, port=port, description='test')
+    db.session.add(server)
+    db.session.commit()
+    return server
+
+
+def test_lookup(app, clock):
+    server = add_server(27015)
+    assert whitelist.lookup(ADDRESS, 27015) == server.id
+    assert whitelist.lookup(ADDRESS, 27016) is None
+    assert whitelist.lookup(IPv4Address('203.0.113.11'), 27015) is None
+
+
+def test_new_server_is_seen_after_ttl(app, clock):
+    assert whitelist.lookup(ADDRESS, 27015) is None
+    server = add_server(27015)
+
+    clock[0] += app.config['WHITELIST_TTL'] - 1
+    assert whitelist.lookup(ADDRESS, 27015) is None
+    clock[0] += 2
+    assert whitelist.lookup(ADDRESS, 27015) == server.id
+
+
+def test_deleted_server_is_dropped_after_ttl(app, clock):
+    server = add_server(27015)
+    assert whitelist.lookup(ADDRESS, 27015) == server.id
+    db.session.delete(server)
+    db.session.commit()
+
+    assert whitelist.lookup(ADDRESS, 27015) == server.id
+    clock[0] += app.config['WHITELIST_TTL'] + 1
+    assert whitelist.lookup(ADDRESS, 27015) is None
+
+
+def test_invalidate_reloads_straight_away(app, clock):
+    assert whitelist.lookup(ADDRESS, 27015) is None
+    server = add_server(27015)
+    whitelist.invalidate()
+    assert whitelist.lookup(ADDRESS, 27015) == server.id